@@ -3,9 +3,34 @@ CREATE EXTENSION "uuid-ossp";
 CREATE OR REPLACE FUNCTION public.notify_me()
   RETURNS trigger AS
 $BODY$
+DECLARE
+  new_row jsonb;
+  old_row jsonb;
 BEGIN
-  -- Создание сообщения в канал DB_NOTIFY и сообщением с наименованием сущности-инициатора
-  EXECUTE 'SELECT pg_notify(''DB_NOTIFY'', ''' || TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME || ''')';
+  IF TG_OP = 'DELETE' THEN
+    new_row := to_jsonb(OLD);
+  ELSE
+    new_row := to_jsonb(NEW);
+  END IF;
+  IF TG_OP = 'UPDATE' THEN
+    old_row := to_jsonb(OLD);
+  END IF;
+  -- Создание сообщения в канал DB_NOTIFY с данными об измененной записи:
+  --  t     - наименование сущности-инициатора
+  --  id    - идентификатор записи
+  --  os/ns - статус до и после изменения (status_id или status)
+  --  mt    - тип сообщения (для manager.message)
+  --  g     - получатель (для manager.message)
+  -- Для секционированной сущности триггер срабатывает на секции, поэтому наименование
+  -- сущности передается аргументом триггера (TG_ARGV[0])
+  PERFORM pg_notify('DB_NOTIFY', jsonb_strip_nulls(jsonb_build_object(
+    't', COALESCE(TG_ARGV[0], TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME),
+    'id', new_row ->> 's_id',
+    'os', COALESCE(old_row ->> 'status_id', old_row ->> 'status'),
+    'ns', COALESCE(new_row ->> 'status_id', new_row ->> 'status'),
+    'mt', new_row ->> 'msg_type',
+    'g', new_row ->> 'get_id'
+  ))::text);
   RETURN NULL;
 END;
 $BODY$
@@ -100,7 +125,8 @@ CREATE TABLE manager.main_task_log (
     status_id uuid,
     add_task_date timestamp with time zone,
     exec_task_date timestamp with time zone,
-    end_task_date timestamp with time zone
+    end_task_date timestamp with time zone,
+    current_task_id uuid
 );
 
 ALTER TABLE manager.main_task_log OWNER TO postgres;
@@ -113,6 +139,38 @@ COMMENT ON COLUMN manager.main_task_log.status_id IS 'Статус выполн
 COMMENT ON COLUMN manager.main_task_log.add_task_date IS 'Дата и время постановки задачи';
 COMMENT ON COLUMN manager.main_task_log.exec_task_date IS 'Дата и время начала выполнения задачи';
 COMMENT ON COLUMN manager.main_task_log.end_task_date IS 'Дата и время окончания выполнения задачи';
+COMMENT ON COLUMN manager.main_task_log.current_task_id IS 'Текущая задача';
+
+
+-- Экземпляры менеджера задач (режим нескольких экземпляров): аренда продлевается экземпляром,
+-- экземпляры с действующей арендой делят между собой секции записей аудита и сообщений
+CREATE UNLOGGED TABLE manager.manager_instance (
+    s_id uuid NOT NULL,
+    host character varying,
+    lease_until timestamp with time zone NOT NULL,
+    date_created timestamp with time zone DEFAULT now()
+) WITH (fillfactor = 50);
+
+ALTER TABLE manager.manager_instance OWNER TO postgres;
+
+COMMENT ON TABLE manager.manager_instance IS 'Экземпляры менеджера задач';
+
+COMMENT ON COLUMN manager.manager_instance.s_id IS 'Идентификатор';
+COMMENT ON COLUMN manager.manager_instance.host IS 'Хост';
+COMMENT ON COLUMN manager.manager_instance.lease_until IS 'Дата и время окончания аренды';
+COMMENT ON COLUMN manager.manager_instance.date_created IS 'Дата и время регистрации';
+
+
+-- Секция записи для распределения обработки между экземплярами менеджера задач
+CREATE OR REPLACE FUNCTION manager.shard_of(p_id uuid, p_shard_count integer)
+  RETURNS integer AS
+$BODY$
+  SELECT mod(hashtext(p_id::text)::bigint + 2147483648, p_shard_count)::integer;
+$BODY$
+  LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+  COST 1;
+ALTER FUNCTION manager.shard_of(uuid, integer)
+  OWNER TO postgres;
 
 
 CREATE TABLE manager.message (
@@ -125,7 +183,8 @@ CREATE TABLE manager.message (
     data jsonb,
     msg_type character varying,
     status character varying,
-    date_created timestamp with time zone
+    date_created timestamp with time zone,
+    instance_id uuid
 );
 
 
@@ -143,13 +202,37 @@ COMMENT ON COLUMN manager.message.data IS 'Сообщение';
 COMMENT ON COLUMN manager.message.msg_type IS 'Тип сообщения';
 COMMENT ON COLUMN manager.message.status IS 'Статус отправки';
 COMMENT ON COLUMN manager.message.date_created IS 'Дата создания';
+COMMENT ON COLUMN manager.message.instance_id IS 'Экземпляр службы-получателя';
+
+
+-- Данные результатов сообщений, вынесенные из атрибута data (результаты длительных задач частями).
+-- Внешнего ключа на сообщение нет (сущность "Сообщения" может быть секционирована): данные сообщений
+-- выгруженных секций удаляет менеджер задач (TaskSVC.manage_message_partition)
+CREATE TABLE manager.message_payload (
+    s_id uuid DEFAULT public.uuid_generate_v4() NOT NULL,
+    message_id uuid NOT NULL,
+    number integer NOT NULL,
+    data jsonb,
+    date_created timestamp with time zone DEFAULT now()
+);
+
+ALTER TABLE manager.message_payload OWNER TO postgres;
+
+COMMENT ON TABLE manager.message_payload IS 'Данные сообщений';
+
+COMMENT ON COLUMN manager.message_payload.s_id IS 'Идентификатор';
+COMMENT ON COLUMN manager.message_payload.message_id IS 'Сообщение';
+COMMENT ON COLUMN manager.message_payload.number IS 'Порядковый номер части';
+COMMENT ON COLUMN manager.message_payload.data IS 'Часть результата';
+COMMENT ON COLUMN manager.message_payload.date_created IS 'Дата создания';
 
 
 CREATE TABLE manager.method_module (
     s_id uuid DEFAULT public.uuid_generate_v4() NOT NULL,
     module_id uuid,
     name character varying,
-    system_name character varying
+    system_name character varying,
+    is_batch boolean DEFAULT false NOT NULL
 );
 
 ALTER TABLE manager.method_module OWNER TO postgres;
@@ -160,6 +243,7 @@ COMMENT ON COLUMN manager.method_module.s_id IS 'Идентификатор';
 COMMENT ON COLUMN manager.method_module.module_id IS 'Служба';
 COMMENT ON COLUMN manager.method_module.name IS 'Наименование';
 COMMENT ON COLUMN manager.method_module.system_name IS 'Системное наименование';
+COMMENT ON COLUMN manager.method_module.is_batch IS 'Признак пакетного выполнения команд (одна задача на группу команд)';
 
 
 CREATE TABLE manager.module (
@@ -181,6 +265,64 @@ COMMENT ON COLUMN manager.module.channel_name IS 'Наименование ка
 COMMENT ON COLUMN manager.module.status IS 'Статус';
 
 
+CREATE TABLE manager.module_instance (
+    s_id uuid DEFAULT public.uuid_generate_v4() NOT NULL,
+    module_id uuid NOT NULL,
+    channel_name character varying NOT NULL,
+    capacity integer DEFAULT 1 NOT NULL,
+    host character varying,
+    date_created timestamp with time zone DEFAULT now()
+);
+
+ALTER TABLE manager.module_instance OWNER TO postgres;
+
+COMMENT ON TABLE manager.module_instance IS 'Экземпляры служб';
+
+COMMENT ON COLUMN manager.module_instance.s_id IS 'Идентификатор';
+COMMENT ON COLUMN manager.module_instance.module_id IS 'Служба';
+COMMENT ON COLUMN manager.module_instance.channel_name IS 'Наименование канала экземпляра';
+COMMENT ON COLUMN manager.module_instance.capacity IS 'Емкость (количество потоков)';
+COMMENT ON COLUMN manager.module_instance.host IS 'Хост';
+COMMENT ON COLUMN manager.module_instance.date_created IS 'Дата и время регистрации';
+
+
+-- Сигналы работоспособности служб: одна запись на экземпляр службы, обновляемая на месте
+-- (нежурналируемая сущность - после аварийного перезапуска СУБД очищается, что допустимо для сигналов)
+CREATE UNLOGGED TABLE manager.module_heartbeat (
+    instance_id uuid NOT NULL,
+    module_id uuid NOT NULL,
+    beat_date timestamp with time zone DEFAULT now() NOT NULL
+) WITH (fillfactor = 50);
+
+ALTER TABLE manager.module_heartbeat OWNER TO postgres;
+
+COMMENT ON TABLE manager.module_heartbeat IS 'Сигналы работоспособности служб';
+
+COMMENT ON COLUMN manager.module_heartbeat.instance_id IS 'Экземпляр службы (для службы без экземпляров - служба)';
+COMMENT ON COLUMN manager.module_heartbeat.module_id IS 'Служба';
+COMMENT ON COLUMN manager.module_heartbeat.beat_date IS 'Дата и время последнего сигнала';
+
+
+CREATE OR REPLACE FUNCTION manager.module_heartbeat(p_module_id uuid, p_instance_id uuid DEFAULT NULL)
+  RETURNS void AS
+$BODY$
+BEGIN
+  -- Сохранение времени сигнала и уведомление менеджера задач
+  --  id - экземпляр службы (для службы без экземпляров - служба)
+  --  m  - служба
+  INSERT INTO manager.module_heartbeat (instance_id, module_id, beat_date)
+    VALUES (COALESCE(p_instance_id, p_module_id), p_module_id, now())
+    ON CONFLICT (instance_id) DO UPDATE SET beat_date = EXCLUDED.beat_date;
+  PERFORM pg_notify('DB_NOTIFY', jsonb_build_object(
+    't', 'manager.module_heartbeat', 'id', COALESCE(p_instance_id, p_module_id), 'm', p_module_id)::text);
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 1;
+ALTER FUNCTION manager.module_heartbeat(uuid, uuid)
+  OWNER TO postgres;
+
+
 CREATE TABLE manager.object_to_command_log (
     s_id uuid DEFAULT public.uuid_generate_v4() NOT NULL,
     command_log_id uuid,
@@ -278,8 +420,12 @@ COMMENT ON COLUMN manager.task_completion_status.system_name IS 'Системн
 ALTER TABLE ONLY manager.action ADD CONSTRAINT action_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.command_log ADD CONSTRAINT command_log_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.command ADD CONSTRAINT command_pkey PRIMARY KEY (s_id);
+ALTER TABLE ONLY manager.module_heartbeat ADD CONSTRAINT module_heartbeat_pkey PRIMARY KEY (instance_id);
+ALTER TABLE ONLY manager.module_instance ADD CONSTRAINT module_instance_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.main_task_log ADD CONSTRAINT main_task_log_pkey PRIMARY KEY (s_id);
+ALTER TABLE ONLY manager.manager_instance ADD CONSTRAINT manager_instance_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.message ADD CONSTRAINT message_pkey PRIMARY KEY (s_id);
+ALTER TABLE ONLY manager.message_payload ADD CONSTRAINT message_payload_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.method_module ADD CONSTRAINT method_module_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.module ADD CONSTRAINT module_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.object_to_command_log ADD CONSTRAINT object_to_command_log_pkey PRIMARY KEY (s_id);
@@ -290,12 +436,56 @@ ALTER TABLE ONLY manager.task_sequence ADD CONSTRAINT task_sequence_pkey PRIMARY
 ALTER TABLE ONLY manager.task_completion_status ADD CONSTRAINT task_completion_status_pkey PRIMARY KEY (s_id);
 ALTER TABLE ONLY manager.base_task ADD CONSTRAINT base_task_pkey PRIMARY KEY (s_id);
 
+-- Индексы под фильтры менеджера задач (поиск изменений, создание сообщений, периодическая задача)
+-- Сообщения к отправке: refresh_message -> send_notify
+CREATE INDEX message_pending_idx ON manager.message (msg_type, send_id) WHERE status IS NULL;
+-- Отправленные и еще не полученные сообщения по получателю: refresh_message
+CREATE INDEX message_sent_get_idx ON manager.message (get_id, msg_type) WHERE status = 'Отправлено';
+-- Последние сообщения по задаче и по команде: create_message (DISTINCT ON), внешние ключи
+CREATE INDEX message_task_log_idx ON manager.message (task_log_id, msg_type, date_created DESC);
+CREATE INDEX message_command_log_idx ON manager.message (command_log_id, msg_type, date_created DESC) WHERE command_log_id IS NOT NULL;
+-- Ответы на сообщение (child_list): неотвеченные задачи экземпляров служб
+CREATE INDEX message_parent_msg_idx ON manager.message (parent_msg_id) WHERE parent_msg_id IS NOT NULL;
+-- Задачи, отправленные экземплярам служб: переназначение задач экземпляра, который стал неработоспособным
+CREATE INDEX message_instance_idx ON manager.message (instance_id) WHERE instance_id IS NOT NULL;
+-- Сообщения о подключении между службами: refresh_message -> restart_log
+CREATE INDEX message_connect_idx ON manager.message (get_id, send_id, date_created) WHERE msg_type = 'Подключение';
+-- Части результата сообщения по порядку
+CREATE UNIQUE INDEX message_payload_message_idx ON manager.message_payload (message_id, number);
+
+-- Записи аудита по статусу (доля статусов "Поставлена", "Выполняется", "Отменено" мала)
+CREATE INDEX main_task_log_status_idx ON manager.main_task_log (status_id);
+CREATE INDEX task_log_status_idx ON manager.task_log (status_id);
+CREATE INDEX command_log_status_idx ON manager.command_log (status_id);
+-- Дочерние записи аудита со статусом: задачи базовой задачи, команды задачи, команды родительской команды
+CREATE INDEX task_log_main_task_log_idx ON manager.task_log (main_task_log_id, status_id);
+CREATE INDEX command_log_task_log_idx ON manager.command_log (task_log_id, status_id);
+CREATE INDEX command_log_parent_idx ON manager.command_log (parent_id, status_id) WHERE parent_id IS NOT NULL;
+CREATE INDEX object_to_task_log_task_log_idx ON manager.object_to_task_log (task_log_id);
+CREATE INDEX object_to_command_log_command_log_idx ON manager.object_to_command_log (command_log_id);
+
+-- Структура задач: операции задачи и команды операции по порядку
+CREATE INDEX task_sequence_base_task_idx ON manager.task_sequence (base_task_id, number);
+CREATE INDEX action_task_idx ON manager.action (task_id, number);
+CREATE INDEX command_action_idx ON manager.command (action_id, number);
+
 
 CREATE TRIGGER command_log_notify AFTER INSERT OR UPDATE ON manager.command_log FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
 CREATE TRIGGER main_task_log_notify AFTER INSERT OR UPDATE ON manager.main_task_log FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
 CREATE TRIGGER message_notify AFTER INSERT OR UPDATE ON manager.message FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
 CREATE TRIGGER task_log_notify AFTER INSERT OR UPDATE ON manager.task_log FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
 
+-- Справочные сущности: notify используется для сброса кэша справочников
+-- (для base_task, task_sequence, action и command - также для сброса кэша планов базовых задач)
+CREATE TRIGGER base_task_notify AFTER INSERT OR UPDATE OR DELETE ON manager.base_task FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER task_sequence_notify AFTER INSERT OR UPDATE OR DELETE ON manager.task_sequence FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER action_notify AFTER INSERT OR UPDATE OR DELETE ON manager.action FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER command_notify AFTER INSERT OR UPDATE OR DELETE ON manager.command FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER method_module_notify AFTER INSERT OR UPDATE OR DELETE ON manager.method_module FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER module_notify AFTER INSERT OR UPDATE OR DELETE ON manager.module FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER module_instance_notify AFTER INSERT OR UPDATE OR DELETE ON manager.module_instance FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+CREATE TRIGGER task_completion_status_notify AFTER INSERT OR UPDATE OR DELETE ON manager.task_completion_status FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+
 
 ALTER TABLE ONLY manager.action ADD CONSTRAINT action_method_id_fkey FOREIGN KEY (method_id) REFERENCES manager.method_module(s_id);
 ALTER TABLE ONLY manager.action ADD CONSTRAINT action_task_id_fkey FOREIGN KEY (task_id) REFERENCES manager.task(s_id);
@@ -311,6 +501,7 @@ ALTER TABLE ONLY manager.command ADD CONSTRAINT command_parent_id_fkey FOREIGN K
 
 ALTER TABLE ONLY manager.main_task_log ADD CONSTRAINT main_task_log_status_id_fkey FOREIGN KEY (status_id) REFERENCES manager.task_completion_status(s_id);
 ALTER TABLE ONLY manager.main_task_log ADD CONSTRAINT main_task_log_base_task_id_fkey FOREIGN KEY (base_task_id) REFERENCES manager.base_task(s_id);
+ALTER TABLE ONLY manager.main_task_log ADD CONSTRAINT main_task_log_current_task_id_fkey FOREIGN KEY (current_task_id) REFERENCES manager.task_log(s_id);
 
 ALTER TABLE ONLY manager.message ADD CONSTRAINT message_command_log_id_fkey FOREIGN KEY (command_log_id) REFERENCES manager.command_log(s_id);
 ALTER TABLE ONLY manager.message ADD CONSTRAINT message_get_id_id_fkey FOREIGN KEY (get_id) REFERENCES manager.module(s_id);
@@ -319,6 +510,7 @@ ALTER TABLE ONLY manager.message ADD CONSTRAINT message_send_id_fkey FOREIGN KEY
 ALTER TABLE ONLY manager.message ADD CONSTRAINT message_task_log_id_fkey FOREIGN KEY (task_log_id) REFERENCES manager.task_log(s_id);
 
 ALTER TABLE ONLY manager.method_module ADD CONSTRAINT method_module_module_id_id_fkey FOREIGN KEY (module_id) REFERENCES manager.module(s_id);
+ALTER TABLE ONLY manager.module_instance ADD CONSTRAINT module_instance_module_id_fkey FOREIGN KEY (module_id) REFERENCES manager.module(s_id);
 
 ALTER TABLE ONLY manager.object_to_command_log ADD CONSTRAINT object_to_command_log_command_log_id_id_fkey FOREIGN KEY (command_log_id) REFERENCES manager.command_log(s_id);
 
@@ -0,0 +1,149 @@
+-- Секционирование сущности "Сообщения" по дате создания (PostgreSQL 11+)
+--
+-- Сущность manager.message разбивается на секции по дням (manager.message_pYYYYMMDD)
+-- по атрибуту date_created; записи вне созданных секций попадают в секцию manager.message_default.
+--
+-- Особенности:
+--  - первичный ключ секционированной сущности включает ключ секционирования: (s_id, date_created)
+--  - внешний ключ parent_msg_id удаляется (ссылка только на s_id невозможна)
+--  - date_created обязателен (по умолчанию now())
+--
+-- Обслуживание секций выполняет функция manager.message_partition_manage, которую менеджер задач
+-- вызывает в периодической задаче (TaskSVC.manage_message_partition):
+--  - создание секций на ahead_days дней вперед (записи интервала секции, попавшие в секцию
+--    manager.message_default, переносятся в созданную секцию)
+--  - отсоединение секций старше retention_days дней, в которых все сообщения обработаны
+--    (статус "Обработано"), и безусловно - секций старше max_days дней (0 - не отсоединять безусловно)
+--  - возврат списка отсоединенных секций, которые менеджер задач выгружает в сжатый файл и удаляет
+--
+-- Если используется режим уведомлений на уровне оператора, то после выполнения данного файла
+-- необходимо повторно выполнить db/notify_statement.sql.
+
+CREATE OR REPLACE FUNCTION manager.message_partition_create(p_from date, p_to date)
+  RETURNS integer AS
+$BODY$
+DECLARE
+  part_date date := p_from;
+  part_name text;
+  part_count integer := 0;
+  is_default boolean;
+BEGIN
+  -- Создание секций для каждого дня из интервала [p_from, p_to]
+  WHILE part_date <= p_to LOOP
+    part_name := 'message_p' || to_char(part_date, 'YYYYMMDD');
+    IF to_regclass('manager.' || part_name) IS NULL THEN
+      is_default := to_regclass('manager.message_default') IS NOT NULL AND EXISTS (
+        SELECT 1 FROM manager.message_default WHERE date_created >= part_date AND date_created < part_date + 1);
+      IF NOT is_default THEN
+        EXECUTE format('CREATE TABLE manager.%I PARTITION OF manager.message FOR VALUES FROM (%L) TO (%L)',
+                       part_name, part_date, part_date + 1);
+      ELSE
+        -- В секции по умолчанию есть записи интервала (CREATE TABLE ... PARTITION OF завершился бы ошибкой):
+        -- записи переносятся в отдельную сущность, которая затем присоединяется как секция
+        -- (секция по умолчанию блокируется от вставки до конца транзакции)
+        LOCK TABLE manager.message_default IN SHARE ROW EXCLUSIVE MODE;
+        EXECUTE format('CREATE TABLE manager.%I (LIKE manager.message INCLUDING DEFAULTS)', part_name);
+        EXECUTE format('WITH moved AS (DELETE FROM manager.message_default '
+                       'WHERE date_created >= %L AND date_created < %L RETURNING *) '
+                       'INSERT INTO manager.%I SELECT * FROM moved',
+                       part_date, part_date + 1, part_name);
+        EXECUTE format('ALTER TABLE manager.message ATTACH PARTITION manager.%I FOR VALUES FROM (%L) TO (%L)',
+                       part_name, part_date, part_date + 1);
+      END IF;
+      part_count := part_count + 1;
+    END IF;
+    part_date := part_date + 1;
+  END LOOP;
+  RETURN part_count;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+ALTER FUNCTION manager.message_partition_create(date, date)
+  OWNER TO postgres;
+
+
+CREATE OR REPLACE FUNCTION manager.message_partition_manage(p_ahead_days integer, p_retention_days integer,
+                                                            p_max_days integer)
+  RETURNS SETOF text AS
+$BODY$
+DECLARE
+  part record;
+  is_busy boolean;
+BEGIN
+  PERFORM manager.message_partition_create(current_date, current_date + p_ahead_days);
+
+  -- Отсоединение устаревших секций (от старых к новым)
+  FOR part IN
+    SELECT c.relname, to_date(substring(c.relname FROM 10), 'YYYYMMDD') AS part_date
+      FROM pg_inherits AS i
+      JOIN pg_class AS c ON c.oid = i.inhrelid
+     WHERE i.inhparent = 'manager.message'::regclass AND c.relname ~ '^message_p[0-9]{8}$'
+     ORDER BY 2
+  LOOP
+    EXIT WHEN part.part_date >= current_date - p_retention_days;
+    IF p_max_days <= 0 OR part.part_date >= current_date - p_max_days THEN
+      EXECUTE format('SELECT EXISTS (SELECT 1 FROM manager.%I WHERE status IS DISTINCT FROM %L)',
+                     part.relname, 'Обработано') INTO is_busy;
+      CONTINUE WHEN is_busy;
+    END IF;
+    EXECUTE format('ALTER TABLE manager.message DETACH PARTITION manager.%I', part.relname);
+  END LOOP;
+
+  -- Отсоединенные секции (в том числе оставшиеся с прошлого запуска), ожидающие выгрузки и удаления
+  RETURN QUERY
+    SELECT c.relname::text
+      FROM pg_class AS c
+     WHERE c.relnamespace = 'manager'::regnamespace AND c.relkind = 'r' AND c.relname ~ '^message_p[0-9]{8}$'
+       AND NOT EXISTS (SELECT 1 FROM pg_inherits AS i WHERE i.inhrelid = c.oid)
+     ORDER BY 1;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+ALTER FUNCTION manager.message_partition_manage(integer, integer, integer)
+  OWNER TO postgres;
+
+
+-- Перевод существующей сущности на секционирование
+BEGIN;
+
+LOCK TABLE manager.message IN ACCESS EXCLUSIVE MODE;
+
+UPDATE manager.message SET date_created = now() WHERE date_created IS NULL;
+
+CREATE TABLE manager.message_new (LIKE manager.message INCLUDING DEFAULTS) PARTITION BY RANGE (date_created);
+ALTER TABLE manager.message_new ALTER COLUMN date_created SET DEFAULT now();
+ALTER TABLE manager.message_new ALTER COLUMN date_created SET NOT NULL;
+
+ALTER TABLE manager.message RENAME TO message_old;
+ALTER TABLE manager.message_new RENAME TO message;
+ALTER TABLE manager.message OWNER TO postgres;
+
+CREATE TABLE manager.message_default PARTITION OF manager.message DEFAULT;
+SELECT manager.message_partition_create(
+  COALESCE((SELECT min(date_created)::date FROM manager.message_old), current_date), current_date + 7);
+
+INSERT INTO manager.message SELECT * FROM manager.message_old;
+DROP TABLE manager.message_old;
+
+COMMENT ON TABLE manager.message IS 'Сообщения';
+
+ALTER TABLE ONLY manager.message ADD CONSTRAINT message_pkey PRIMARY KEY (s_id, date_created);
+
+CREATE INDEX message_pending_idx ON manager.message (msg_type, send_id) WHERE status IS NULL;
+CREATE INDEX message_sent_get_idx ON manager.message (get_id, msg_type) WHERE status = 'Отправлено';
+CREATE INDEX message_task_log_idx ON manager.message (task_log_id, msg_type, date_created DESC);
+CREATE INDEX message_command_log_idx ON manager.message (command_log_id, msg_type, date_created DESC) WHERE command_log_id IS NOT NULL;
+CREATE INDEX message_parent_msg_idx ON manager.message (parent_msg_id) WHERE parent_msg_id IS NOT NULL;
+CREATE INDEX message_instance_idx ON manager.message (instance_id) WHERE instance_id IS NOT NULL;
+CREATE INDEX message_connect_idx ON manager.message (get_id, send_id, date_created) WHERE msg_type = 'Подключение';
+
+ALTER TABLE ONLY manager.message ADD CONSTRAINT message_command_log_id_fkey FOREIGN KEY (command_log_id) REFERENCES manager.command_log(s_id);
+ALTER TABLE ONLY manager.message ADD CONSTRAINT message_get_id_id_fkey FOREIGN KEY (get_id) REFERENCES manager.module(s_id);
+ALTER TABLE ONLY manager.message ADD CONSTRAINT message_send_id_fkey FOREIGN KEY (send_id) REFERENCES manager.module(s_id);
+ALTER TABLE ONLY manager.message ADD CONSTRAINT message_task_log_id_fkey FOREIGN KEY (task_log_id) REFERENCES manager.task_log(s_id);
+
+-- Триггер создается на секционированной сущности и срабатывает на секциях,
+-- поэтому наименование сущности передается аргументом
+CREATE TRIGGER message_notify AFTER INSERT OR UPDATE ON manager.message FOR EACH ROW EXECUTE PROCEDURE public.notify_me('manager.message');
+
+COMMIT;
@@ -0,0 +1,72 @@
+-- Режим уведомлений на уровне оператора (FOR EACH STATEMENT)
+--
+-- Заменяет построчные триггеры *_notify из manager_structure.sql на триггеры уровня оператора
+-- с таблицами переходов (REFERENCING NEW TABLE). Один INSERT/UPDATE/COPY порождает одно
+-- сообщение в канал DB_NOTIFY со списком идентификаторов измененных записей:
+--   {"t": "<схема>.<сущность>", "ids": ["<s_id>", ...]}
+-- Список идентификаторов разбивается на части так, чтобы сообщение не превышало
+-- ограничение pg_notify в 8000 байт.
+--
+-- Возврат к построчным уведомлениям: выполнить блок "Построчный режим" в конце файла.
+
+CREATE OR REPLACE FUNCTION public.notify_me_statement()
+  RETURNS trigger AS
+$BODY$
+DECLARE
+  -- 36 символов идентификатора + кавычки и разделитель: 160 * 39 байт с запасом меньше 8000 байт
+  chunk_size integer := 160;
+  id_list text[];
+BEGIN
+  FOR id_list IN
+    SELECT array_agg(s_id::text)
+      FROM (SELECT s_id, (row_number() OVER () - 1) / chunk_size AS chunk FROM new_table) AS t
+     GROUP BY chunk
+  LOOP
+    PERFORM pg_notify('DB_NOTIFY', jsonb_build_object(
+      't', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME,
+      'ids', to_jsonb(id_list)
+    )::text);
+  END LOOP;
+  RETURN NULL;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 1;
+ALTER FUNCTION public.notify_me_statement()
+  OWNER TO postgres;
+
+
+-- Режим уровня оператора
+-- (таблицы переходов не допускаются для триггеров с несколькими событиями,
+--  поэтому для INSERT и UPDATE создаются отдельные триггеры)
+
+DROP TRIGGER IF EXISTS command_log_notify ON manager.command_log;
+DROP TRIGGER IF EXISTS main_task_log_notify ON manager.main_task_log;
+DROP TRIGGER IF EXISTS message_notify ON manager.message;
+DROP TRIGGER IF EXISTS task_log_notify ON manager.task_log;
+
+CREATE TRIGGER command_log_notify_insert AFTER INSERT ON manager.command_log REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER command_log_notify_update AFTER UPDATE ON manager.command_log REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER main_task_log_notify_insert AFTER INSERT ON manager.main_task_log REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER main_task_log_notify_update AFTER UPDATE ON manager.main_task_log REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER message_notify_insert AFTER INSERT ON manager.message REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER message_notify_update AFTER UPDATE ON manager.message REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER task_log_notify_insert AFTER INSERT ON manager.task_log REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+CREATE TRIGGER task_log_notify_update AFTER UPDATE ON manager.task_log REFERENCING NEW TABLE AS new_table FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_me_statement();
+
+
+-- Построчный режим
+--
+-- DROP TRIGGER IF EXISTS command_log_notify_insert ON manager.command_log;
+-- DROP TRIGGER IF EXISTS command_log_notify_update ON manager.command_log;
+-- DROP TRIGGER IF EXISTS main_task_log_notify_insert ON manager.main_task_log;
+-- DROP TRIGGER IF EXISTS main_task_log_notify_update ON manager.main_task_log;
+-- DROP TRIGGER IF EXISTS message_notify_insert ON manager.message;
+-- DROP TRIGGER IF EXISTS message_notify_update ON manager.message;
+-- DROP TRIGGER IF EXISTS task_log_notify_insert ON manager.task_log;
+-- DROP TRIGGER IF EXISTS task_log_notify_update ON manager.task_log;
+--
+-- CREATE TRIGGER command_log_notify AFTER INSERT OR UPDATE ON manager.command_log FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+-- CREATE TRIGGER main_task_log_notify AFTER INSERT OR UPDATE ON manager.main_task_log FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+-- CREATE TRIGGER message_notify AFTER INSERT OR UPDATE ON manager.message FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
+-- CREATE TRIGGER task_log_notify AFTER INSERT OR UPDATE ON manager.task_log FOR EACH ROW EXECUTE PROCEDURE public.notify_me();
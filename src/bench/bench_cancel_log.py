@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Замер отмены поставленных команд (TaskSVC.cancel_command_log) на деревьях команд
+(CommandLogModel.parent_id) глубины depth с ветвлением width
+
+Листья деревьев в статусе "Поставлена", остальные команды в статусе "Выполняется";
+отменяются все поставленные команды отмененных задач.
+
+Сравниваются:
+ - legacy - рекурсивный обход дерева прежней реализации TaskSVC.cancel_command_log
+   (для каждой записи: отмена дочерних команд и спуск в дочерние команды в статусе "Выполняется")
+ - recursive_cte - текущая реализация (один запрос WITH RECURSIVE для всего списка задач)
+
+Запуск: python3 bench_cancel_log.py [количество задач, по умолчанию 100] [глубина, по умолчанию 6]
+                                    [ветвление, по умолчанию 4]
+Все изменения в базе данных откатываются.
+"""
+import sys
+from collections import namedtuple
+
+from common import connect, BenchTaskSVC, CountingCursor, Measure, print_result
+from common import get_status_id, seed_module, seed_base_task, seed_command, seed_task_log, seed_command_tree
+
+Row = namedtuple("Row", "s_id")
+
+
+def legacy_cancel_command_log(cursor, log_id_list: list, is_command: bool) -> int:
+    """
+    Рекурсивный алгоритм прежней реализации TaskSVC.cancel_command_log
+    :return: количество отмененных команд
+    """
+    status_set = get_status_id(cursor, "set")
+    status_progress = get_status_id(cursor, "progress")
+    status_cancel = get_status_id(cursor, "cancel")
+    child_id = "parent_id" if is_command else "task_log_id"
+    count = 0
+    for log_id in log_id_list:
+        cursor.execute("UPDATE manager.command_log SET status_id = %s WHERE {} = %s AND status_id = %s".format(
+            child_id), (status_cancel, log_id, status_set))
+        count += cursor.rowcount
+        cursor.execute("""
+            SELECT DISTINCT cl.s_id FROM manager.command_log AS cl
+              JOIN manager.command_log AS c ON c.parent_id = cl.s_id
+             WHERE cl.{} = %s AND cl.status_id = %s AND c.status_id = %s
+        """.format(child_id), (log_id, status_progress, status_set))
+        child_list = [row[0] for row in cursor.fetchall()]
+        if child_list:
+            count += legacy_cancel_command_log(cursor, child_list, True)
+    return count
+
+
+def run(count: int, depth: int, width: int) -> dict:
+    """
+    Замер для count задач с деревьями команд
+    :param count: количество задач
+    :param depth: глубина дерева команд
+    :param width: ветвление дерева команд
+    :return: словарь {наименование варианта: {wall_time, query_count, log_count}}
+    """
+    connection = connect()
+    cursor = CountingCursor(connection.cursor())
+    result = dict()
+    try:
+        method_id_list = seed_module(cursor, 10)
+        base_task_id, action_id_list = seed_base_task(cursor, method_id_list, 10)
+        seed_command(cursor, action_id_list, 1)
+        task_log_id_list = seed_task_log(cursor, base_task_id, action_id_list, count // len(action_id_list),
+                                         "cancel")
+        seed_command_tree(cursor, task_log_id_list, depth, width, "set")
+        cursor.execute("SELECT s_id FROM manager.module WHERE system_name = 'task_manager'")
+        module = Row(cursor.fetchone()[0])
+        cursor.execute("ANALYZE")
+
+        cursor.execute("SAVEPOINT bench")
+        with Measure(cursor) as measure:
+            log_count = legacy_cancel_command_log(cursor, task_log_id_list, False)
+        result["legacy"] = dict(measure.as_dict(), log_count=log_count)
+        cursor.execute("ROLLBACK TO SAVEPOINT bench")
+
+        svc = BenchTaskSVC(cursor, module)
+        svc.reference.status_id("cancel")
+        with Measure(cursor) as measure:
+            log_count = svc.cancel_command_log([Row(s_id) for s_id in task_log_id_list])
+        result["recursive_cte"] = dict(measure.as_dict(), log_count=log_count)
+    finally:
+        connection.rollback()
+        connection.close()
+    return result
+
+
+if __name__ == '__main__':
+    task_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tree_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    tree_width = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    print_result("cancel_command_log: {} задач, дерево команд {}x{}".format(task_count, tree_depth, tree_width),
+                 run(task_count, tree_depth, tree_width))
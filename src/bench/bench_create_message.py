@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Замер создания сообщений с типом "Задача" для задач в статусе "Выполняется"
+
+Сравниваются:
+ - legacy - построчный алгоритм прежней реализации TaskSVC.create_message
+   (запросы, которые выполнял ORM для каждой записи)
+ - set_based - текущая реализация TaskSVC.create_message (один запрос)
+
+Запуск: python3 bench_create_message.py [количество задач, по умолчанию 10000]
+Все изменения в базе данных откатываются.
+"""
+import sys
+import uuid
+from collections import namedtuple
+
+from common import connect, BenchTaskSVC, CountingCursor, Measure, print_result
+from common import get_status_id, seed_module, seed_base_task, seed_task_log
+from utils.status_type import MsgTypeChoice
+
+Row = namedtuple("Row", "s_id")
+
+
+def legacy_create_message(cursor, log_id_list: list, send_id) -> int:
+    """
+    Построчный алгоритм прежней реализации TaskSVC.create_message
+    :return: количество созданных сообщений
+    """
+    status_id = get_status_id(cursor, "progress")
+    count = 0
+    for log_id in log_id_list:
+        cursor.execute("SELECT s_id, action_id, status_id FROM manager.task_log WHERE s_id = %s", (log_id,))
+        _, action_id, log_status_id = cursor.fetchone()
+        date_list = dict()
+        for msg_type in (MsgTypeChoice.success.value, MsgTypeChoice.error.value):
+            cursor.execute("""
+                SELECT date_created FROM manager.message
+                 WHERE task_log_id = %s AND command_log_id IS NULL AND msg_type = %s
+                 ORDER BY date_created DESC LIMIT 1
+            """, (log_id, msg_type))
+            row = cursor.fetchone()
+            date_list[msg_type] = row[0] if row else None
+        cursor.execute("SELECT 1 FROM manager.command_log WHERE task_log_id = %s LIMIT 1", (log_id,))
+        if cursor.fetchone():
+            continue
+        s_date, e_date = date_list[MsgTypeChoice.success.value], date_list[MsgTypeChoice.error.value]
+        if not s_date or (e_date and s_date < e_date):
+            cursor.execute("SELECT method_id FROM manager.action WHERE s_id = %s", (action_id,))
+            method_id = cursor.fetchone()[0]
+            cursor.execute("SELECT module_id, system_name FROM manager.method_module WHERE s_id = %s", (method_id,))
+            module_id, method = cursor.fetchone()
+            cursor.execute("SELECT status FROM manager.module WHERE s_id = %s", (module_id,))
+            if cursor.fetchone()[0]:
+                s_id = str(uuid.uuid4())
+                cursor.execute("""
+                    INSERT INTO manager.message (s_id, send_id, get_id, date_created, msg_type, task_log_id, data)
+                    VALUES (%s, %s, %s, now(), %s, %s, json_build_object('task_id', %s, 'msg_type', %s, 'method', %s))
+                """, (s_id, send_id, module_id, MsgTypeChoice.task.value, log_id, s_id, MsgTypeChoice.task.value,
+                      method))
+                count += 1
+        if log_status_id != status_id:
+            cursor.execute("UPDATE manager.task_log SET status_id = %s WHERE s_id = %s", (status_id, log_id))
+    return count
+
+
+def run(count: int) -> dict:
+    """
+    Замер для count задач
+    :param count: количество задач
+    :return: словарь {наименование варианта: {wall_time, query_count, message_count}}
+    """
+    connection = connect()
+    cursor = CountingCursor(connection.cursor())
+    result = dict()
+    try:
+        method_id_list = seed_module(cursor, 10)
+        base_task_id, action_id_list = seed_base_task(cursor, method_id_list, 10)
+        log_id_list = seed_task_log(cursor, base_task_id, action_id_list, count // len(action_id_list), "progress")
+        cursor.execute("SELECT s_id FROM manager.module WHERE system_name = 'task_manager'")
+        module = Row(cursor.fetchone()[0])
+        cursor.execute("ANALYZE")
+
+        cursor.execute("SAVEPOINT bench")
+        with Measure(cursor) as measure:
+            message_count = legacy_create_message(cursor, log_id_list, module.s_id)
+        result["legacy"] = dict(measure.as_dict(), message_count=message_count)
+        cursor.execute("ROLLBACK TO SAVEPOINT bench")
+
+        svc = BenchTaskSVC(cursor, module)
+        with Measure(cursor) as measure:
+            message_count = svc.create_message([Row(log_id) for log_id in log_id_list])
+        result["set_based"] = dict(measure.as_dict(), message_count=message_count)
+    finally:
+        connection.rollback()
+        connection.close()
+    return result
+
+
+if __name__ == '__main__':
+    task_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print_result("create_message: {} задач".format(task_count), run(task_count))
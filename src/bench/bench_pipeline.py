@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+Сквозной замер конвейера менеджера задач
+
+Создает временную базу данных (структура из db/manager_structure.sql), наполняет ее службами,
+базовой задачей с операциями и командами, запускает менеджер задач (TaskSVC) и заглушки функциональных
+служб (BaseFunctionalSVC, отвечают на задачи сразу) в отдельных процессах и ставит базовые задачи
+на выполнение. Перед замером выполняется одна базовая задача для прогрева.
+
+Результат (выводится и сохраняется в json для сравнения запусков):
+ - throughput - базовых задач в секунду (от постановки первой до окончания последней)
+ - latency_* - задержка отправки задачи службе в миллисекундах: от постановки базовой задачи
+   (для первой задачи) или ответа службы на предыдущую задачу той же базовой задачи до получения задачи
+   службой (время базы данных и служб сравнивается, поэтому СУБД должна быть локальной)
+ - queries_per_task - запросов на базовую задачу (pg_stat_statements; None, если расширение недоступно)
+ - transactions_per_task - транзакций на базовую задачу (pg_stat_database)
+ - db_cpu_time, db_cpu_per_task - процессорное время серверных процессов базы данных в секундах
+   (/proc; None, если СУБД не локальная)
+Запросы, обращения и время, потраченные самим замером, в результат не входят; сигналы работоспособности
+служб входят.
+
+Для менеджера задач подключение Django (settings.DATABASES["default"]) перенаправляется во временную
+базу данных. Временная база данных удаляется после замера (кроме запуска с --keep).
+
+Запуск: python3 bench_pipeline.py [--main 1000] [--module 4] [--action 5] [--command 0] [--rate 0]
+                                  [--manager-thread 4] [--module-thread 4] [--statement-notify]
+                                  [--timeout 300] [--keep] [--output файл.json] [--compare файл.json]
+"""
+import os
+import json
+import time
+import uuid
+import signal
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from collections import defaultdict
+
+from common import connect, CountingCursor, seed_module, seed_base_task, seed_command
+from bench.settings import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_MAINTENANCE_NAME
+import task_svc
+from task_svc import TaskSVC
+from utils.other_class import BaseFunctionalSVC
+from utils.wrapper import task_wrapper
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+STRUCTURE_FILE = os.path.join(ROOT_DIR, "db", "manager_structure.sql")
+NOTIFY_STATEMENT_FILE = os.path.join(ROOT_DIR, "db", "notify_statement.sql")
+# Метод заглушек функциональных служб
+METHOD = "execute"
+# Отметка запросов самого замера (исключаются из статистики pg_stat_statements)
+MARK = "/* bench */ "
+# Метрики для сравнения запусков: наименование, признак "больше - лучше"
+METRIC_LIST = (("throughput", True), ("latency_p50", False), ("latency_p90", False), ("latency_p99", False),
+               ("latency_max", False), ("queries_per_task", False), ("transactions_per_task", False),
+               ("db_cpu_per_task", False))
+
+
+class BenchManagerSVC(TaskSVC):
+    """
+    Менеджер задач замера: дополнительно подписан на канал уведомлений триггеров (DB_NOTIFY)
+    """
+    _extra_channel_list = ["DB_NOTIFY"]
+
+
+class StubSVC(BaseFunctionalSVC):
+    """
+    Заглушка функциональной службы: отвечает на задачу сразу и запоминает время получения задачи
+    и время ответа (для расчета задержки отправки)
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.timing = dict()
+
+    def add_task(self, channel: str, data: str) -> None:
+        now = time.time()
+        message = json.loads(data)
+        for s_id in message.get("task_id_list") or [message.get("task_id")]:
+            if s_id:
+                self.timing[s_id] = [now, None]
+        super().add_task(channel, data)
+
+    @task_wrapper
+    def _execute(self, *args, **kwargs) -> (None, bool, dict):
+        return None, False, {"message": "Выполнено"}
+
+    def execute(self, *args, **kwargs) -> None:
+        self._execute(*args, **kwargs)
+        item = self.timing.get(kwargs.get("task_id"))
+        if item:
+            item[1] = time.time()
+
+
+def run_stub(db_name: str, system_name: str, thread_count: int, path: str) -> None:
+    """
+    Процесс заглушки функциональной службы (до SIGTERM), при остановке время получения задач и ответов
+    сохраняется в файл
+    """
+    svc = StubSVC(system_name, thread_count, DB_HOST, DB_PORT, db_name, DB_USER, system_name,
+                  task_svc.MODULE_SYSTEM_NAME)
+    try:
+        svc.run()
+    finally:
+        with open(path, "w") as file:
+            json.dump(svc.timing, file)
+
+
+def run_manager(db_name: str, thread_count: int) -> None:
+    """
+    Процесс менеджера задач (до SIGTERM)
+    """
+    from django.db import connections
+    connections["default"].settings_dict["NAME"] = db_name
+    connections["default"].close()
+    task_svc.DB_NAME = db_name
+    BenchManagerSVC(thread_count).run()
+
+
+def create_database(statement_notify: bool) -> str:
+    """
+    Создание временной базы данных со структурой менеджера задач
+    :param statement_notify: признак уведомлений на уровне оператора (db/notify_statement.sql)
+    :return: наименование базы данных
+    """
+    db_name = "{}_{}".format(DB_NAME, uuid.uuid4().hex[:8])
+    connection = connect(DB_MAINTENANCE_NAME)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE DATABASE "{}"'.format(db_name))
+    connection.close()
+
+    connection = connect(db_name)
+    with connection.cursor() as cursor:
+        for path in [STRUCTURE_FILE] + ([NOTIFY_STATEMENT_FILE] if statement_notify else []):
+            with open(path, encoding="utf-8") as file:
+                cursor.execute(file.read())
+        # менеджер задач ищет свою запись по системному наименованию из файла настроек
+        cursor.execute("UPDATE manager.module SET system_name = %s WHERE system_name = 'task_manager'",
+                       (task_svc.MODULE_SYSTEM_NAME,))
+    connection.commit()
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+        except Exception:
+            pass
+    connection.close()
+    return db_name
+
+
+def drop_database(db_name: str) -> None:
+    """
+    Удаление временной базы данных (подключения к ней принудительно закрываются)
+    :param db_name: наименование базы данных
+    :return:
+    """
+    connection = connect(DB_MAINTENANCE_NAME)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s", (db_name,))
+        cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(db_name))
+    connection.close()
+
+
+def add_main_task(cursor, base_task_id, count: int) -> list:
+    """
+    Постановка count базовых задач в статусе "Выполняется"
+    :return: список идентификаторов базовых задач
+    """
+    cursor.execute(MARK + """
+        INSERT INTO manager.main_task_log (base_task_id, status_id, add_task_date)
+        SELECT %s, s.s_id, now()
+          FROM manager.task_completion_status AS s, generate_series(1, %s)
+         WHERE s.system_name = 'progress'
+        RETURNING s_id
+    """, (base_task_id, count))
+    return [str(row[0]) for row in cursor.fetchall()]
+
+
+def submit(cursor, base_task_id, count: int, rate: int) -> list:
+    """
+    Постановка базовых задач: все сразу (rate = 0) или равномерно по rate задач в секунду
+    (пачками каждые 100 миллисекунд)
+    :return: список идентификаторов базовых задач
+    """
+    if not rate:
+        return add_main_task(cursor, base_task_id, count)
+    main_id_list = list()
+    start = time.monotonic()
+    while len(main_id_list) < count:
+        due = min(count, int((time.monotonic() - start) * rate) + 1)
+        if due > len(main_id_list):
+            main_id_list += add_main_task(cursor, base_task_id, due - len(main_id_list))
+        time.sleep(0.1)
+    return main_id_list
+
+
+def wait_for(cursor, query: str, params: tuple, expected: int, timeout: float) -> int:
+    """
+    Ожидание, пока запрос количества не вернет expected (или истечения timeout секунд)
+    :return: последнее значение количества
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        cursor.execute(MARK + query, params)
+        value = cursor.fetchone()[0]
+        if value >= expected or time.monotonic() > deadline:
+            return value
+        time.sleep(0.1)
+
+
+DONE_QUERY = """
+    SELECT count(*) FROM manager.main_task_log AS m
+      JOIN manager.task_completion_status AS s ON s.s_id = m.status_id
+     WHERE m.s_id = ANY(%s::uuid[]) AND s.system_name IN ('finish', 'error')
+"""
+
+
+def backend_cpu(cursor) -> dict:
+    """
+    Процессорное время (в тактах) серверных процессов временной базы данных, кроме процесса замера
+    :return: словарь {pid: такты} или None, если /proc серверных процессов недоступен
+    """
+    cursor.execute(MARK + "SELECT pid FROM pg_stat_activity WHERE datname = current_database() "
+                          "AND pid <> pg_backend_pid()")
+    result = dict()
+    for (pid,) in cursor.fetchall():
+        try:
+            with open("/proc/{}/stat".format(pid)) as file:
+                field_list = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        result[pid] = int(field_list[11]) + int(field_list[12])
+    return result or None
+
+
+def db_stats(cursor) -> dict:
+    """
+    Счетчики временной базы данных: транзакции (pg_stat_database) и запросы (pg_stat_statements)
+    :return: словарь {xact_count, query_count}
+    """
+    cursor.execute(MARK + "SELECT pg_stat_clear_snapshot()")
+    cursor.execute(MARK + "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()")
+    result = {"xact_count": cursor.fetchone()[0], "query_count": None}
+    try:
+        cursor.execute(MARK + """
+            SELECT COALESCE(sum(calls), 0) FROM pg_stat_statements
+             WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+               AND query NOT LIKE '%/* bench */%'
+        """)
+        result["query_count"] = cursor.fetchone()[0]
+    except Exception:
+        pass
+    return result
+
+
+def dispatch_latency(cursor, main_id_list: list, timing: dict) -> list:
+    """
+    Задержки отправки задач базовых задач замера
+    :param main_id_list: список идентификаторов базовых задач
+    :param timing: словарь {идентификатор сообщения: [время получения, время ответа]}
+    :return: список задержек в секундах
+    """
+    if not timing:
+        return []
+    cursor.execute(MARK + """
+        SELECT m.s_id, t.main_task_log_id FROM manager.message AS m
+          JOIN manager.task_log AS t ON t.s_id = m.task_log_id
+         WHERE m.s_id = ANY(%s::uuid[])
+    """, (list(timing),))
+    main_dict = {str(s_id): str(main_id) for s_id, main_id in cursor.fetchall()}
+    cursor.execute(MARK + "SELECT s_id, extract(epoch FROM add_task_date) FROM manager.main_task_log "
+                          "WHERE s_id = ANY(%s::uuid[])", (main_id_list,))
+    start_dict = {str(s_id): float(start) for s_id, start in cursor.fetchall()}
+
+    event_dict = defaultdict(list)
+    for s_id, (received, replied) in timing.items():
+        main_id = main_dict.get(s_id)
+        if main_id in start_dict:
+            event_dict[main_id].append((received, replied or received))
+    latency_list = list()
+    for main_id, event_list in event_dict.items():
+        ready = start_dict[main_id]
+        for received, replied in sorted(event_list):
+            latency_list.append(max(0.0, received - ready))
+            ready = max(ready, replied)
+    return latency_list
+
+
+def percentile(value_list: list, q: float) -> float:
+    if not value_list:
+        return None
+    return value_list[min(len(value_list) - 1, int(q * len(value_list)))]
+
+
+def stop_process(process_list: list) -> None:
+    """
+    Остановка процессов служб (SIGTERM, через 10 секунд - SIGKILL)
+    """
+    for process in process_list:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+    for process in process_list:
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def run(args) -> dict:
+    """
+    Сквозной замер
+    :param args: параметры запуска (см. parse_args)
+    :return: словарь результата
+    """
+    db_name = create_database(args.statement_notify)
+    tmp_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    process_list = list()
+    connection = None
+    try:
+        connection = connect(db_name)
+        connection.autocommit = True
+        cursor = CountingCursor(connection.cursor())
+        method_id_list = seed_module(cursor, args.module, METHOD)
+        base_task_id, action_id_list = seed_base_task(cursor, method_id_list, args.action)
+        if args.command:
+            seed_command(cursor, action_id_list, args.command)
+        cursor.execute("ANALYZE")
+
+        path_list = list()
+        for number in range(1, args.module + 1):
+            path_list.append(os.path.join(tmp_dir, "bench_{}.json".format(number)))
+            process_list.append(multiprocessing.Process(target=run_stub, args=(
+                db_name, "bench_{}".format(number), args.module_thread, path_list[-1])))
+            process_list[-1].start()
+        wait_for(cursor, "SELECT count(*) FROM manager.module_instance", (), args.module, args.timeout)
+        process_list.append(multiprocessing.Process(target=run_manager, args=(db_name, args.manager_thread)))
+        process_list[-1].start()
+
+        warm_id_list = add_main_task(cursor, base_task_id, 1)
+        if not wait_for(cursor, DONE_QUERY, (warm_id_list,), 1, args.timeout):
+            raise RuntimeError("Прогрев не завершен за {} секунд".format(args.timeout))
+
+        cpu_before, stats_before, query_before = backend_cpu(cursor), db_stats(cursor), cursor.count
+        main_id_list = submit(cursor, base_task_id, args.main, args.rate)
+        done_count = wait_for(cursor, DONE_QUERY, (main_id_list,), len(main_id_list), args.timeout)
+        cpu_after = backend_cpu(cursor)
+
+        stop_process(process_list)
+        time.sleep(1)
+        stats_after, own_count = db_stats(cursor), cursor.count - query_before
+
+        timing = dict()
+        for path in path_list:
+            if os.path.exists(path):
+                with open(path) as file:
+                    timing.update(json.load(file))
+        latency_list = sorted(dispatch_latency(cursor, main_id_list, timing))
+
+        cursor.execute(MARK + """
+            SELECT extract(epoch FROM max(m.end_task_date) - min(m.add_task_date)),
+                   count(*) FILTER (WHERE s.system_name = 'error')
+              FROM manager.main_task_log AS m
+              JOIN manager.task_completion_status AS s ON s.s_id = m.status_id
+             WHERE m.s_id = ANY(%s::uuid[])
+        """, (main_id_list,))
+        wall_time, error_count = cursor.fetchone()
+        wall_time = float(wall_time) if wall_time else None
+    finally:
+        stop_process(process_list)
+        if connection is not None:
+            connection.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not args.keep:
+            drop_database(db_name)
+
+    db_cpu_time = None
+    if cpu_before is not None and cpu_after is not None:
+        db_cpu_time = sum(ticks - cpu_before.get(pid, 0) for pid, ticks in cpu_after.items()) / \
+            os.sysconf("SC_CLK_TCK")
+    query_count = None
+    if stats_before["query_count"] is not None and stats_after["query_count"] is not None:
+        query_count = int(stats_after["query_count"] - stats_before["query_count"])
+    # запросы замера выполняются в режиме autocommit: одна транзакция на запрос
+    xact_count = int(stats_after["xact_count"] - stats_before["xact_count"]) - own_count
+    return {
+        "database": db_name if args.keep else None,
+        "main_count": len(main_id_list),
+        "done_count": done_count,
+        "error_count": error_count,
+        "message_count": len(latency_list),
+        "wall_time": wall_time,
+        "throughput": done_count / wall_time if wall_time else None,
+        "latency_p50": percentile(latency_list, 0.5) * 1000 if latency_list else None,
+        "latency_p90": percentile(latency_list, 0.9) * 1000 if latency_list else None,
+        "latency_p99": percentile(latency_list, 0.99) * 1000 if latency_list else None,
+        "latency_max": latency_list[-1] * 1000 if latency_list else None,
+        "query_count": query_count,
+        "queries_per_task": query_count / done_count if query_count is not None and done_count else None,
+        "transaction_count": xact_count,
+        "transactions_per_task": xact_count / done_count if done_count else None,
+        "db_cpu_time": db_cpu_time,
+        "db_cpu_per_task": db_cpu_time / done_count if db_cpu_time is not None and done_count else None,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict, previous: dict = None) -> None:
+    """
+    Вывод результата (и сравнения с предыдущим запуском, если он указан)
+    """
+    result = report["result"]
+    print("pipeline: {main_count} базовых задач, выполнено {done_count}, с ошибкой {error_count}".format(**result))
+    for name, is_higher_better in METRIC_LIST:
+        value = result.get(name)
+        line = "  {:<22} {:>12}".format(name, "-" if value is None else "{:.3f}".format(value))
+        old = previous["result"].get(name) if previous else None
+        if value is not None and old:
+            change = (value - old) / old * 100
+            better = change > 0 if is_higher_better else change < 0
+            line += "   было {:>12.3f} ({:+.1f}%{})".format(old, change, ", лучше" if better else "")
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозной замер конвейера менеджера задач")
+    parser.add_argument("--main", type=int, default=1000, help="количество базовых задач")
+    parser.add_argument("--module", type=int, default=4, help="количество функциональных служб")
+    parser.add_argument("--action", type=int, default=5, help="количество операций базовой задачи")
+    parser.add_argument("--command", type=int, default=0, help="количество команд каждой операции")
+    parser.add_argument("--rate", type=int, default=0,
+                        help="скорость постановки базовых задач в секунду (0 - все сразу)")
+    parser.add_argument("--manager-thread", type=int, default=4, help="потоков менеджера задач")
+    parser.add_argument("--module-thread", type=int, default=4, help="потоков каждой функциональной службы")
+    parser.add_argument("--statement-notify", action="store_true",
+                        help="уведомления на уровне оператора (db/notify_statement.sql)")
+    parser.add_argument("--timeout", type=int, default=300, help="максимальное время ожидания в секундах")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу данных")
+    parser.add_argument("--output", help="файл результата (по умолчанию bench_pipeline_<дата и время>.json)")
+    parser.add_argument("--compare", help="файл результата предыдущего запуска для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    start_date = datetime.now()
+    report = {"date": start_date.isoformat(), "revision": git_revision(), "params": vars(arguments),
+              "result": run(arguments)}
+    output = arguments.output or "bench_pipeline_{}.json".format(start_date.strftime("%Y%m%d_%H%M%S"))
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            previous = json.load(file)
+    print_report(report, previous)
+    print("Результат сохранен в {}".format(output))
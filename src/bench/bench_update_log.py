@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Замер обновления статуса выполнения родительских записей по статусам дочерних (TaskSVC.update_log)
+на деревьях команд (CommandLogModel.parent_id) глубины depth с ветвлением width
+
+Листья деревьев выполнены, остальные команды и задачи в статусе "Выполняется";
+статус поднимается снизу вверх: по уровням дерева команд, затем для задач.
+
+Сравниваются:
+ - legacy - построчный алгоритм прежней реализации TaskSVC.update_log
+   (для каждой родительской записи запросы по дочерним записям и сохранение записи)
+ - set_based - текущая реализация (один запрос на уровень дерева)
+
+Запуск: python3 bench_update_log.py [количество задач, по умолчанию 1000] [глубина, по умолчанию 4]
+                                    [ветвление, по умолчанию 3]
+Все изменения в базе данных откатываются.
+"""
+import sys
+from collections import namedtuple
+
+from common import connect, BenchTaskSVC, CountingCursor, Measure, print_result
+from common import get_status_id, seed_module, seed_base_task, seed_command, seed_task_log, seed_command_tree
+
+Row = namedtuple("Row", "s_id")
+
+
+def legacy_update_log(cursor, log_id_list: list, is_command: bool) -> int:
+    """
+    Построчный алгоритм прежней реализации TaskSVC.update_log
+    :return: количество измененных записей
+    """
+    status_finish = get_status_id(cursor, "finish")
+    status_error = get_status_id(cursor, "error")
+    table, child_id = ("command_log", "parent_id") if is_command else ("task_log", "task_log_id")
+    count = 0
+    for log_id in log_id_list:
+        cursor.execute("SELECT 1 FROM manager.command_log WHERE {} = %s LIMIT 1".format(child_id), (log_id,))
+        if not cursor.fetchone():
+            continue
+        cursor.execute("SELECT 1 FROM manager.command_log WHERE {} = %s AND status_id = %s LIMIT 1".format(
+            child_id), (log_id, status_error))
+        is_error = cursor.fetchone() is not None
+        cursor.execute("SELECT 1 FROM manager.command_log WHERE {} = %s AND status_id <> %s LIMIT 1".format(
+            child_id), (log_id, status_finish))
+        is_not_finish = cursor.fetchone() is not None
+        if is_error or not is_not_finish:
+            cursor.execute("UPDATE manager.{} SET status_id = %s WHERE s_id = %s".format(table),
+                           (status_error if is_error else status_finish, log_id))
+            count += 1
+    return count
+
+
+def run(count: int, depth: int, width: int) -> dict:
+    """
+    Замер для count задач с деревьями команд
+    :param count: количество задач
+    :param depth: глубина дерева команд
+    :param width: ветвление дерева команд
+    :return: словарь {наименование варианта: {wall_time, query_count, log_count}}
+    """
+    connection = connect()
+    cursor = CountingCursor(connection.cursor())
+    result = dict()
+    try:
+        method_id_list = seed_module(cursor, 10)
+        base_task_id, action_id_list = seed_base_task(cursor, method_id_list, 10)
+        seed_command(cursor, action_id_list, 1)
+        task_log_id_list = seed_task_log(cursor, base_task_id, action_id_list, count // len(action_id_list),
+                                         "progress")
+        level_list = seed_command_tree(cursor, task_log_id_list, depth, width)
+        cursor.execute("SELECT s_id FROM manager.module WHERE system_name = 'task_manager'")
+        module = Row(cursor.fetchone()[0])
+        cursor.execute("ANALYZE")
+
+        cursor.execute("SAVEPOINT bench")
+        with Measure(cursor) as measure:
+            log_count = 0
+            for id_list in reversed(level_list[:-1]):
+                log_count += legacy_update_log(cursor, id_list, True)
+            log_count += legacy_update_log(cursor, task_log_id_list, False)
+        result["legacy"] = dict(measure.as_dict(), log_count=log_count)
+        cursor.execute("ROLLBACK TO SAVEPOINT bench")
+
+        svc = BenchTaskSVC(cursor, module)
+        svc.reference.status_id("finish")
+        with Measure(cursor) as measure:
+            log_count = 0
+            for id_list in reversed(level_list[:-1]):
+                log_count += len(svc.update_log([Row(s_id) for s_id in id_list], is_command=True))
+            log_count += len(svc.update_log([Row(s_id) for s_id in task_log_id_list]))
+        result["set_based"] = dict(measure.as_dict(), log_count=log_count)
+    finally:
+        connection.rollback()
+        connection.close()
+    return result
+
+
+if __name__ == '__main__':
+    task_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tree_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    tree_width = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    print_result("update_log: {} задач, дерево команд {}x{}".format(task_count, tree_depth, tree_width),
+                 run(task_count, tree_depth, tree_width))
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+
+import psycopg2
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Порядок важен: модули менеджера задач импортируют свои настройки как settings
+for path in (SRC_DIR, os.path.join(SRC_DIR, "manager")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from bench.settings import DB_HOST, DB_PORT, DB_NAME, DB_USER
+from task_svc import TaskSVC
+from utils.base_utils.reference_cache import ReferenceCache
+from utils.base_utils.task_plan_cache import TaskPlanCache
+
+
+def connect(db_name: str = None):
+    """
+    Подключение к базе данных для замеров производительности
+    (структура базы данных должна быть создана из db/manager_structure.sql)
+
+    :param db_name: наименование базы данных (по умолчанию - база данных замеров из файла настроек)
+    :return: подключение DB-API
+    """
+    return psycopg2.connect(host=DB_HOST, port=DB_PORT, dbname=db_name or DB_NAME, user=DB_USER)
+
+
+class BenchTaskSVC(TaskSVC):
+    """
+    Менеджер задач без подключения к каналам: используется только для вызова методов
+    (все методы выполняются на одном курсоре замера вместо пула подключений)
+    """
+    cursor = None
+
+    def __init__(self, cursor, module):
+        self.cursor = cursor
+        self._module = module
+        self.reference = ReferenceCache(lambda: cursor)
+        self.task_plan = TaskPlanCache(lambda: cursor)
+
+
+class CountingCursor(object):
+    """
+    Курсор с подсчетом количества и времени выполнения запросов
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.count = 0
+        self.time = 0.0
+
+    def execute(self, query, params=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class Measure(object):
+    """
+    Замер времени выполнения и количества запросов блока кода
+
+    Пример:
+        with Measure(cursor) as measure:
+            ...
+        print(measure.wall_time, measure.query_count)
+    """
+
+    def __init__(self, cursor: CountingCursor):
+        self._cursor = cursor
+        self._start = None
+        self._count = None
+        self.wall_time = None
+        self.query_count = None
+
+    def __enter__(self):
+        self._count = self._cursor.count
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wall_time = time.perf_counter() - self._start
+        self.query_count = self._cursor.count - self._count
+        return False
+
+    def as_dict(self) -> dict:
+        return {"wall_time": self.wall_time, "query_count": self.query_count}
+
+
+def get_status_id(cursor, system_name: str):
+    """
+    Получение идентификатора статуса выполнения задачи
+    :param cursor: курсор
+    :param system_name: системное наименование статуса
+    :return: идентификатор
+    """
+    cursor.execute("SELECT s_id FROM manager.task_completion_status WHERE system_name = %s", (system_name,))
+    return cursor.fetchone()[0]
+
+
+def seed_module(cursor, count: int, method: str = "run") -> list:
+    """
+    Создание работоспособных функциональных служб с одним методом для каждой службы
+    :param cursor: курсор
+    :param count: количество служб
+    :param method: системное наименование метода
+    :return: список идентификаторов методов
+    """
+    cursor.execute("""
+        WITH module AS (
+            INSERT INTO manager.module (name, system_name, channel_name, status)
+            SELECT 'bench_' || i, 'bench_' || i, 'bench_' || i, true FROM generate_series(1, %s) AS i
+            RETURNING s_id, system_name
+        )
+        INSERT INTO manager.method_module (module_id, name, system_name)
+        SELECT s_id, %s, %s FROM module
+        RETURNING s_id
+    """, (count, method, method))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def seed_base_task(cursor, method_id_list: list, action_count: int) -> tuple:
+    """
+    Создание базовой задачи из одной задачи с action_count операциями
+    (методы служб назначаются операциям по кругу)
+    :param cursor: курсор
+    :param method_id_list: список идентификаторов методов
+    :param action_count: количество операций
+    :return: кортеж (идентификатор базовой задачи, список идентификаторов операций по порядку)
+    """
+    cursor.execute("INSERT INTO manager.base_task (name) VALUES ('bench') RETURNING s_id")
+    base_task_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO manager.task (name) VALUES ('bench') RETURNING s_id")
+    task_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO manager.task_sequence (base_task_id, task_id, number) VALUES (%s, %s, 1)",
+                   (base_task_id, task_id))
+    action_id_list = list()
+    for number in range(1, action_count + 1):
+        cursor.execute(
+            "INSERT INTO manager.action (task_id, method_id, name, number) VALUES (%s, %s, %s, %s) RETURNING s_id",
+            (task_id, method_id_list[(number - 1) % len(method_id_list)], "bench_{}".format(number), number))
+        action_id_list.append(cursor.fetchone()[0])
+    return base_task_id, action_id_list
+
+
+def seed_command(cursor, action_id_list: list, count: int = 2) -> None:
+    """
+    Создание последовательных команд для каждой операции (с методом операции)
+    :param cursor: курсор
+    :param action_id_list: список идентификаторов операций
+    :param count: количество команд для каждой операции
+    :return:
+    """
+    cursor.execute("""
+        INSERT INTO manager.command (action_id, method_id, name, is_parallel, number)
+        SELECT a.s_id, a.method_id, 'bench_' || i, false, i
+          FROM manager.action AS a, generate_series(1, %s) AS i
+         WHERE a.s_id = ANY(%s::uuid[])
+    """, (count, [str(action_id) for action_id in action_id_list]))
+
+
+def seed_task_log(cursor, base_task_id, action_id_list: list, main_count: int, status: str) -> list:
+    """
+    Создание main_count поставленных базовых задач и задач для каждой операции
+    :param cursor: курсор
+    :param base_task_id: идентификатор базовой задачи
+    :param action_id_list: список идентификаторов операций
+    :param main_count: количество базовых задач
+    :param status: системное наименование статуса выполнения задач
+    :return: список идентификаторов задач
+    """
+    cursor.execute("""
+        WITH status AS (
+            SELECT s_id FROM manager.task_completion_status WHERE system_name = %(status)s
+        ), main AS (
+            INSERT INTO manager.main_task_log (base_task_id, status_id, add_task_date)
+            SELECT %(base_task_id)s, status.s_id, now() FROM generate_series(1, %(count)s), status
+            RETURNING s_id
+        )
+        INSERT INTO manager.task_log (main_task_log_id, action_id, status_id)
+        SELECT main.s_id, action_id, status.s_id
+          FROM main, status, unnest(%(action_id_list)s::uuid[]) AS action_id
+        RETURNING s_id
+    """, {"status": status, "base_task_id": base_task_id, "count": main_count,
+          "action_id_list": [str(action_id) for action_id in action_id_list]})
+    return [row[0] for row in cursor.fetchall()]
+
+
+def seed_command_tree(cursor, task_log_id_list: list, depth: int, width: int, leaf_status: str = "finish") -> list:
+    """
+    Создание дерева команд для каждой задачи: один корень, width дочерних команд у каждой команды
+    (листья в статусе leaf_status, остальные команды в статусе "Выполняется")
+    :param cursor: курсор
+    :param task_log_id_list: список идентификаторов задач
+    :param depth: глубина дерева
+    :param width: ветвление
+    :param leaf_status: системное наименование статуса выполнения листьев
+    :return: список уровней дерева (список идентификаторов команд уровня), от корней к листьям
+    """
+    status_progress = get_status_id(cursor, "progress")
+    status_leaf = get_status_id(cursor, leaf_status)
+    cursor.execute("""
+        INSERT INTO manager.command_log (task_log_id, command_id, status_id)
+        SELECT t.s_id, c.s_id, %(status)s
+          FROM manager.task_log AS t
+          JOIN manager.command AS c ON c.action_id = t.action_id AND c.number = 1
+         WHERE t.s_id = ANY(%(id_list)s::uuid[])
+        RETURNING s_id
+    """, {"status": status_progress if depth > 1 else status_leaf,
+          "id_list": [str(s_id) for s_id in task_log_id_list]})
+    level_list = [[row[0] for row in cursor.fetchall()]]
+    for level in range(1, depth):
+        cursor.execute("""
+            INSERT INTO manager.command_log (task_log_id, parent_id, command_id, status_id)
+            SELECT p.task_log_id, p.s_id, p.command_id, %(status)s
+              FROM manager.command_log AS p, generate_series(1, %(width)s)
+             WHERE p.s_id = ANY(%(id_list)s::uuid[])
+            RETURNING s_id
+        """, {"status": status_leaf if level == depth - 1 else status_progress, "width": width,
+              "id_list": [str(s_id) for s_id in level_list[-1]]})
+        level_list.append([row[0] for row in cursor.fetchall()])
+    return level_list
+
+
+def print_result(title: str, result: dict) -> None:
+    """
+    Вывод результата замера
+    :param title: заголовок
+    :param result: словарь {наименование варианта: {wall_time, query_count}}
+    :return:
+    """
+    print(title)
+    for name, item in result.items():
+        print("  {:<12} {:>10.3f} s {:>10} queries".format(name, item["wall_time"], item["query_count"]))
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка планов запросов менеджера задач
+
+Наполняет базу данных историей выполнения (большая часть задач завершена, сообщения обработаны,
+небольшая доля задач в работе), выполняет EXPLAIN для запросов поиска изменений (QuerySet, которые строят
+TaskSVC._find_* для обработчиков refresh_*, - SQL, который генерирует Django) и для всех запросов TaskSVC._*_query
+и завершается с кодом 1, если в плане любого запроса есть последовательное чтение (Seq Scan)
+сущностей аудита или сообщений, или если запрос TaskSVC._*_query не проверяется (нет в query_params
+и SKIP_QUERY_LIST).
+
+Все запросы выполняются через подключение Django (база данных замеров из файла настроек) в одной транзакции,
+которая откатывается.
+
+Запуск: python3 explain_check.py [количество базовых задач, по умолчанию 2000]
+"""
+import re
+import sys
+import json
+
+from django.db import connections, transaction
+
+from common import BenchTaskSVC, get_status_id, seed_module, seed_base_task, seed_command, seed_task_log
+from bench.settings import DB_NAME
+from task_svc import TaskSVC
+from utils.status_type import MsgTypeChoice, StatusSendChoice
+
+# Сущности, последовательное чтение которых считается деградацией плана
+CHECK_TABLE_LIST = ("message", "main_task_log", "task_log", "command_log", "object_to_task_log",
+                    "object_to_command_log")
+
+# Запросы TaskSVC, которые не проверяются (не читают сущности аудита и сообщений)
+SKIP_QUERY_LIST = ("_notify_query", "_is_partitioned_query", "_partition_query")
+
+# Шаблоны запросов с вариантами: атрибут запроса - атрибут частей запроса {вариант: части}
+QUERY_PART = {
+    "_create_message_query": "_create_message_part",
+    "_update_log_query": "_update_log_part",
+    "_update_next_command_log_query": "_update_next_command_log_part",
+    "_cancel_command_log_query": "_cancel_command_log_part",
+}
+
+
+def query_params(data: dict) -> dict:
+    """
+    Параметры запросов TaskSVC._*_query
+    :param data: идентификаторы записей истории и справочников (см. run)
+    :return: словарь {атрибут запроса: функция (вариант запроса) -> параметры}
+    """
+    return {
+        "_message_status_query": lambda part: (StatusSendChoice.ok.value, data["message_id_list"]),
+        "_payload_cleanup_query": lambda part: (30,),
+        "_create_message_query": lambda part: {
+            "log_id_list": data["command_log_id_list" if part else "task_log_id_list"],
+            "status_id": data["progress"], "send_id": data["manager"], "task": MsgTypeChoice.task.value,
+            "success": MsgTypeChoice.success.value, "error": MsgTypeChoice.error.value, "is_restart": False},
+        "_command_query": lambda part: {"message_id_list": data["message_id_list"]},
+        "_update_log_query": lambda part: {
+            "log_id_list": data[part + "_id_list"], "finish": data["finish"], "error": data["error"]},
+        "_update_next_command_log_query": lambda part: {
+            "log_id_list": data["command_log_id_list" if part else "task_log_id_list"], "set": data["set"],
+            "progress": data["progress"], "finish": data["finish"]},
+        "_main_task_log_query": lambda part: {"log_id_list": data["main_task_log_id_list"],
+                                              "progress": data["progress"]},
+        "_current_task_query": lambda part: {"main_task_log_id_list": data["main_task_log_id_list"][:1],
+                                             "task_log_id_list": data["task_log_id_list"][:1]},
+        "_heartbeat_state_query": lambda part: (data["manager"],),
+        "_heartbeat_age_query": lambda part: {"instance_id_list": [data["module"]]},
+        "_outstanding_query": lambda part: {"task": MsgTypeChoice.task.value, "success": MsgTypeChoice.success.value,
+                                            "error": MsgTypeChoice.error.value},
+        "_reassign_query": lambda part: {"instance_id_list": [data["module"]], "task": MsgTypeChoice.task.value,
+                                         "success": MsgTypeChoice.success.value, "error": MsgTypeChoice.error.value},
+        "_module_status_query": lambda part: {"module_id_list": [data["module"]], "status_list": [True]},
+        "_recovery_query": lambda part: {"module_id_list": [data["module"]], "progress": data["progress"]},
+        "_cancel_command_log_query": lambda part: {
+            "log_id_list": data[part + "_id_list"], "set": data["set"], "progress": data["progress"],
+            "cancel": data["cancel"]},
+    }
+
+
+def seed_history(cursor, base_task_id, action_id_list: list, main_count: int) -> None:
+    """
+    Создание истории выполнения: main_count завершенных базовых задач с задачами, командами,
+    обработанными сообщениями (задача, ответ) и 1% задач в работе с неотправленными сообщениями
+    :param cursor: курсор
+    :param base_task_id: идентификатор базовой задачи
+    :param action_id_list: список идентификаторов операций
+    :param main_count: количество базовых задач
+    :return:
+    """
+    seed_task_log(cursor, base_task_id, action_id_list, main_count, "finish")
+    seed_task_log(cursor, base_task_id, action_id_list, max(main_count // 100, 1), "progress")
+    cursor.execute("""
+        INSERT INTO manager.command_log (task_log_id, command_id, status_id)
+        SELECT t.s_id, c.s_id, t.status_id
+          FROM manager.task_log AS t
+          JOIN manager.command AS c ON c.action_id = t.action_id
+    """)
+    cursor.execute("""
+        WITH manager_module AS (
+            SELECT s_id FROM manager.module WHERE system_name = 'task_manager'
+        ), task AS (
+            INSERT INTO manager.message (send_id, get_id, date_created, status, msg_type, task_log_id)
+            SELECT mm.s_id, m.module_id, now() - interval '1 day',
+                   CASE WHEN t.status_id = %(progress)s THEN NULL ELSE %(ok)s END, %(task)s, t.s_id
+              FROM manager.task_log AS t
+              JOIN manager.action AS a ON a.s_id = t.action_id
+              JOIN manager.method_module AS m ON m.s_id = a.method_id, manager_module AS mm
+            RETURNING s_id, send_id, get_id, task_log_id, status
+        )
+        INSERT INTO manager.message (send_id, get_id, date_created, status, msg_type, parent_msg_id, task_log_id)
+        SELECT get_id, send_id, now(), %(ok)s, %(success)s, s_id, task_log_id FROM task WHERE status IS NOT NULL
+    """, {"progress": get_status_id(cursor, "progress"), "ok": StatusSendChoice.ok.value,
+          "task": MsgTypeChoice.task.value, "success": MsgTypeChoice.success.value})
+
+
+def find_seq_scan(plan: dict) -> list:
+    """
+    Поиск последовательного чтения проверяемых сущностей в плане запроса
+    :param plan: узел плана (EXPLAIN FORMAT JSON)
+    :return: список наименований сущностей
+    """
+    result = list()
+    # секции секционированной сущности проверяются как сама сущность (db/message_partition.sql)
+    relation = re.sub(r"_(p[0-9]{8}|default)$", "", plan.get("Relation Name", ""))
+    if plan.get("Node Type") == "Seq Scan" and relation in CHECK_TABLE_LIST:
+        result.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        result.extend(find_seq_scan(child))
+    return result
+
+
+def explain(cursor, query: str, params) -> list:
+    """
+    Получение списка сущностей с последовательным чтением в плане запроса
+    :param cursor: курсор
+    :param query: запрос
+    :param params: параметры запроса
+    :return: список наименований сущностей
+    """
+    cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return find_seq_scan(plan[0]["Plan"])
+
+
+def explain_queryset(queryset) -> list:
+    """
+    Получение списка сущностей с последовательным чтением в плане запроса QuerySet
+    :param queryset: QuerySet
+    :return: список наименований сущностей
+    """
+    return find_seq_scan(json.loads(queryset.explain(format="json"))[0]["Plan"])
+
+
+def id_list(cursor, table: str, where: str = "", params=None) -> list:
+    """
+    Получение до 100 идентификаторов записей сущности
+    """
+    cursor.execute("SELECT s_id FROM manager.{} {} LIMIT 100".format(table, where), params)
+    return [str(row[0]) for row in cursor.fetchall()]
+
+
+def run(count: int) -> dict:
+    """
+    Проверка планов запросов на истории из count базовых задач
+    :param count: количество базовых задач
+    :return: словарь {наименование запроса: список сущностей с последовательным чтением
+                      (None - запрос не проверяется)}
+    """
+    connection = connections["default"]
+    connection.settings_dict["NAME"] = DB_NAME
+    connection.close()
+    result = dict()
+    with transaction.atomic():
+        try:
+            cursor = connection.cursor()
+            method_id_list = seed_module(cursor, 10)
+            base_task_id, action_id_list = seed_base_task(cursor, method_id_list, 10)
+            seed_command(cursor, action_id_list)
+            seed_history(cursor, base_task_id, action_id_list, count)
+            cursor.execute("ANALYZE")
+
+            cursor.execute("SELECT s_id FROM manager.module WHERE system_name = 'task_manager'")
+            manager_id = cursor.fetchone()[0]
+            cursor.execute("SELECT module_id FROM manager.method_module WHERE s_id = %s", (method_id_list[0],))
+            module_id = cursor.fetchone()[0]
+            data = {system_name: get_status_id(cursor, system_name)
+                    for system_name in ("set", "progress", "finish", "error", "cancel")}
+            data.update({
+                "manager": str(manager_id), "module": str(module_id),
+                "main_task_log_id_list": id_list(cursor, "main_task_log"),
+                "task_log_id_list": id_list(cursor, "task_log", "WHERE status_id = %s", (data["progress"],)),
+                "command_log_id_list": id_list(cursor, "command_log"),
+                "message_id_list": id_list(cursor, "message", "WHERE msg_type = %s", (MsgTypeChoice.task.value,)),
+            })
+
+            # поиск изменений: QuerySet обработчиков refresh_* (по всей сущности)
+            svc = BenchTaskSVC(cursor, manager_id)
+            for table in ("main_task_log", "task_log", "command_log", "message"):
+                for func, queryset, kwargs in getattr(svc, "_find_" + table)():
+                    name = "refresh_{}.{}{}".format(table, func.__name__,
+                                                    ".command" if kwargs.get("is_command") else "")
+                    result[name] = explain_queryset(queryset)
+
+            # запросы TaskSVC (для шаблонов - каждый вариант)
+            params = query_params(data)
+            for attr in sorted(dir(TaskSVC)):
+                if not (attr.startswith("_") and attr.endswith("_query")) or attr in SKIP_QUERY_LIST:
+                    continue
+                if attr not in params:
+                    result[attr] = None
+                    continue
+                if attr in QUERY_PART:
+                    for part, format_dict in getattr(TaskSVC, QUERY_PART[attr]).items():
+                        result["{}.{}".format(attr, part)] = explain(
+                            cursor, getattr(TaskSVC, attr).format(**format_dict), params[attr](part))
+                else:
+                    result[attr] = explain(cursor, getattr(TaskSVC, attr), params[attr](None))
+        finally:
+            transaction.set_rollback(True)
+    return result
+
+
+if __name__ == '__main__':
+    main_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    check_result = run(main_count)
+    for query_name, table_list in check_result.items():
+        if table_list is None:
+            status = "not checked (add to query_params or SKIP_QUERY_LIST)"
+        else:
+            status = "Seq Scan: " + ", ".join(table_list) if table_list else "ok"
+        print("  {:<60} {}".format(query_name, status))
+    sys.exit(1 if any(table_list is None or table_list for table_list in check_result.values()) else 0)
@@ -0,0 +1,15 @@
+import os
+import configparser
+
+BASE_DIR = os.path.dirname(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+config = configparser.ConfigParser()
+config_path = "{}/conf/config.ini".format(BASE_DIR)
+config.read(config_path)
+
+# Отдельная база данных для замеров производительности (содержимое не сохраняется)
+DB_NAME = config['BENCH']['NAME']
+# База данных для создания и удаления временных баз данных сквозного замера (bench_pipeline.py)
+DB_MAINTENANCE_NAME = config['BENCH']['MAINTENANCE']
+DB_USER = config['DATABASE']['USER']
+DB_HOST = config['DATABASE']['HOST']
+DB_PORT = config['DATABASE']['PORT']
@@ -13,10 +13,60 @@ MAIN_TASK_LOG_CHANNEL = config['LISTEN_CHANNEL_NAME']['table_main_task_log']
 TASK_LOG_CHANNEL = config['LISTEN_CHANNEL_NAME']['table_task_log']
 MESSAGE_CHANNEL = config['LISTEN_CHANNEL_NAME']['table_message']
 COMMAND_LOG_CHANNEL = config['LISTEN_CHANNEL_NAME']['table_command_log']
+HEARTBEAT_CHANNEL = config['LISTEN_CHANNEL_NAME']['table_module_heartbeat']
+MODULE_INSTANCE_CHANNEL = config['LISTEN_CHANNEL_NAME']['table_module_instance']
 
 # Период (в минутах) повторения периодической задачи
 PERIOD_TIME = int(config['DEFAULT']['period_time'])
 
+# Период (в секундах) полного поиска изменений в сущностях
+# (страховка на случай потери notify с данными об измененных записях)
+FULL_REFRESH_TIME = int(config['DEFAULT']['full_refresh_time'])
+
+# Максимальная глубина очереди задач пула потоков (0 - без ограничения)
+# При заполнении очереди постановка задачи ожидает освобождения места (кроме задач с приоритетом heartbeat)
+QUEUE_SIZE = int(config['DEFAULT']['queue_size'])
+
+# Минимальное и максимальное окно ожидания (в миллисекундах) буфера сообщений
+NOTIFY_MIN_WAIT = int(config['NOTIFY']['min_wait'])
+NOTIFY_MAX_WAIT = int(config['NOTIFY']['max_wait'])
+
+# Время (в миллисекундах) без сигналов работоспособности, после которого служба считается неработоспособной,
+# и период (в миллисекундах) проверки сигналов
+HEARTBEAT_TIMEOUT = int(config['HEARTBEAT']['timeout'])
+HEARTBEAT_CHECK = int(config['HEARTBEAT']['check'])
+
+# Восстановление службы после возобновления работоспособности: размер пачки повторно отправляемых задач
+# и максимальная скорость отправки (задач в секунду для одной службы, 0 - без ограничения)
+RECOVERY_BATCH_SIZE = int(config['RECOVERY']['batch_size'])
+RECOVERY_RATE = int(config['RECOVERY']['rate'])
+
+# Режим выбора экземпляра функциональной службы при отправке задачи:
+# least_outstanding - наименьшая загрузка (неотвеченные задачи / емкость), hash - по ключу задачи
+DISPATCH_MODE = config['DISPATCH']['mode']
+
+# Режим нескольких экземпляров менеджера задач: признак включения, количество секций записей,
+# срок аренды экземпляра и период ее продления (в миллисекундах)
+CLUSTER_ENABLED = config['CLUSTER'].getboolean('enabled')
+CLUSTER_SHARD_COUNT = int(config['CLUSTER']['shard_count'])
+CLUSTER_LEASE = int(config['CLUSTER']['lease'])
+CLUSTER_RENEW = int(config['CLUSTER']['renew'])
+
+# Обслуживание секций сущности "Сообщения" (db/message_partition.sql):
+# количество дней, на которое секции создаются заранее; срок хранения (в днях) секций с обработанными
+# сообщениями; срок (в днях), после которого секция отсоединяется безусловно (0 - не отсоединять безусловно);
+# каталог для выгрузки отсоединенных секций (относительный путь - от корня проекта)
+PARTITION_AHEAD_DAYS = int(config['PARTITION']['ahead_days'])
+PARTITION_RETENTION_DAYS = int(config['PARTITION']['retention_days'])
+PARTITION_MAX_DAYS = int(config['PARTITION']['max_days'])
+PARTITION_ARCHIVE_DIR = os.path.join(BASE_DIR, config['PARTITION']['archive_dir'])
+
+# Метрики: адрес и порт выгрузки по HTTP в формате Prometheus (порт 0 - выгрузка отключена)
+# и период (в секундах) сводки метрик в журнал (0 - сводка отключена)
+METRICS_HOST = config['METRICS']['host']
+METRICS_PORT = int(config['METRICS']['port'])
+METRICS_LOG_INTERVAL = int(config['METRICS']['log_interval'])
+
 DB_NAME = config['DATABASE']['NAME']
 DB_USER = config['DATABASE']['USER']
 DB_HOST = config['DATABASE']['HOST']
@@ -1,38 +1,57 @@
 # -*- coding: utf-8 -*-
+import os
 import uuid
 import json
 from datetime import datetime
 # from django.conf import settings as main_settings
-from django.db.models import Q
+from django.db.models import Q, F, Func, Value, IntegerField
+from django.db import connection as db_connection
+from django.db.transaction import atomic, on_commit
+from django.db.backends.signals import connection_created
 from settings import MODULE_SYSTEM_NAME
 from settings import TASK_LOG_CHANNEL
 from settings import MESSAGE_CHANNEL
 from settings import MAIN_TASK_LOG_CHANNEL
 from settings import COMMAND_LOG_CHANNEL
 from settings import PERIOD_TIME
+from settings import FULL_REFRESH_TIME
+from settings import PARTITION_AHEAD_DAYS, PARTITION_RETENTION_DAYS, PARTITION_MAX_DAYS, PARTITION_ARCHIVE_DIR
+from settings import NOTIFY_MIN_WAIT, NOTIFY_MAX_WAIT
+from settings import QUEUE_SIZE
+from settings import HEARTBEAT_CHANNEL, HEARTBEAT_TIMEOUT, HEARTBEAT_CHECK
+from settings import RECOVERY_BATCH_SIZE, RECOVERY_RATE
+from settings import MODULE_INSTANCE_CHANNEL, DISPATCH_MODE
+from settings import CLUSTER_ENABLED, CLUSTER_SHARD_COUNT, CLUSTER_LEASE, CLUSTER_RENEW
+from settings import METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL
 from settings import DB_HOST, DB_PORT, DB_NAME, DB_USER
 
+from functools import partial
 from collections import namedtuple
 
 from utils.base_utils.base_class import BaseSVC
+from utils.base_utils.base_class import NotifyCoalescer
+from utils.base_utils.reference_cache import ReferenceCache
+from utils.base_utils.in_flight import InFlightRegistry
+from utils.base_utils.task_plan_cache import TaskPlanCache
+from utils.base_utils.heartbeat import HeartbeatMonitor
+from utils.base_utils.recovery import RecoveryEngine
+from utils.base_utils.dispatcher import InstanceDispatcher
+from utils.base_utils.cluster import ShardCluster
+from utils.base_utils.thread_pool import PRIORITY_HEARTBEAT, PRIORITY_COMPLETION, PRIORITY_DISPATCH, PRIORITY_FANOUT
 from utils.exceptions import FindModuleError
 from utils.wrapper import message_wrapper
+from utils.db_utils import transaction, copy_rows, copy_to_file
 
 from utils.status_type import MsgTypeChoice
 from utils.status_type import StatusSendChoice
 from models import ModuleModel
 from models import MainTaskLogModel
-from models import TaskSequenceModel
-from models import ObjectToCommandLogModel
 from models import TaskLogModel
 from models import CommandLogModel
-from models import ActionModel
-from models import CommandModel
-from models import MethodModuleModel
 from models import MessageModel
-from models import StatusTaskModel
 
-FuncInfo = namedtuple("FuncInfo", "name max_count wait_time")
+FuncInfo = namedtuple("FuncInfo", "name max_count priority")
+LogItem = namedtuple("LogItem", "s_id")
 
 
 class TaskSVC(BaseSVC):
@@ -41,7 +60,12 @@ class TaskSVC(BaseSVC):
 
     Основыне задачи:
      - подписка на каналы, указанные в настройках менеджера
-     - запуск периодической задачи: проверка на работоспособность функциональных служб
+     - контроль работоспособности функциональных служб и их экземпляров по сигналам (см. HeartbeatMonitor)
+     - выбор экземпляра функциональной службы при отправке задачи (см. InstanceDispatcher)
+     - запуск периодической задачи: обслуживание секций сущности "Сообщения"
+     - в режиме нескольких экземпляров: обработка только своих секций записей и выполнение задач ведущего
+       только ведущим экземпляром (см. ShardCluster)
+     - метрики буферов сообщений по каналам в дополнение к метрикам задач и очереди (см. BaseSVC)
      - при получении сообщений:
         - создание сообщений для соответствующих задач
         - обновление статусов отправки сообщений
@@ -50,19 +74,311 @@ class TaskSVC(BaseSVC):
     """
     _module = None
     _notify_query = "SELECT pg_notify('{}', '{}');"
+    _is_partitioned_query = "SELECT relkind = 'p' FROM pg_class WHERE oid = 'manager.message'::regclass"
+    _partition_query = "SELECT manager.message_partition_manage(%s, %s, %s)"
+    _payload_cleanup_query = """
+        DELETE FROM manager.message_payload AS p
+         WHERE p.date_created < now() - %s * interval '1 day'
+           AND NOT EXISTS (SELECT 1 FROM manager.message AS m WHERE m.s_id = p.message_id)
+    """
+    _create_message_query = """
+        WITH log AS (
+            SELECT l.s_id AS log_id, {task_log_id} AS task_log_id, {command_log_id} AS command_log_id,
+                   m.module_id, m.system_name AS method, md.status AS module_status, {batch} AS batch
+              FROM manager.{table} AS l
+              JOIN manager.{definition} AS d ON d.s_id = l.{definition_id}
+              JOIN manager.method_module AS m ON m.s_id = d.method_id
+              JOIN manager.module AS md ON md.s_id = m.module_id
+             WHERE l.s_id = ANY(%(log_id_list)s::uuid[])
+               AND NOT EXISTS (SELECT 1 FROM manager.command_log AS c WHERE c.{child_id} = l.s_id)
+               FOR UPDATE OF l SKIP LOCKED
+        ), last_message AS (
+            SELECT DISTINCT ON (msg.{message_log_id}, msg.msg_type)
+                   msg.{message_log_id} AS log_id, msg.msg_type, msg.date_created
+              FROM manager.message AS msg
+             WHERE msg.{message_log_id} = ANY(%(log_id_list)s::uuid[]) {message_filter}
+               AND msg.msg_type IN (%(success)s, %(error)s, %(task)s)
+             ORDER BY msg.{message_log_id}, msg.msg_type, msg.date_created DESC
+        ), new_message AS (
+            INSERT INTO manager.message (s_id, send_id, get_id, date_created, status, msg_type,
+                                         parent_msg_id, task_log_id, command_log_id, data)
+            SELECT n.s_id, %(send_id)s, n.module_id, now(), NULL, %(task)s, NULL, n.task_log_id, n.command_log_id,
+                   jsonb_strip_nulls(jsonb_build_object('task_id', n.s_id::text, 'msg_type', %(task)s,
+                                                        'method', n.method, 'batch', n.batch))
+              FROM (SELECT public.uuid_generate_v4() AS s_id, log.*
+                      FROM log
+                      LEFT JOIN last_message AS s ON s.log_id = log.log_id AND s.msg_type = %(success)s
+                      LEFT JOIN last_message AS e ON e.log_id = log.log_id AND e.msg_type = %(error)s
+                      LEFT JOIN last_message AS t ON t.log_id = log.log_id AND t.msg_type = %(task)s
+                     WHERE log.module_status AND (s.date_created IS NULL OR e.date_created > s.date_created)
+                       AND (%(is_restart)s OR t.date_created IS NULL OR e.date_created > t.date_created)
+                   ) AS n
+            RETURNING s_id
+        ), update_log AS (
+            UPDATE manager.{table} AS l SET status_id = %(status_id)s
+              FROM log
+             WHERE l.s_id = log.log_id AND l.status_id IS DISTINCT FROM %(status_id)s
+            RETURNING l.s_id
+        )
+        SELECT (SELECT count(*) FROM new_message), (SELECT count(*) FROM update_log);
+    """
+    # batch - ключ группы команд одной родительской записи с одной командой (для методов с пакетным выполнением):
+    # задачи группы отправляются службе одним notify (см. send_notify)
+    _create_message_part = {
+        False: {"table": "task_log", "definition": "action", "definition_id": "action_id",
+                "task_log_id": "l.s_id", "command_log_id": "NULL::uuid", "child_id": "task_log_id",
+                "message_log_id": "task_log_id", "message_filter": "AND msg.command_log_id IS NULL",
+                "batch": "NULL::text"},
+        True: {"table": "command_log", "definition": "command", "definition_id": "command_id",
+               "task_log_id": "l.task_log_id", "command_log_id": "l.s_id", "child_id": "parent_id",
+               "message_log_id": "command_log_id", "message_filter": "",
+               "batch": "CASE WHEN m.is_batch THEN concat_ws(':', l.task_log_id, l.parent_id, l.command_id) END"},
+    }
+    _command_query = """
+        SELECT msg.s_id, m.system_name, c.s_id, c.is_parallel
+          FROM manager.message AS msg
+          JOIN manager.task_log AS tl ON tl.s_id = msg.task_log_id
+          JOIN manager.command AS c ON c.action_id = tl.action_id
+          JOIN manager.method_module AS m ON m.s_id = c.method_id AND m.module_id = msg.send_id
+         WHERE msg.s_id = ANY(%(message_id_list)s::uuid[])
+    """
+    _update_log_query = """
+        WITH target AS (
+            SELECT s_id FROM manager.{table}
+             WHERE s_id = ANY(%(log_id_list)s::uuid[])
+               FOR UPDATE SKIP LOCKED
+        ), child AS (
+            SELECT c.{child_id} AS log_id,
+                   count(*) FILTER (WHERE c.status_id = %(error)s) AS error_count,
+                   count(*) FILTER (WHERE c.status_id IS DISTINCT FROM %(finish)s) AS not_finish_count
+              FROM manager.{child_table} AS c
+              JOIN target ON target.s_id = c.{child_id}
+             GROUP BY c.{child_id}
+        )
+        UPDATE manager.{table} AS l
+           SET status_id = CASE WHEN child.error_count > 0 THEN %(error)s::uuid ELSE %(finish)s::uuid END{finish_set}
+          FROM child
+         WHERE l.s_id = child.log_id AND (child.error_count > 0 OR child.not_finish_count = 0)
+           AND l.status_id IS DISTINCT FROM CASE WHEN child.error_count > 0 THEN %(error)s::uuid
+                                                 ELSE %(finish)s::uuid END
+        RETURNING l.s_id
+    """
+    # Для базовой задачи при выполнении заполняется дата окончания и очищается текущая задача
+    _main_task_log_finish_set = """,
+               end_task_date = CASE WHEN child.error_count > 0 THEN l.end_task_date ELSE now() END,
+               current_task_id = CASE WHEN child.error_count > 0 THEN l.current_task_id END"""
+    _update_log_part = {
+        "main_task_log": {"table": "main_task_log", "child_table": "task_log", "child_id": "main_task_log_id",
+                          "finish_set": _main_task_log_finish_set},
+        "task_log": {"table": "task_log", "child_table": "command_log", "child_id": "task_log_id", "finish_set": ""},
+        "command_log": {"table": "command_log", "child_table": "command_log", "child_id": "parent_id",
+                        "finish_set": ""},
+    }
+    _update_next_command_log_query = """
+        WITH target AS (
+            SELECT s_id FROM manager.{table}
+             WHERE s_id = ANY(%(log_id_list)s::uuid[])
+               FOR UPDATE SKIP LOCKED
+        ), last_finish AS (
+            SELECT cl.{child_id} AS log_id, max(c.number) AS number
+              FROM manager.command_log AS cl
+              JOIN target ON target.s_id = cl.{child_id}
+              JOIN manager.command AS c ON c.s_id = cl.command_id
+             WHERE cl.status_id = %(finish)s {child_filter}
+             GROUP BY cl.{child_id}
+        )
+        UPDATE manager.command_log AS cl SET status_id = %(progress)s
+          FROM last_finish, manager.command AS c
+         WHERE cl.{child_id} = last_finish.log_id {child_filter} AND c.s_id = cl.command_id
+           AND cl.status_id = %(set)s AND NOT c.is_parallel AND c.number = last_finish.number + 1
+        RETURNING cl.s_id
+    """
+    _update_next_command_log_part = {
+        False: {"table": "task_log", "child_id": "task_log_id", "child_filter": "AND cl.parent_id IS NULL"},
+        True: {"table": "command_log", "child_id": "parent_id", "child_filter": ""},
+    }
+    _main_task_log_query = """
+        SELECT m.s_id, m.base_task_id
+          FROM manager.main_task_log AS m
+         WHERE m.s_id = ANY(%(log_id_list)s::uuid[]) AND m.status_id = %(progress)s
+           AND NOT EXISTS (SELECT 1 FROM manager.task_log AS t WHERE t.main_task_log_id = m.s_id)
+           FOR UPDATE SKIP LOCKED
+    """
+    _current_task_query = """
+        UPDATE manager.main_task_log AS m SET current_task_id = c.task_log_id
+          FROM unnest(%(main_task_log_id_list)s::uuid[], %(task_log_id_list)s::uuid[])
+               AS c (main_task_log_id, task_log_id)
+         WHERE m.s_id = c.main_task_log_id
+    """
+    # Состояние экземпляров служб (для службы без экземпляров - самой службы)
+    _heartbeat_state_query = """
+        SELECT COALESCE(i.s_id, m.s_id), m.s_id, m.status, extract(epoch FROM now() - h.beat_date)
+          FROM manager.module AS m
+          LEFT JOIN manager.module_instance AS i ON i.module_id = m.s_id
+          LEFT JOIN manager.module_heartbeat AS h ON h.instance_id = COALESCE(i.s_id, m.s_id)
+         WHERE m.s_id <> %s
+    """
+    # Время с последнего сигнала экземпляров служб (в секундах)
+    _heartbeat_age_query = """
+        SELECT instance_id, extract(epoch FROM now() - beat_date)
+          FROM manager.module_heartbeat
+         WHERE instance_id = ANY(%(instance_id_list)s::uuid[])
+    """
+    # Задачи, отправленные экземплярам служб, на которые еще нет ответа
+    # (ответ - дочернее сообщение "Успешно" или "Ошибка"; информационные сообщения и ход выполнения не в счет)
+    _outstanding_query = """
+        SELECT msg.s_id, msg.instance_id
+          FROM manager.message AS msg
+         WHERE msg.instance_id IS NOT NULL AND msg.msg_type = %(task)s AND msg.status IS NOT NULL
+           AND NOT EXISTS (SELECT 1 FROM manager.message AS r
+                            WHERE r.parent_msg_id = msg.s_id AND r.msg_type IN (%(success)s, %(error)s))
+    """
+    # Переназначение неотвеченных задач неработоспособных экземпляров: сброс статуса отправки
+    # (notify по сообщениям - повторная отправка через send_notify другому экземпляру)
+    _reassign_query = """
+        UPDATE manager.message AS msg SET status = NULL, instance_id = NULL
+         WHERE msg.instance_id = ANY(%(instance_id_list)s::uuid[]) AND msg.msg_type = %(task)s
+           AND msg.status IS NOT NULL
+           AND NOT EXISTS (SELECT 1 FROM manager.message AS r
+                            WHERE r.parent_msg_id = msg.s_id AND r.msg_type IN (%(success)s, %(error)s))
+        RETURNING msg.s_id
+    """
+    _module_status_query = """
+        WITH changed AS (
+            UPDATE manager.module AS m SET status = s.status
+              FROM unnest(%(module_id_list)s::uuid[], %(status_list)s::boolean[]) AS s (s_id, status)
+             WHERE m.s_id = s.s_id AND m.status IS DISTINCT FROM s.status
+            RETURNING m.s_id, m.status
+        )
+        SELECT s_id, status FROM changed
+    """
+    # Задачи и команды в статусе "Выполняется" без дочерних команд, методы которых выполняют службы
+    _recovery_query = """
+        SELECT m.module_id, false, l.s_id
+          FROM manager.task_log AS l
+          JOIN manager.action AS d ON d.s_id = l.action_id
+          JOIN manager.method_module AS m ON m.s_id = d.method_id
+         WHERE l.status_id = %(progress)s AND m.module_id = ANY(%(module_id_list)s::uuid[])
+           AND NOT EXISTS (SELECT 1 FROM manager.command_log AS c WHERE c.task_log_id = l.s_id)
+         UNION ALL
+        SELECT m.module_id, true, l.s_id
+          FROM manager.command_log AS l
+          JOIN manager.command AS d ON d.s_id = l.command_id
+          JOIN manager.method_module AS m ON m.s_id = d.method_id
+         WHERE l.status_id = %(progress)s AND m.module_id = ANY(%(module_id_list)s::uuid[])
+           AND NOT EXISTS (SELECT 1 FROM manager.command_log AS c WHERE c.parent_id = l.s_id)
+         ORDER BY 1, 2, 3
+    """
+    # Отмена поставленных команд в дереве команд (command_log.parent_id):
+    # спуск по дереву выполняется только через команды в статусе "Выполняется",
+    # отменяются команды в статусе "Поставлена".
+    # Сложность - O(N log N) для N команд в обходимой части дерева: один индексный поиск по parent_id
+    # на уровень дерева (command_log_parent_idx) и сортировка отменяемых команд.
+    # Порядок блокировок: сначала задачи, затем команды, каждые в порядке s_id, - поэтому два
+    # одновременных запроса отмены не блокируют друг друга взаимно.
+    _cancel_command_log_query = """
+        WITH RECURSIVE {task_cte} tree AS (
+            SELECT cl.s_id, cl.status_id
+              FROM manager.command_log AS cl
+             WHERE {root_filter}
+             UNION ALL
+            SELECT cl.s_id, cl.status_id
+              FROM tree
+              JOIN manager.command_log AS cl ON cl.parent_id = tree.s_id
+             WHERE tree.status_id = %(progress)s
+        ), target AS (
+            SELECT cl.s_id
+              FROM manager.command_log AS cl
+              JOIN tree ON tree.s_id = cl.s_id
+             WHERE cl.status_id = %(set)s
+             ORDER BY cl.s_id
+               FOR UPDATE OF cl
+        ), cancel_command_log AS (
+            UPDATE manager.command_log AS cl SET status_id = %(cancel)s
+              FROM target
+             WHERE cl.s_id = target.s_id
+            RETURNING cl.s_id
+        )
+        SELECT {task_count} (SELECT count(*) FROM cancel_command_log);
+    """
+    _cancel_task_cte = """task_target AS (
+            SELECT s_id FROM manager.task_log
+             WHERE main_task_log_id = ANY(%(log_id_list)s::uuid[]) AND status_id = %(set)s
+             ORDER BY s_id
+               FOR UPDATE
+        ), cancel_task_log AS (
+            UPDATE manager.task_log AS t SET status_id = %(cancel)s
+              FROM task_target
+             WHERE t.s_id = task_target.s_id
+            RETURNING t.s_id
+        ),"""
+    _cancel_command_log_part = {
+        "main_task_log": {"task_cte": _cancel_task_cte, "task_count": "(SELECT count(*) FROM cancel_task_log) +",
+                          "root_filter": "cl.task_log_id IN (SELECT s_id FROM cancel_task_log) "
+                                         "AND cl.parent_id IS NULL"},
+        "task_log": {"task_cte": "", "task_count": "",
+                     "root_filter": "cl.task_log_id = ANY(%(log_id_list)s::uuid[]) AND cl.parent_id IS NULL"},
+        "command_log": {"task_cte": "", "task_count": "", "root_filter": "cl.parent_id = ANY(%(log_id_list)s::uuid[])"},
+    }
     _ksa = None
-    _key_func = {TASK_LOG_CHANNEL: FuncInfo("refresh_task_log", 10, 10),
-                 COMMAND_LOG_CHANNEL: FuncInfo("refresh_command_log", 10, 10),
-                 MAIN_TASK_LOG_CHANNEL: FuncInfo("refresh_main_task_log", 10, 10),
-                 MESSAGE_CHANNEL: FuncInfo("refresh_message", 100, 10)}
-
-    cursor = None
+    # Канал: функция поиска изменений, максимальный размер пачки буфера сообщений, приоритет в очереди задач
+    # (завершения выполнения из сообщений > рассылка задач > создание задач для базовых задач)
+    _key_func = {TASK_LOG_CHANNEL: FuncInfo("refresh_task_log", 100, PRIORITY_DISPATCH),
+                 COMMAND_LOG_CHANNEL: FuncInfo("refresh_command_log", 100, PRIORITY_DISPATCH),
+                 MAIN_TASK_LOG_CHANNEL: FuncInfo("refresh_main_task_log", 100, PRIORITY_FANOUT),
+                 MESSAGE_CHANNEL: FuncInfo("refresh_message", 1000, PRIORITY_COMPLETION)}
+    _priority_func = {"set_module_status": PRIORITY_HEARTBEAT, "set_instance_status": PRIORITY_HEARTBEAT,
+                      "update_command_log": PRIORITY_COMPLETION, "update_task_log": PRIORITY_COMPLETION,
+                      "create_task_log": PRIORITY_FANOUT, "create_command_log": PRIORITY_FANOUT}
+    # Обработчики, которые сами захватывают записи в запросе (FOR UPDATE [SKIP LOCKED])
+    _self_locked_func = ("create_message", "update_main_task_log", "update_next_command_log", "update_log",
+                         "cancel_task_log", "cancel_command_log", "create_task_log")
+    _queue_size = QUEUE_SIZE
+    _metrics_host = METRICS_HOST
+    _metrics_port = METRICS_PORT
+    _metrics_log_interval = METRICS_LOG_INTERVAL
+    # Максимальное количество задач в одном notify группы пакетного выполнения
+    # (размер notify ограничен 8000 байт)
+    _batch_size = 100
+
+    reference = None
+    task_plan = None
+    heartbeat = None
+    recovery = None
+    dispatcher = None
+    cluster = None
+    in_flight = None
     notify_list = None
+    fdt = None
 
     def __init__(self, thread_count):
-        BaseSVC.__init__(self, thread_count, DB_HOST, DB_PORT, DB_NAME, DB_USER, MODULE_SYSTEM_NAME)
+        super().__init__(thread_count, DB_HOST, DB_PORT, DB_NAME, DB_USER, MODULE_SYSTEM_NAME)
+        # запросы Django в задачах учитываются в метриках задач (подключения Django создаются в потоках)
+        connection_created.connect(self._on_connection_created, weak=False)
+        self.metrics.add_collector(self._notify_metrics)
         self.module = MODULE_SYSTEM_NAME
-        self.cursor = self.e.cursor()
+        self.reference = ReferenceCache(lambda: self.cursor)
+        self.task_plan = TaskPlanCache(lambda: self.cursor)
+        self.in_flight = InFlightRegistry()
+        self.dispatcher = InstanceDispatcher(DISPATCH_MODE)
+        self._instance_module = dict()
+        self._instance_id_set = set()
+
+    @property
+    def cursor(self):
+        """
+        Новый курсор для подключения текущего потока из пула подключений
+        (подключение для подписки на канал используется только для ожидания сообщений)
+        """
+        return self.db_pool.cursor()
+
+    @property
+    def atomic_cursor(self):
+        """
+        Новый курсор для подключения Django текущего потока
+        (запросы выполняются в транзакции обработчика вместе с изменением статуса сообщений, см. _run_claimed)
+        """
+        return db_connection.cursor()
 
     @property
     def module(self):
@@ -86,346 +402,686 @@ class TaskSVC(BaseSVC):
         Запуск подписки на список каналов
 
         Основыне задачи метода:
-         - инициализация списка каналов: канал для сущности "Сообщения" и канал для сущности "Аудит выполнения задач"
-         - инициализация структуры для хранения времени первого сообщения и количество сообщений
-           (данная структура необходима для реализации ожидания нескольких сообщений из канала,
-            обеспечивает выполнение поиска изменений не для каждого изменения в БД а для группы изменений)
+         - инициализация списка каналов: канал для сущности "Сообщения" и канал для сущности "Аудит выполнения задач",
+           а также каналы справочных сущностей и структуры задач (для сброса кэша справочников и кэша планов)
+         - инициализация адаптивного буфера сообщений для каждого канала
+           (буфер накапливает измененные записи и по собственному таймеру ставит в очередь поиск изменений
+            для группы изменений, а не для каждого изменения в БД)
+         - в режиме нескольких экземпляров (CLUSTER_ENABLED): запуск распределения секций (см. ShardCluster)
          - запуск подкписки
 
         :return:
         """
-        self.table_list = [MESSAGE_CHANNEL, TASK_LOG_CHANNEL, MAIN_TASK_LOG_CHANNEL, COMMAND_LOG_CHANNEL]
+        self.table_list = [MESSAGE_CHANNEL, TASK_LOG_CHANNEL, MAIN_TASK_LOG_CHANNEL, COMMAND_LOG_CHANNEL,
+                           HEARTBEAT_CHANNEL] + \
+            self.reference.table_list + [table for table in self.task_plan.table_list
+                                         if table not in self.reference.table_list]
         self.notify_list = dict()
         for key, item in self._key_func.items():
-            self.notify_list[key] = NotifyCount(item.max_count, item.wait_time)
-        BaseSVC.run(self)
+            self.notify_list[key] = NotifyCoalescer(
+                partial(self.refresh, key), NOTIFY_MIN_WAIT, NOTIFY_MAX_WAIT, item.max_count)
+        self.recovery = RecoveryEngine(self._dispatch_recovery, RECOVERY_BATCH_SIZE, RECOVERY_RATE)
+        self.refresh_instance_list()
+        cursor = self.cursor
+        cursor.execute(self._heartbeat_state_query, (str(self.module.s_id),))
+        state = dict()
+        for instance_id, module_id, status, age in cursor.fetchall():
+            self._instance_module[str(instance_id)] = str(module_id)
+            self.dispatcher.set_alive(instance_id, bool(status))
+            state[str(instance_id)] = (status, age)
+        for message_id, instance_id in self._outstanding_list():
+            self.dispatcher.assign(message_id, instance_id)
+        self.heartbeat = HeartbeatMonitor(self._on_heartbeat_change, HEARTBEAT_TIMEOUT, HEARTBEAT_CHECK, state)
+        if CLUSTER_ENABLED:
+            self.cluster = ShardCluster(self.connect, CLUSTER_SHARD_COUNT, CLUSTER_LEASE, CLUSTER_RENEW,
+                                        self._on_cluster_change)
+        super().run()
+        if self.cluster:
+            self.cluster.stop()
+        self.heartbeat.stop()
+        self.recovery.stop()
+        for notify in self.notify_list.values():
+            notify.stop()
+
+    @property
+    def is_leader(self) -> bool:
+        """
+        Признак ведущего экземпляра (единственный экземпляр всегда ведущий)
+        """
+        return self.cluster is None or self.cluster.is_leader
+
+    def _owned(self, queryset):
+        """
+        Ограничение поиска изменений своими секциями записей (в режиме нескольких экземпляров)
+        :param queryset: записи сущности
+        :return: записи сущности из своих секций
+        """
+        if self.cluster is None:
+            return queryset
+        return queryset.annotate(shard=Func(F("s_id"), Value(self.cluster.shard_count),
+                                            function="manager.shard_of", output_field=IntegerField())
+                                 ).filter(shard__in=self.cluster.shard_list)
+
+    def _on_cluster_change(self, shard_list: list, is_new_leader: bool) -> None:
+        """
+        Обработка получения новых секций или роли ведущего (вызывается распределением секций)
+
+        Для новых секций запускается полный поиск изменений по всем каналам (работа, оставшаяся
+        от прежнего владельца секций). Новый ведущий сверяет статусы служб с монитором работоспособности
+        и обслуживает секции сущности "Сообщения".
+
+        :param shard_list: список новых секций
+        :param is_new_leader: признак получения роли ведущего
+        :return:
+        """
+        if shard_list:
+            for notify in self.notify_list.values():
+                notify.push(None)
+                notify.flush()
+            self.pool_task.put_task(self.sync_dispatch, priority=PRIORITY_HEARTBEAT)
+        if is_new_leader:
+            self._on_heartbeat_change(self.heartbeat.state())
+            self.pool_task.add_task(self.manage_message_partition)
+
+    def cluster_stats(self) -> dict:
+        """
+        Состояние экземпляра в режиме нескольких экземпляров
+        :return: статистика распределения секций или None
+        """
+        return self.cluster.stats() if self.cluster else None
 
     def add_task(self, channel: str, data: str) -> None:
         """
         Обработка сообщений из каналов
 
-        Алгоритм:
-         - для каждого канала проверяется нужно ли запускать поиск изменений
-           в зависимости от прошедшего времени и количества уже поступивших аналогичных сообщений
-         - если нужно, то запускается соответствующий метод
+        Если канал - сигналы работоспособности служб, то время сигнала экземпляра службы учитывается в мониторе
+        работоспособности (см. HeartbeatMonitor).
+        Если канал - экземпляры служб, то дополнительно ставится в очередь обновление списка экземпляров диспетчера
+        (метод вызывается потоком подписки или на цикле событий и не обращается к базе данных).
+        Если канал - справочная сущность или сущность структуры задач, то сбрасывается кэш данной сущности
+        и кэш планов базовых задач (см. TaskPlanCache).
+        Иначе измененные записи добавляются в буфер сообщений канала, который сам определяет,
+        когда поставить в очередь поиск изменений (см. NotifyCoalescer)
+
+        :param channel: наименование канала
+        :param data: список измененных записей или None (если необходим полный поиск изменений)
+        :return:
+        """
+        if channel == HEARTBEAT_CHANNEL:
+            for row in data or []:
+                self._instance_module[str(row["id"])] = str(row.get("m") or row["id"])
+                self.heartbeat.beat(row["id"])
+        elif channel in self.notify_list:
+            self.notify_list[channel].push(data)
+        else:
+            self.reference.invalidate(channel)
+            self.task_plan.invalidate(channel)
+            if channel == MODULE_INSTANCE_CHANNEL:
+                self.pool_task.put_task(self.refresh_instance_list, priority=PRIORITY_HEARTBEAT)
+
+    def refresh_instance_list(self) -> None:
+        """
+        Обновление списка экземпляров служб диспетчера из кэша справочников
+
+        Удаленные экземпляры (остановленные службы) считаются неработоспособными (см. set_instance_status)
+        и исключаются из монитора сигналов и соответствия экземпляров службам.
+        :return:
+        """
+        instance_list = self.reference.all(MODULE_INSTANCE_CHANNEL)
+        self.dispatcher.set_instance_list(instance_list)
+        instance_id_set = {str(instance["s_id"]) for instance in instance_list}
+        removed_list = list(self._instance_id_set - instance_id_set)
+        self._instance_id_set = instance_id_set
+        if removed_list:
+            self.heartbeat.forget(removed_list)
+            self.set_instance_status({instance_id: False for instance_id in removed_list})
+            for instance_id in removed_list:
+                self._instance_module.pop(instance_id, None)
+
+    def refresh(self, channel: str, row_list) -> None:
+        """
+        Постановка в очередь поиска изменений для канала по накопленному списку измененных записей
+        (вызывается буфером сообщений канала; при заполненной очереди ожидает, пока буфер копит изменения)
 
         :param channel: наименование канала
-        :param data: сообщение (не используется)
+        :param row_list: список измененных записей или None (если необходим полный поиск изменений)
         :return:
         """
-        if self.notify_list[channel].is_need_add_task():
-            refresh_func = getattr(self, self._key_func[channel].name)
-            refresh_func()
+        item = self._key_func[channel]
+        self.pool_task.put_task(getattr(self, item.name), (row_list,), priority=item.priority, key=channel)
 
-    def refresh_main_task_log(self):
+    def notify_stats(self) -> dict:
+        """
+        Статистика буферов сообщений по каналам (задержка и размер пачек)
+        :return: словарь {канал: статистика}
+        """
+        return {key: notify.stats() for key, notify in self.notify_list.items()}
+
+    def _on_connection_created(self, sender, connection, **kwargs) -> None:
+        connection.execute_wrappers.append(self.task_metrics.django_execute_wrapper)
+
+    def _notify_metrics(self) -> list:
+        """
+        Функция сбора метрик буферов сообщений по каналам: поступившие notify, переданные на обработку пачки
+        (notify, объединенные в пачки) и задержка передачи пачки на обработку
+        :return: список метрик (см. MetricRegistry.add_collector)
+        """
+        if not self.notify_list:
+            return []
+        stats = self.notify_stats()
+        return [
+            ("manager_notify_received_total", "counter", "Поступившие notify", ("channel",),
+             {(key,): item["notify_count"] for key, item in stats.items()}),
+            ("manager_notify_batches_total", "counter", "Пачки notify, переданные на обработку", ("channel",),
+             {(key,): item["batch_count"] for key, item in stats.items()}),
+            ("manager_notify_latency_p99_seconds", "gauge", "Задержка передачи пачки на обработку (99-й процентиль)",
+             ("channel",), {(key,): item["latency_p99"] / 1000 for key, item in stats.items()}),
+        ]
+
+    def queue_stats(self) -> dict:
+        """
+        Статистика очереди задач по классам приоритета (глубина, количество, время ожидания в очереди)
+        :return: словарь {приоритет: статистика}
+        """
+        return self.pool_task.stats()
+
+    def set_message_status(self, id_list: list, status: str) -> None:
+        """
+        Изменение статуса отправки списка сообщений одним запросом
+        (через подключение Django текущего потока: сообщения могут быть заблокированы в транзакции обработчика)
+
+        :param id_list: список идентификаторов сообщений из сущности "Сообщения"
+        :param status: статус отправки
+        :return:
+        """
+        MessageModel.objects.filter(s_id__in=id_list).update(status=status)
+
+    def _enqueue(self, func, log_list, **kwargs) -> None:
+        """
+        Постановка обработчика в очередь задач для списка записей без записей, которые уже в обработке
+
+        Записи регистрируются в реестре записей в обработке по наименованию обработчика;
+        записи, которые уже переданы этому обработчику и еще не обработаны, отбрасываются.
+
+        :param func: обработчик
+        :param log_list: записи (QuerySet с условием поиска изменений: условие повторно проверяется
+                         при блокировке записей, см. _run_claimed)
+        :param kwargs: именованные аргументы обработчика
+        :return:
+        """
+        row_dict = {str(row.s_id): row for row in log_list}
+        id_list = self.in_flight.claim(func.__name__, list(row_dict.keys()))
+        if id_list:
+            self.pool_task.put_task(
+                self._run_claimed, (func, [row_dict[s_id] for s_id in id_list], log_list), kwargs,
+                priority=self._priority_func.get(func.__name__, PRIORITY_DISPATCH), key=func.__name__,
+                name=func.__name__)
+
+    def _run_claimed(self, func, row_list: list, queryset, **kwargs) -> None:
+        """
+        Выполнение обработчика для захваченных записей
+
+        Алгоритм:
+         - если обработчик сам захватывает записи в запросе, то он вызывается для всего списка
+         - иначе в транзакции записи блокируются (SELECT ... FOR UPDATE SKIP LOCKED) с повторной проверкой
+           условия поиска изменений, и обработчик вызывается только для заблокированных записей, которые
+           все еще удовлетворяют условию: записи, которые обрабатывает другой поток или другой экземпляр
+           менеджера задач, пропускаются, а записи, уже обработанные после поиска изменений, не обрабатываются
+           повторно
+         - записи освобождаются в реестре записей в обработке; записи, измененные во время обработки
+           (см. InFlightRegistry), повторно ставятся в очередь, если все еще удовлетворяют условию
+
+        :param func: обработчик
+        :param row_list: список записей
+        :param queryset: записи с условием поиска изменений (QuerySet)
+        :param kwargs: именованные аргументы обработчика
+        :return:
+        """
+        id_list = [str(row.s_id) for row in row_list]
+        self.in_flight.start(func.__name__, id_list)
+        try:
+            if func.__name__ in self._self_locked_func:
+                func(row_list, **kwargs)
+            else:
+                with atomic():
+                    row_list = list(type(row_list[0]).objects.select_for_update(skip_locked=True).filter(
+                        s_id__in=id_list).filter(s_id__in=queryset.order_by().values("s_id")))
+                    if row_list:
+                        func(row_list, **kwargs)
+        finally:
+            dirty_list = self.in_flight.release(func.__name__, id_list)
+            if dirty_list:
+                self._enqueue(func, queryset.filter(s_id__in=dirty_list), **kwargs)
+
+    @staticmethod
+    def _get_id_list(row_list: list) -> list:
+        """
+        Получение списка идентификаторов измененных записей
+        :param row_list: список измененных записей
+        :return: список идентификаторов
+        """
+        return [row["id"] for row in row_list]
+
+    @staticmethod
+    def _is_msg_type(row_list, *msg_type_list) -> bool:
+        """
+        Проверка на наличие среди измененных записей сообщений с указанными типами
+        (если тип сообщения неизвестен, то считается, что запись может иметь любой тип)
+        :param row_list: список измененных записей или None
+        :param msg_type_list: список типов сообщения
+        :return: True или False
+        """
+        if row_list is None:
+            return True
+        return any(row.get("mt") is None or row["mt"] in msg_type_list for row in row_list)
+
+    def _enqueue_found(self, found) -> None:
+        """
+        Постановка в очередь обработчиков поиска изменений для непустых списков записей
+        :param found: генератор (обработчик, записи, именованные аргументы обработчика)
+        :return:
+        """
+        for func, queryset, kwargs in found:
+            if queryset:
+                self._enqueue(func, queryset, **kwargs)
+
+    def refresh_main_task_log(self, row_list=None):
         """
         Поиск изменений в сущности "Аудит выполнения базовых задач"
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
         :return:
         """
-        main_task_log_list = MainTaskLogModel.objects.filter(
-            status_id__system_name="progress", task_log_list__isnull=True
+        self._enqueue_found(self._find_main_task_log(row_list))
+
+    def _find_main_task_log(self, row_list=None):
+        """
+        Записи для обработчиков поиска изменений в сущности (см. refresh_main_task_log)
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
+        :return: генератор (обработчик, записи - QuerySet, именованные аргументы обработчика)
+        """
+        main_task_log_list = self._owned(MainTaskLogModel.objects.all())
+        if row_list is not None:
+            if not row_list:
+                return
+            main_task_log_list = main_task_log_list.filter(s_id__in=self._get_id_list(row_list))
+
+        new_main_task_log_list = main_task_log_list.filter(
+            status_id=self.reference.status_id("progress"), task_log_list__isnull=True
         )
-        if main_task_log_list:
-            self.pool_task.add_task(self.create_task_log, main_task_log_list)
+        yield self.create_task_log, new_main_task_log_list, dict()
 
-        main_task_log_list = MainTaskLogModel.objects.filter(
-            status_id__system_name="cancel", task_log_list__isnull=False
+        main_task_log_list = main_task_log_list.filter(
+            status_id=self.reference.status_id("cancel"), task_log_list__isnull=False
         )
-        if main_task_log_list:
-            self.pool_task.add_task(self.cancel_task_log, main_task_log_list)
+        yield self.cancel_task_log, main_task_log_list, dict()
 
-    def refresh_task_log(self):
+    def refresh_task_log(self, row_list=None):
         """
         Поиск изменений в сущности "Аудит выполнения задач"
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
         :return:
         """
-        task_log_list = TaskLogModel.objects.filter(
-            status_id__system_name="progress",
-            action_id__method_id__module_id__status=True).distinct()
-        if task_log_list:
-            self.pool_task.add_task(self.create_message, task_log_list)
+        self._enqueue_found(self._find_task_log(row_list))
 
-        task_log_list = TaskLogModel.objects.filter(
-            status_id__system_name="cancel",
-            command_log_list__status_id__system_name__in=["set", "progress"]
+    def _find_task_log(self, row_list=None):
+        """
+        Записи для обработчиков поиска изменений в сущности (см. refresh_task_log)
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
+        :return: генератор (обработчик, записи - QuerySet, именованные аргументы обработчика)
+        """
+        log_list = self._owned(TaskLogModel.objects.all())
+        main_task_log_list = self._owned(MainTaskLogModel.objects.all())
+        if row_list is not None:
+            if not row_list:
+                return
+            id_list = self._get_id_list(row_list)
+            log_list = log_list.filter(s_id__in=id_list)
+            main_task_log_list = main_task_log_list.filter(task_log_list__s_id__in=id_list)
+
+        task_log_list = log_list.filter(
+            status_id=self.reference.status_id("progress"),
+            action_id__in=self.reference.active_action_id_list()).distinct()
+        yield self.create_message, task_log_list, dict()
+
+        task_log_list = log_list.filter(
+            status_id=self.reference.status_id("cancel"),
+            command_log_list__status_id__in=self.reference.status_id_list("set", "progress")
         ).distinct()
-        if task_log_list:
-            self.pool_task.add_task(self.cancel_command_log, task_log_list)
+        yield self.cancel_command_log, task_log_list, dict()
 
-        main_task_log = MainTaskLogModel.objects.filter(
-            status_id__system_name="progress"
+        main_task_log = main_task_log_list.filter(
+            status_id=self.reference.status_id("progress")
         ).distinct()
-        if main_task_log:
-            self.pool_task.add_task(self.update_main_task_log, main_task_log)
+        yield self.update_main_task_log, main_task_log, dict()
 
-    def refresh_command_log(self):
+    def refresh_command_log(self, row_list=None):
         """
         Поиск изменений в сущности "Аудит выполнения команд"
-        :return: 
+
+        При указании списка измененных записей поиск производится только по данным записям
+        и по их родительским записям (записям из сущностей "Аудит выполнения команд" и "Аудит выполнения задач")
+
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
+        :return:
         """
-        command_log_list = CommandLogModel.objects.filter(status_id__system_name="progress").distinct()
-        if command_log_list:
-            self.pool_task.add_task(self.create_message, command_log_list, is_command=True)
+        self._enqueue_found(self._find_command_log(row_list))
 
-        command_log_list = CommandLogModel.objects.filter(
-            status_id__system_name="cancel", command_log_list__status_id__system_name__in=["set", "progress"]
+    def _find_command_log(self, row_list=None):
+        """
+        Записи для обработчиков поиска изменений в сущности (см. refresh_command_log)
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
+        :return: генератор (обработчик, записи - QuerySet, именованные аргументы обработчика)
+        """
+        log_list = self._owned(CommandLogModel.objects.all())
+        parent_log_list = self._owned(CommandLogModel.objects.all())
+        parent_task_log_list = self._owned(TaskLogModel.objects.all())
+        if row_list is not None:
+            if not row_list:
+                return
+            id_list = self._get_id_list(row_list)
+            log_list = log_list.filter(s_id__in=id_list)
+            parent_log_list = parent_log_list.filter(command_log_list__s_id__in=id_list)
+            parent_task_log_list = parent_task_log_list.filter(command_log_list__s_id__in=id_list)
+        status_set = self.reference.status_id("set")
+        status_progress = self.reference.status_id("progress")
+        status_error = self.reference.status_id("error")
+
+        command_log_list = log_list.filter(status_id=status_progress).distinct()
+        yield self.create_message, command_log_list, dict(is_command=True)
+
+        command_log_list = log_list.filter(
+            status_id=self.reference.status_id("cancel"), command_log_list__status_id__in=[status_set, status_progress]
         ).distinct()
-        if command_log_list:
-            self.pool_task.add_task(self.cancel_command_log, command_log_list, is_command=True)
-
-        command_log_list = CommandLogModel.objects.filter(
-            status_id__system_name="progress", command_log_list__status_id__system_name="set"
-        ).exclude(command_log_list__status_id__system_name="error").distinct()
-        if command_log_list:
-            self.pool_task.add_task(self.update_next_command_log, command_log_list, is_command=True)
-
-        task_log_list = TaskLogModel.objects.filter(
-            status_id__system_name="progress", command_log_list__status_id__system_name="set"
-        ).exclude(command_log_list__status_id__system_name="error").distinct()
-        if task_log_list:
-            self.pool_task.add_task(self.update_next_command_log, task_log_list, is_command=False)
-
-        command_log_list = CommandLogModel.objects.filter(
-            status_id__system_name="progress", command_id__command_list__isnull=False
+        yield self.cancel_command_log, command_log_list, dict(is_command=True)
+
+        command_log_list = parent_log_list.filter(
+            status_id=status_progress, command_log_list__status_id=status_set
+        ).exclude(command_log_list__status_id=status_error).distinct()
+        yield self.update_next_command_log, command_log_list, dict(is_command=True)
+
+        task_log_list = parent_task_log_list.filter(
+            status_id=status_progress, command_log_list__status_id=status_set
+        ).exclude(command_log_list__status_id=status_error).distinct()
+        yield self.update_next_command_log, task_log_list, dict(is_command=False)
+
+        command_log_list = parent_log_list.filter(
+            status_id=status_progress, command_id__command_list__isnull=False
         ).distinct()
-        if command_log_list:
-            self.pool_task.add_task(self.update_log, command_log_list, is_command=True)
+        yield self.update_log, command_log_list, dict(is_command=True)
 
-        task_log_list = TaskLogModel.objects.filter(
-            status_id__system_name="progress", action_id__command_list__isnull=False
+        task_log_list = parent_task_log_list.filter(
+            status_id=status_progress, action_id__command_list__isnull=False
         ).distinct()
-        if task_log_list:
-            self.pool_task.add_task(self.update_log, task_log_list)
+        yield self.update_log, task_log_list, dict()
 
-    def refresh_message(self):
+    def refresh_message(self, row_list=None):
         """
         Поиск изменений в сущности "Сообщения"
-        :return:
-        """
-        message_list = MessageModel.objects.filter(
-            Q(msg_type=MsgTypeChoice.task.value, status__isnull=True) |
-            Q(msg_type=MsgTypeChoice.connect.value, send_id=self.module, status__isnull=True)
-        )
-        if message_list:
-            self.pool_task.add_task(self.send_notify, message_list)
 
-        message_list = MessageModel.objects.filter(
-            msg_type=MsgTypeChoice.task.value, status=StatusSendChoice.sent.value, get_id=self.module
-        )
-        if message_list:
-            self.pool_task.add_task(self.create_command_log, message_list)
+        При указании списка измененных записей поиск производится только по данным записям,
+        а поиск для типов сообщений, которых нет среди измененных записей, не производится
 
-        message_list = MessageModel.objects.filter(
-            msg_type__in=[MsgTypeChoice.success.value, MsgTypeChoice.error.value],
-            get_id=self.module, status=StatusSendChoice.sent.value,
-            command_log_id__status_id__system_name="progress"
-        )
-        if message_list:
-            self.pool_task.add_task(self.update_command_log, message_list)
-
-        message_list = MessageModel.objects.filter(
-            msg_type__in=[MsgTypeChoice.success.value, MsgTypeChoice.error.value],
-            get_id=self.module, status=StatusSendChoice.sent.value,
-            task_log_id__status_id__system_name="progress", command_log_id__isnull=True
-        )
-        if message_list:
-            self.pool_task.add_task(self.update_task_log, message_list)
-
-        message_list = MessageModel.objects.filter(
-            msg_type__in=[MsgTypeChoice.info.value, MsgTypeChoice.warning.value], get_id=self.module,
-            status=StatusSendChoice.sent.value
-        )
-        if message_list:
-            self.pool_task.add_task(self.update_message, message_list)
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
+        :return:
+        """
+        self._enqueue_found(self._find_message(row_list))
 
-        message_list = MessageModel.objects.filter(
-            msg_type=MsgTypeChoice.connect.value, get_id=self.module, status=StatusSendChoice.sent.value
-        )
-        if message_list:
-            self.pool_task.add_task(self.restart_log, message_list)
+    def _find_message(self, row_list=None):
+        """
+        Записи для обработчиков поиска изменений в сущности (см. refresh_message)
+        :param row_list: список измененных записей (если None - поиск по всей сущности)
+        :return: генератор (обработчик, записи - QuerySet, именованные аргументы обработчика)
+        """
+        all_message_list = self._owned(MessageModel.objects.all())
+        if row_list is not None:
+            if not row_list:
+                return
+            all_message_list = all_message_list.filter(s_id__in=self._get_id_list(row_list))
+
+        if self._is_msg_type(row_list, MsgTypeChoice.task.value, MsgTypeChoice.connect.value):
+            message_list = all_message_list.filter(
+                Q(msg_type=MsgTypeChoice.task.value, status__isnull=True) |
+                Q(msg_type=MsgTypeChoice.connect.value, send_id=self.module, status__isnull=True)
+            )
+            yield self.send_notify, message_list, dict()
+
+        if self._is_msg_type(row_list, MsgTypeChoice.task.value):
+            message_list = all_message_list.filter(
+                msg_type=MsgTypeChoice.task.value, status=StatusSendChoice.sent.value, get_id=self.module
+            )
+            yield self.create_command_log, message_list, dict()
+
+        if self._is_msg_type(row_list, MsgTypeChoice.success.value, MsgTypeChoice.error.value):
+            message_list = all_message_list.filter(
+                msg_type__in=[MsgTypeChoice.success.value, MsgTypeChoice.error.value],
+                get_id=self.module, status=StatusSendChoice.sent.value,
+                command_log_id__status_id=self.reference.status_id("progress")
+            )
+            yield self.update_command_log, message_list, dict()
+
+            message_list = all_message_list.filter(
+                msg_type__in=[MsgTypeChoice.success.value, MsgTypeChoice.error.value],
+                get_id=self.module, status=StatusSendChoice.sent.value,
+                task_log_id__status_id=self.reference.status_id("progress"), command_log_id__isnull=True
+            )
+            yield self.update_task_log, message_list, dict()
+
+        if self._is_msg_type(row_list, MsgTypeChoice.info.value, MsgTypeChoice.warning.value):
+            message_list = all_message_list.filter(
+                msg_type__in=[MsgTypeChoice.info.value, MsgTypeChoice.warning.value], get_id=self.module,
+                status=StatusSendChoice.sent.value
+            )
+            yield self.update_message, message_list, dict()
+
+        if self._is_msg_type(row_list, MsgTypeChoice.connect.value):
+            message_list = all_message_list.filter(
+                msg_type=MsgTypeChoice.connect.value, get_id=self.module, status=StatusSendChoice.sent.value
+            )
+            yield self.restart_log, message_list, dict()
 
     def create_task_log(self, main_task_log_list):
         """
         Постановка задач в сущности "Аудит выполнения задач" на основе базовой задачи
+
+        Алгоритм (в одной транзакции):
+         - блокировка базовых задач в статусе "Выполняется" без задач (FOR UPDATE SKIP LOCKED)
+         - получение планов базовых задач из кэша планов (без запросов к структуре задач)
+         - загрузка задач всех базовых задач через COPY: первая задача в статусе "Выполняется", остальные - "Поставлена"
+         - заполнение текущей задачи базовых задач одним запросом
+
         :param main_task_log_list: список задач из сущности "Аудит выполнения базовых задач"
-        :return:
+        :return: количество созданных задач
         """
-        status_set = StatusTaskModel.objects.get(system_name="set")
-        status_progress = StatusTaskModel.objects.get(system_name="progress")
-        for main_task_log in main_task_log_list:
+        main_task_log_id_list = [str(main_task_log.s_id) for main_task_log in main_task_log_list]
+        if not main_task_log_id_list:
+            return 0
+        status_set = self.reference.status_id("set")
+        status_progress = self.reference.status_id("progress")
+
+        cursor = self.cursor
+        with transaction(cursor):
+            cursor.execute(self._main_task_log_query, {"log_id_list": main_task_log_id_list,
+                                                       "progress": status_progress})
+            main_task_log_list = cursor.fetchall()
+            if not main_task_log_list:
+                return 0
+            plan_dict = self.task_plan.plan_dict([base_task_id for _, base_task_id in main_task_log_list])
+
             task_log_list = list()
-            task_sequence_list = TaskSequenceModel.objects.filter(
-                template_task_id=main_task_log.template_task_id).order_by("number")
-            if task_sequence_list:
-                for task_sequence in task_sequence_list:
-                    action_list = ActionModel.objects.filter(task_id=task_sequence.task_id).order_by("number")
-                    if action_list:
-                        for action in action_list:
-                            data = TaskLogModel(main_task_log_id=main_task_log, action_id=action, status_id=status_set)
-                            task_log_list.append(data)
-            if task_log_list:
-                task_log_list[0].status_id = status_progress
-                TaskLogModel.objects.bulk_create(task_log_list)
-            current_task = TaskLogModel.objects.filter(main_task_log_id=main_task_log, status_id=status_progress).last()
-            if current_task:
-                main_task_log.current_task_id = current_task
-                main_task_log.save()
+            current_list = list()
+            for main_task_log_id, base_task_id in main_task_log_list:
+                for number, action in enumerate(plan_dict[str(base_task_id)]):
+                    task_log_id = uuid.uuid4()
+                    task_log_list.append((task_log_id, main_task_log_id, action.s_id,
+                                          status_progress if number == 0 else status_set))
+                    if number == 0:
+                        current_list.append((str(main_task_log_id), str(task_log_id)))
+            copy_rows(cursor, "manager.task_log", ["s_id", "main_task_log_id", "action_id", "status_id"],
+                      task_log_list)
+            if current_list:
+                cursor.execute(self._current_task_query, {"main_task_log_id_list": [item[0] for item in current_list],
+                                                          "task_log_id_list": [item[1] for item in current_list]})
+        return len(task_log_list)
 
     def cancel_task_log(self, main_task_log_list):
         """
         Отмена поставленных задач в сущности "Аудит выполнения задач"
-        :param main_task_log_list: списокй записей из сущности "Аудит выполнения базовых задач"
-        :return:
+
+        Выполняется одним запросом: отмена задач в статусе "Поставлена" для всех базовых задач
+        и отмена поставленных команд этих задач (см. _cancel_command_log_query)
+
+        :param main_task_log_list: список записей из сущности "Аудит выполнения базовых задач"
+        :return: количество отмененных задач и команд
         """
-        status = StatusTaskModel.objects.get(system_name="cancel")
-        task_log_list = TaskLogModel.objects.filter(main_task_log_id__in=main_task_log_list,
-                                                    status_id__system_name="set")
-        task_log_list.update(status_id=status)
+        return self._cancel_log(main_task_log_list, "main_task_log")
 
     def create_message(self, log_list, is_command=False, is_restart=False):
         """
         Создание записей в сущности "Сообщения" (Задача или Подключение)
+
+        Выполняется одним запросом для всего списка записей:
+         - отбор записей без дочерних записей в сущности "Аудит выполнения команд"
+         - поиск последних сообщений об успешном выполнении и об ошибке для каждой записи (DISTINCT ON)
+         - блокировка отобранных записей (FOR UPDATE SKIP LOCKED): записи, которые обрабатывает
+           другой поток или другой экземпляр менеджера задач, пропускаются
+         - создание сообщений с типом "Задача" для записей, у которых нет сообщения об успешном выполнении
+           или последнее сообщение об ошибке новее, если служба, выполняющая метод, работоспособна
+           и нет отправленной задачи без ответа (кроме перезапуска)
+         - изменение статуса выполнения отобранных записей на "Выполняется"
+
         :param log_list: список записей из сущностей "Аудит выполнения задач" или "Аудит выполнения команд"
         :param is_command: признак того, что записи из сущности "Аудит выполнения команд"
         :param is_restart: признак перезапуска
-        :return:
+        :return: количество созданных сообщений
         """
-        status = StatusTaskModel.objects.get(system_name="progress")
-        for log_item in log_list:
-            is_new = False
-            if is_command:
-                s_message = MessageModel.objects.filter(task_log_id=log_item.task_log_id, command_log_id=log_item,
-                                                        msg_type=MsgTypeChoice.success.value).order_by("-date_created")
-                e_message = MessageModel.objects.filter(task_log_id=log_item.task_log_id, command_log_id=log_item,
-                                                        msg_type=MsgTypeChoice.error.value).order_by("-date_created")
-                command_log_list = CommandLogModel.objects.filter(task_log_id=log_item.task_log_id, parent_id=log_item)
-            else:
-                s_message = MessageModel.objects.filter(task_log_id=log_item, command_log_id__isnull=True,
-                                                        msg_type=MsgTypeChoice.success.value).order_by("-date_created")
-                e_message = MessageModel.objects.filter(task_log_id=log_item, command_log_id__isnull=True,
-                                                        msg_type=MsgTypeChoice.error.value).order_by("-date_created")
-                command_log_list = CommandLogModel.objects.filter(task_log_id=log_item)
-
-            s_message = s_message.first() if s_message else None
-            e_message = e_message.first() if e_message else None
-
-            if not command_log_list:
-                if s_message and e_message and s_message.date_created < e_message.date_created:
-                    is_new = True
-                elif not s_message:
-                    is_new = True
-
-                if is_new:
-                    method = log_item.action_id.method_id if not is_command else log_item.command_id.method_id
-                    if method.module_id.status:
-                        s_id = uuid.uuid4()
-                        post_data = {
-                            "s_id": s_id,
-                            "send_id": self.module,
-                            "get_id": method.module_id,
-                            "date_created": datetime.now(),
-                            "status": None,
-                            "msg_type": MsgTypeChoice.task.value,
-                            "parent_msg_id": None,
-                            "task_log_id": log_item if not is_command else log_item.task_log_id,
-                            "command_log_id": log_item if is_command else None,
-                            "data": {
-                                "task_id": str(s_id),
-                                "msg_type": MsgTypeChoice.task.value,
-                                "method": method.system_name
-                            }
-                        }
-                        MessageModel.objects.create(**post_data)
-                if log_item.status_id != status:
-                    log_item.status_id = status
-                    log_item.save()
+        log_id_list = [str(log_item.s_id) for log_item in log_list]
+        if not log_id_list:
+            return 0
+        cursor = self.cursor
+        cursor.execute(self._create_message_query.format(**self._create_message_part[is_command]), {
+            "log_id_list": log_id_list,
+            "status_id": self.reference.status_id("progress"),
+            "send_id": str(self.module.s_id),
+            "task": MsgTypeChoice.task.value,
+            "success": MsgTypeChoice.success.value,
+            "error": MsgTypeChoice.error.value,
+            "is_restart": is_restart,
+        })
+        message_count, log_count = cursor.fetchone()
+        return message_count
 
     def update_main_task_log(self, main_task_log_list):
         """
         Обновление статуса выполнения задач в сущности "Аудит выполнения базовых задач"
+
+        Выполняется одним запросом для всего списка записей (см. update_log): если среди задач есть
+        задача с ошибкой, то статус "Ошибка выполнения", если все задачи выполнены, то статус "Выполнена",
+        дата и время окончания выполнения и очистка текущей задачи
+
         :param main_task_log_list: список записей из сущности "Аудит выполнения базовых задач"
-        :return:
+        :return: список идентификаторов измененных записей
         """
-        f_status = StatusTaskModel.objects.get(system_name="finish")
-        e_status = StatusTaskModel.objects.get(system_name="error")
-        for main_task_log in main_task_log_list:
-            e_command_log_list = TaskLogModel.objects.filter(main_task_log_id=main_task_log, status_id=e_status)
-            not_command_log_list = TaskLogModel.objects.filter(
-                Q(main_task_log_id=main_task_log) & ~Q(status_id=f_status))
-            if e_command_log_list:
-                main_task_log.status_id = e_status
-                main_task_log.save()
-            elif not not_command_log_list:
-                main_task_log.status_id = f_status
-                main_task_log.end_task_date = datetime.now()
-                main_task_log.current_task_id = None
-                main_task_log.save()
+        return self._update_log(main_task_log_list, "main_task_log")
 
     def cancel_command_log(self, log_list, is_command=False):
         """
         Отмена поставленных команд в сущности "Аудит выполнения команд"
+
+        Выполняется одним рекурсивным запросом по дереву команд для всего списка записей
+        (см. _cancel_command_log_query)
+
         :param log_list: список записей из аудита выполнения
         :param is_command: признак того, что данные из сущности "Аудит выполнения команд"
-        :return:
+        :return: количество отмененных команд
+        """
+        return self._cancel_log(log_list, "command_log" if is_command else "task_log")
+
+    def _cancel_log(self, log_list, table: str) -> int:
+        """
+        Отмена поставленных записей одним запросом
+        :param log_list: список записей, для которых отменяются дочерние записи
+        :param table: наименование сущности записей из списка
+        :return: количество отмененных записей
         """
-        status = StatusTaskModel.objects.get(system_name="cancel")
-        for log_item in log_list:
-            command_log_list = log_item.command_log_list.filter(status_id__system_name="set")
-            command_log_list.update(status_id=status)
-            command_log_list = log_item.command_log_list.filter(
-                status_id__system_name="progress", command_log_list__status_id__system_name="set")
-            if command_log_list:
-                self.cancel_command_log(command_log_list, is_command=True)
+        log_id_list = [str(log_item.s_id) for log_item in log_list]
+        if not log_id_list:
+            return 0
+        cursor = self.cursor
+        cursor.execute(self._cancel_command_log_query.format(**self._cancel_command_log_part[table]), {
+            "log_id_list": log_id_list,
+            "set": self.reference.status_id("set"),
+            "progress": self.reference.status_id("progress"),
+            "cancel": self.reference.status_id("cancel"),
+        })
+        return cursor.fetchone()[0]
 
     def update_next_command_log(self, log_list, is_command=False):
         """
         Обновление следующих команд из сущности «Аудит выполнения команд»
+
+        Выполняется одним запросом для всего списка записей:
+         - блокировка записей (FOR UPDATE SKIP LOCKED)
+         - поиск номера последней выполненной дочерней команды для каждой записи
+           (для задачи - среди команд верхнего уровня)
+         - изменение статуса дочерних последовательных команд со следующим номером
+           и статусом "Поставлена" на "Выполняется"
+
         :param log_list: список записей из аудита выполнения
         :param is_command: признак того, что данные из сущности "Аудит выполнения команд"
-        :return:
+        :return: список идентификаторов команд, переведенных в статус "Выполняется"
         """
-        status = StatusTaskModel.objects.get(system_name="progress")
-        for log_item in log_list:
-            command_log = log_item.command_log_list.filter(
-                status_id__system_name="finish").order_by("command_id__number").last()
-            if command_log:
-                if is_command:
-                    next_command_log_list = CommandLogModel.objects.filter(
-                        task_log_id=log_item.task_log_id, parent_id=log_item, status_id__system_name="set",
-                        command_id__is_parallel=False, command_id__number=command_log.command_id.number + 1)
-                else:
-                    next_command_log_list = CommandLogModel.objects.filter(
-                        task_log_id=log_item, command_id__is_parallel=False, status_id__system_name="set",
-                        command_id__number=command_log.command_id.number + 1)
-                if next_command_log_list:
-                    for next_command_log in next_command_log_list:
-                        next_command_log.status_id = status
-                        next_command_log.save()
+        log_id_list = [str(log_item.s_id) for log_item in log_list]
+        if not log_id_list:
+            return []
+        cursor = self.cursor
+        cursor.execute(self._update_next_command_log_query.format(**self._update_next_command_log_part[is_command]), {
+            "log_id_list": log_id_list,
+            "set": self.reference.status_id("set"),
+            "progress": self.reference.status_id("progress"),
+            "finish": self.reference.status_id("finish"),
+        })
+        return [row[0] for row in cursor.fetchall()]
 
     def update_log(self, log_list, is_command=False):
         """
         Обновление статуса выполнения задачи в сущностях «Аудит выполнения задач»
         или "Аудит выполнения команд"
+
+        Выполняется одним запросом для всего списка записей (см. _update_log): если среди дочерних команд
+        есть команда с ошибкой, то статус "Ошибка выполнения", если все дочерние команды выполнены,
+        то статус "Выполнена"
+
         :param log_list: список записей из сущностей "Аудит выполнения задач" или "Аудит выполнения команд"
         :param is_command: признак того, что данные из сущности "Аудит выполнения команд"
-        :return:
+        :return: список идентификаторов измененных записей
         """
-        f_status = StatusTaskModel.objects.get(system_name="finish")
-        e_status = StatusTaskModel.objects.get(system_name="error")
-        for log in log_list:
-            if is_command:
-                command_log_list = CommandLogModel.objects.filter(parent_id=log)
-            else:
-                command_log_list = CommandLogModel.objects.filter(task_log_id=log)
-            if command_log_list:
-                e_command_log_list = command_log_list.filter(status_id=e_status)
-                not_command_log_list = command_log_list.filter(~Q(status_id=f_status))
-                if e_command_log_list:
-                    log.status_id = e_status
-                    log.save()
-                elif not not_command_log_list:
-                    log.status_id = f_status
-                    log.save()
+        return self._update_log(log_list, "command_log" if is_command else "task_log")
+
+    def _update_log(self, log_list, table: str) -> list:
+        """
+        Обновление статуса выполнения родительских записей по статусам дочерних записей
+
+        Алгоритм (один запрос UPDATE ... FROM):
+         - блокировка записей (FOR UPDATE SKIP LOCKED): записи, которые обрабатывает другой поток
+           или другой экземпляр менеджера задач, пропускаются
+         - подсчет дочерних записей с ошибкой и невыполненных дочерних записей для каждой записи (GROUP BY)
+         - изменение статуса записей, у которых есть дочерние записи с ошибкой или все дочерние записи выполнены
+           (записи без дочерних записей не изменяются)
+
+        :param log_list: список родительских записей
+        :param table: наименование сущности родительских записей (ключ _update_log_part)
+        :return: список идентификаторов измененных записей
+        """
+        log_id_list = [str(log_item.s_id) for log_item in log_list]
+        if not log_id_list:
+            return []
+        cursor = self.cursor
+        cursor.execute(self._update_log_query.format(**self._update_log_part[table]), {
+            "log_id_list": log_id_list,
+            "finish": self.reference.status_id("finish"),
+            "error": self.reference.status_id("error"),
+        })
+        return [row[0] for row in cursor.fetchall()]
 
     @message_wrapper
     def send_notify(self, message_list, *args, **kwargs):
@@ -434,14 +1090,58 @@ class TaskSVC(BaseSVC):
 
         Алгоритм:
          - изменение статуса отправки для всех записей на "Отправлено"
-         - для каждой записи: генерация pg_notify с данными из атрибута "Данные сообщения" (data)
+         - для задачи службе, у которой есть экземпляры: выбор работоспособного экземпляра (см. InstanceDispatcher)
+           и сохранение экземпляра в сообщении (один запрос на экземпляр); если работоспособных экземпляров нет,
+           задача не отправляется - ее повторно отправит восстановление службы (см. restart_module)
+         - задачи одной группы пакетного выполнения (ключ batch в данных сообщения) объединяются
+           по _batch_size задач: службе отправляется один notify с данными первой задачи и списком
+           задач группы (task_id_list)
+         - для каждой записи (группы): генерация pg_notify с данными из атрибута "Данные сообщения" (data)
+           в канал экземпляра или в канал службы после фиксации транзакции обработчика (служба не получит
+           задачу, статус которой еще не зафиксирован или будет откачен)
 
         :param message_list: список записей из сущности "Сообщения", для которых необходимо сгенерировать notify
         :return:
         """
+        group_dict = dict()
         for message in message_list:
-            data = json.dumps(message.data).replace("'", "\'")
-            self.cursor.execute(self._notify_query.format(message.get_id.channel_name, data))
+            batch = message.data.get("batch") if message.msg_type == MsgTypeChoice.task.value else None
+            group_dict.setdefault((message.get_id_id, batch) if batch else message.s_id, list()).append(message)
+
+        notify_list = list()
+        instance_dict = dict()
+        for group in group_dict.values():
+            for start in range(0, len(group), self._batch_size):
+                batch_list = group[start:start + self._batch_size]
+                message = batch_list[0]
+                channel_name = self.reference.module(message.get_id_id)["channel_name"]
+                if message.msg_type == MsgTypeChoice.task.value and self.dispatcher.has_instance(message.get_id_id):
+                    instance = self.dispatcher.choose(message.get_id_id, message.s_id, key=message.task_log_id_id)
+                    if instance is None:
+                        continue
+                    for batch_message in batch_list[1:]:
+                        self.dispatcher.assign(batch_message.s_id, instance["s_id"])
+                    channel_name = instance["channel_name"]
+                    instance_dict.setdefault(instance["s_id"], list()).extend(
+                        batch_message.s_id for batch_message in batch_list)
+                data = dict(message.data)
+                if len(batch_list) > 1:
+                    data["task_id_list"] = [str(batch_message.s_id) for batch_message in batch_list]
+                notify_list.append((channel_name, json.dumps(data).replace("'", "\'")))
+        for instance_id, id_list in instance_dict.items():
+            MessageModel.objects.filter(s_id__in=id_list).update(instance_id=instance_id)
+        if notify_list:
+            on_commit(partial(self._send_notify_list, notify_list))
+
+    def _send_notify_list(self, notify_list: list) -> None:
+        """
+        Генерация pg_notify для списка уведомлений
+        :param notify_list: список пар (канал, данные)
+        :return:
+        """
+        cursor = self.cursor
+        for channel_name, data in notify_list:
+            cursor.execute(self._notify_query.format(channel_name, data))
 
     @message_wrapper
     def update_message(self, message_list, *args, **kwargs):
@@ -456,42 +1156,52 @@ class TaskSVC(BaseSVC):
     def create_command_log(self, message_list, *args, **kwargs):
         """
         Создание структуры команд в сущности "Аудит выполнения команд"
+
+        Алгоритм:
+         - получение команд для всех сообщений одним запросом (по операции задачи, службе-отправителю
+           и списку методов из сообщения)
+         - формирование записей для сущностей "Аудит выполнения команд" и "Связь Аудита выполнения команд
+           с записью объекта" с идентификаторами, сгенерированными на стороне службы, и начальным статусом:
+           "Выполняется" для параллельных команд или первой из последовательных, иначе "Поставлена"
+         - загрузка записей обеих сущностей через COPY в транзакции обработчика (через подключение Django,
+           вместе с изменением статуса сообщений): при откате транзакции команды не создаются, и повторная
+           обработка сообщений не дублирует их
+
         :param message_list: список записей из сущности "Сообщения"
         :return:
         """
-        status_set = StatusTaskModel.objects.get(system_name="set")
-        status_progress = StatusTaskModel.objects.get(system_name="progress")
+        message_list = [message for message in message_list
+                        if message.data.get("method_list", None) and message.data.get("object_list", None)]
+        if not message_list:
+            return
+        status_set = self.reference.status_id("set")
+        status_progress = self.reference.status_id("progress")
+
+        cursor = self.atomic_cursor
+        cursor.execute(self._command_query, {"message_id_list": [str(message.s_id) for message in message_list]})
+        command_dict = dict()
+        for message_id, method, command_id, is_parallel in cursor.fetchall():
+            command_dict[(str(message_id), method)] = (command_id, is_parallel)
+
+        command_log_list = list()
+        object_list = list()
         for message in message_list:
-            method_list = message.data.get("method_list", None)
-            object_list = message.data.get("object_list", None)
-            command_list = list()
-            is_parallel = True
-            if method_list and object_list:
-                for method in method_list:
-                    try:
-                        command = CommandModel.objects.get(
-                            method_id__system_name=method, method_id__module_id=message.send_id,
-                            action_id=message.task_log_id.action_id
-                        )
-                        is_parallel = is_parallel and command.is_parallel
-                        command_list.append(command)
-                    except CommandModel.DoesNotExist:
-                        pass
-
-            if command_list:
-                is_first = True
-                for command in command_list:
-                    for instance in object_list:
-                        command_log = CommandLogModel.objects.create(
-                            task_log_id=message.task_log_id, parent_id=message.command_log_id,
-                            command_id=command, status_id=status_set
-                        )
-                        ObjectToCommandLogModel.objects.create(
-                            command_log_id=command_log, object_id=uuid.UUID(instance))
-                        if is_parallel or (not is_parallel and is_first):
-                            command_log.status_id = status_progress
-                            command_log.save()
-                    is_first = False
+            command_list = [command_dict[(str(message.s_id), method)] for method in message.data["method_list"]
+                            if (str(message.s_id), method) in command_dict]
+            is_parallel = all(command_is_parallel for _, command_is_parallel in command_list)
+            for number, (command_id, _) in enumerate(command_list):
+                status = status_progress if is_parallel or number == 0 else status_set
+                for instance in message.data["object_list"]:
+                    command_log_id = uuid.uuid4()
+                    command_log_list.append(
+                        (command_log_id, message.task_log_id_id, message.command_log_id_id, command_id, status))
+                    object_list.append((uuid.uuid4(), command_log_id, uuid.UUID(instance)))
+
+        with atomic():
+            copy_rows(cursor, "manager.command_log",
+                      ["s_id", "task_log_id", "parent_id", "command_id", "status_id"], command_log_list)
+            copy_rows(cursor, "manager.object_to_command_log",
+                      ["s_id", "command_log_id", "object_id"], object_list)
 
     @message_wrapper
     def update_command_log(self, message_list, *args, **kwargs):
@@ -501,12 +1211,13 @@ class TaskSVC(BaseSVC):
         :return:
         """
         status_dict = {
-            MsgTypeChoice.success.value: StatusTaskModel.objects.get(system_name="finish"),
-            MsgTypeChoice.error.value: StatusTaskModel.objects.get(system_name="error")
+            MsgTypeChoice.success.value: self.reference.status_id("finish"),
+            MsgTypeChoice.error.value: self.reference.status_id("error")
         }
         for message in message_list:
-            message.command_log_id.status_id = status_dict[message.msg_type]
+            message.command_log_id.status_id_id = status_dict[message.msg_type]
             message.command_log_id.save()
+        self.dispatcher.release([message.parent_msg_id_id for message in message_list])
 
     @message_wrapper
     def update_task_log(self, message_list, *args, **kwargs):
@@ -516,103 +1227,240 @@ class TaskSVC(BaseSVC):
         :return:
         """
         status_dict = {
-            MsgTypeChoice.success.value: StatusTaskModel.objects.get(system_name="finish"),
-            MsgTypeChoice.error.value: StatusTaskModel.objects.get(system_name="error")
+            MsgTypeChoice.success.value: self.reference.status_id("finish"),
+            MsgTypeChoice.error.value: self.reference.status_id("error")
         }
         for message in message_list:
-            message.task_log_id.status_id = status_dict[message.msg_type]
+            message.task_log_id.status_id_id = status_dict[message.msg_type]
             message.task_log_id.save()
+        self.dispatcher.release([message.parent_msg_id_id for message in message_list])
 
     @message_wrapper
     def restart_log(self, message_list, *args, **kwargs):
         """
         Перезапуск задач
+        (служба прислала сообщение о подключении: статус службы изменяется на работоспособный,
+        для служб, статус которых изменился, запускается восстановление - см. set_module_status)
         :param message_list: список записей из сущности "Сообщения"
         :return:
         """
-        send_list = list()
-        for message in message_list:
-            if message.send_id not in send_list and not message.send_id.status:
-                send_list.append(message.send_id)
-                message.send_id.status = True
-                message.send_id.save()
-        # send_list = ModuleModel.objects.filter(get_message_list__in=message_list).distinct()
-        method_list = MethodModuleModel.objects.filter(module_id__in=send_list, action_list__isnull=False).distinct()
-        if method_list:
-            task_log_list = TaskLogModel.objects.filter(
-                status_id__system_name="progress",
-                action_id__method_id__in=method_list,
-                command_log_list__isnull=True
-            ).distinct()
-            self.create_message(task_log_list, is_restart=True)
-
-        method_list = MethodModuleModel.objects.filter(module_id__in=send_list, command_list__isnull=False).distinct()
-        if method_list:
-            command_log_list = CommandLogModel.objects.filter(
-                status_id__system_name="progress",
-                command_id__method_id__in=method_list,
-                command_log_list__isnull=True
-            ).distinct()
-            self.create_message(command_log_list, is_command=True, is_restart=True)
-
-    def period_task(self):
-        """
-        Периодическая задача (открытый метод)
-
-        Открытый метод в базовом классе вызывается в основном потоке,
-        поэтому метод меняет время последнего вызова периодической задачи
-        и добавляет периодическую задачу в очередь на выполнение
+        self.set_module_status({str(message.send_id_id): True for message in message_list})
+
+    def restart_module(self, module_id_list: list) -> int:
+        """
+        Запуск восстановления служб
+
+        Алгоритм:
+         - поиск задач и команд в статусе "Выполняется" без дочерних команд, методы которых выполняют
+           службы, одним запросом для всех служб
+         - запуск задания восстановления для каждой службы: записи повторно отправляются пачками
+           с ограничением скорости (см. RecoveryEngine)
+
+        :param module_id_list: список идентификаторов служб
+        :return: количество записей для повторной отправки
+        """
+        cursor = self.cursor
+        cursor.execute(self._recovery_query, {"module_id_list": [str(s_id) for s_id in module_id_list],
+                                              "progress": self.reference.status_id("progress")})
+        job_dict = {str(s_id): list() for s_id in module_id_list}
+        row_list = cursor.fetchall()
+        for module_id, is_command, log_id in row_list:
+            job_dict[str(module_id)].append((is_command, log_id))
+        for module_id, item_list in job_dict.items():
+            self.recovery.start(module_id, item_list)
+        return len(row_list)
+
+    def _dispatch_recovery(self, module_id: str, item_list: list) -> None:
+        """
+        Постановка в очередь повторной отправки пачки записей (вызывается движком восстановления)
+        :param module_id: идентификатор службы
+        :param item_list: список записей (признак команды, идентификатор записи)
+        :return:
+        """
+        self.pool_task.put_task(self.recover_log, (item_list,), priority=PRIORITY_DISPATCH, key=module_id)
+
+    def recover_log(self, item_list: list) -> int:
+        """
+        Повторная отправка пачки задач и команд
+        :param item_list: список записей (признак команды, идентификатор записи)
+        :return: количество созданных сообщений
+        """
+        message_count = 0
+        for is_command in (False, True):
+            log_list = [LogItem(log_id) for item_is_command, log_id in item_list if item_is_command == is_command]
+            if log_list:
+                message_count += self.create_message(log_list, is_command=is_command, is_restart=True)
+        return message_count
+
+    def recovery_stats(self) -> dict:
+        """
+        Ход выполнения восстановления служб
+        :return: словарь {идентификатор службы: статистика задания восстановления}
+        """
+        return self.recovery.stats()
+
+    def dispatch_stats(self) -> dict:
+        """
+        Загрузка экземпляров служб (неотвеченные задачи по экземплярам)
+        :return: статистика диспетчера
+        """
+        return self.dispatcher.stats()
+
+    def _outstanding_list(self) -> list:
+        """
+        Неотвеченные задачи экземпляров служб из базы данных
+        :return: список пар (идентификатор задачи, идентификатор экземпляра службы)
+        """
+        cursor = self.cursor
+        cursor.execute(self._outstanding_query, {"task": MsgTypeChoice.task.value,
+                                                 "success": MsgTypeChoice.success.value,
+                                                 "error": MsgTypeChoice.error.value})
+        return cursor.fetchall()
 
+    def sync_dispatch(self) -> None:
+        """
+        Сверка неотвеченных задач диспетчера с базой данных (в режиме нескольких экземпляров)
+
+        Задачу экземпляру службы отправляет владелец секции сообщения задачи, а ответ обрабатывает владелец
+        секции сообщения ответа, поэтому задачи, ответ на которые обработал другой экземпляр менеджера задач,
+        освобождаются только сверкой. Сверка также учитывает задачи, отправленные другими экземплярами
+        менеджера задач (загрузка экземпляров служб общая).
         :return:
         """
-        self.ldt = datetime.now()
-        self.pool_task.add_task(self._period_task)
+        if not self.dispatcher.begin_sync():
+            return
+        try:
+            task_list = self._outstanding_list()
+        except Exception:
+            self.dispatcher.cancel_sync()
+            raise
+        self.dispatcher.resync(task_list)
 
-    def _period_task(self):
+    def _on_heartbeat_change(self, status_dict: dict) -> None:
         """
-        Периодическая задача
+        Постановка в очередь изменения статусов экземпляров служб (вызывается монитором работоспособности)
+        (на каждом экземпляре менеджера задач; изменения в базе данных выполняет только ведущий экземпляр)
+        :param status_dict: словарь {идентификатор экземпляра службы: признак работоспособности}
         :return:
         """
-        module_list = ModuleModel.objects.all().exclude(s_id=self.module.s_id)
-        post_data = {
-            "send_id": self.module,
-            "date_created": datetime.now(),
-            "status": None,
-            "msg_type": MsgTypeChoice.connect.value,
-            "parent_msg_id": None,
-            "task_log_id": None
-        }
-        for module in module_list:
-            is_need_connect = True
-            if module.status:
-                # Если есть запрос на подключение без ответов
-                # (то есть прошло period_time минут с последнего запуска периодической задачи),
-                # то сообщение необходимо отправить снова
-                message_list = MessageModel.objects.filter(
-                    get_id=module, send_id=self.module, msg_type=MsgTypeChoice.connect.value, child_list__isnull=True
-                )
-                if message_list:
-                    module.status = False
-                    module.save()
-                    # TODO возможно тут сделать команду на перезапуск службы и тогда снова коннект отправлять не надо
-                else:
-                    # Если есть ответные сообщения о подключении, то проверяем, как давно он был отправлен
-                    # Если давно (то есть прошло period_time времени), то сообщение отправлем снова
-                    # Нужно для того, чтобы проверять, что службы работают
-                    message_list = MessageModel.objects.filter(
-                        get_id=self.module, send_id=module, msg_type=MsgTypeChoice.connect.value
-                    )
-                    if message_list:
-                        last_answer = message_list.order_by("date_created").last()
-                        if last_answer and (last_answer.date_created - datetime.now()).seconds < PERIOD_TIME * 60:
-                            is_need_connect = False
-
-            if is_need_connect:
-                s_id = uuid.uuid4()
-                post_data["s_id"] = s_id
-                post_data["get_id"] = module
-                post_data["data"] = {"task_id": str(s_id), "msg_type": MsgTypeChoice.connect.value}
-                MessageModel.objects.create(**post_data)
+        self.pool_task.put_task(self.set_instance_status, (status_dict,), priority=PRIORITY_HEARTBEAT)
+
+    def set_instance_status(self, status_dict: dict) -> list:
+        """
+        Изменение статусов экземпляров служб
+
+        Алгоритм:
+         - проверка экземпляров, которые стали неработоспособными, по времени последнего сигнала в базе данных
+           (см. _confirm_dead)
+         - изменение признака работоспособности экземпляров в диспетчере (на каждом экземпляре менеджера задач)
+         - только ведущим экземпляром менеджера задач:
+            - переназначение неотвеченных задач экземпляров, которые стали неработоспособными (одним запросом)
+            - изменение статусов служб: служба работоспособна, если работоспособен хотя бы один ее экземпляр
+              (см. set_module_status)
+
+        :param status_dict: словарь {идентификатор экземпляра службы: признак работоспособности}
+        :return: список идентификаторов переназначенных сообщений
+        """
+        status_dict = self._confirm_dead(status_dict)
+        if not status_dict:
+            return []
+        dead_list = list()
+        for instance_id, is_alive in status_dict.items():
+            self.dispatcher.set_alive(instance_id, is_alive)
+            if not is_alive:
+                dead_list.append(instance_id)
+        if not self.is_leader:
+            return []
+        message_id_list = list()
+        if dead_list:
+            cursor = self.cursor
+            cursor.execute(self._reassign_query, {"instance_id_list": dead_list, "task": MsgTypeChoice.task.value,
+                                                  "success": MsgTypeChoice.success.value,
+                                                  "error": MsgTypeChoice.error.value})
+            message_id_list = [row[0] for row in cursor.fetchall()]
+        module_id_set = {self._instance_module.get(instance_id, instance_id) for instance_id in status_dict}
+        module_dict = {module_id: False for module_id in module_id_set}
+        for instance_id, is_alive in self.heartbeat.state().items():
+            module_id = self._instance_module.get(instance_id, instance_id)
+            if is_alive and status_dict.get(instance_id, True) and module_id in module_dict:
+                module_dict[module_id] = True
+        self.set_module_status(module_dict)
+        return message_id_list
+
+    def _confirm_dead(self, status_dict: dict) -> dict:
+        """
+        Проверка неработоспособности экземпляров служб по времени последнего сигнала в базе данных
+
+        Сигналы поступают в монитор через поток подписки: если поток был занят (например, долгим запросом),
+        время сигнала в мониторе устаревает, хотя экземпляр работоспособен. Экземпляры, сигнал которых
+        в базе данных не старше HEARTBEAT_TIMEOUT, подтверждаются в мониторе как работоспособные
+        и исключаются из изменений.
+
+        :param status_dict: словарь {идентификатор экземпляра службы: признак работоспособности}
+        :return: словарь изменений без экземпляров, работоспособность которых подтверждена
+        """
+        dead_list = [instance_id for instance_id, is_alive in status_dict.items() if not is_alive]
+        if not dead_list:
+            return status_dict
+        cursor = self.cursor
+        cursor.execute(self._heartbeat_age_query, {"instance_id_list": dead_list})
+        status_dict = dict(status_dict)
+        for instance_id, age in cursor.fetchall():
+            if age is not None and float(age) <= HEARTBEAT_TIMEOUT / 1000:
+                self.heartbeat.confirm_alive(instance_id, float(age))
+                status_dict.pop(str(instance_id), None)
+        return status_dict
+
+    def set_module_status(self, status_dict: dict) -> list:
+        """
+        Изменение статусов служб одним запросом (только для служб, статус которых отличается)
+        с запуском восстановления служб, которые стали работоспособными, и отменой восстановления служб,
+        которые стали неработоспособными
+        :param status_dict: словарь {идентификатор службы: признак работоспособности}
+        :return: список идентификаторов служб, которые стали работоспособными
+        """
+        if not status_dict:
+            return []
+        cursor = self.cursor
+        cursor.execute(self._module_status_query, {"module_id_list": list(status_dict.keys()),
+                                                   "status_list": list(status_dict.values())})
+        module_id_list = list()
+        for module_id, status in cursor.fetchall():
+            if status:
+                module_id_list.append(module_id)
+            else:
+                self.recovery.cancel(str(module_id))
+        if module_id_list:
+            self.restart_module(module_id_list)
+        return module_id_list
+
+    def manage_message_partition(self) -> list:
+        """
+        Обслуживание секций сущности "Сообщения" (если сущность секционирована, см. db/message_partition.sql)
+
+        Алгоритм:
+         - создание секций на PARTITION_AHEAD_DAYS дней вперед и отсоединение устаревших секций
+           (функция manager.message_partition_manage)
+         - для каждой отсоединенной секции: выгрузка в сжатый файл в каталог PARTITION_ARCHIVE_DIR
+           и удаление секции (если выгрузка прервалась, секция будет выгружена при следующем запуске)
+         - если секции удалены: удаление данных результатов (сущность "Данные сообщений") старше срока хранения,
+           сообщений которых больше нет
+
+        :return: список выгруженных секций
+        """
+        cursor = self.cursor
+        cursor.execute(self._is_partitioned_query)
+        if not cursor.fetchone()[0]:
+            return []
+        cursor.execute(self._partition_query, (PARTITION_AHEAD_DAYS, PARTITION_RETENTION_DAYS, PARTITION_MAX_DAYS))
+        table_list = [row[0] for row in cursor.fetchall()]
+        for table in table_list:
+            # наименования секций проверены функцией по шаблону message_pYYYYMMDD
+            copy_to_file(cursor, "manager.{}".format(table), os.path.join(PARTITION_ARCHIVE_DIR, table + ".csv.gz"))
+            cursor.execute("DROP TABLE manager.{}".format(table))
+        if table_list:
+            cursor.execute(self._payload_cleanup_query, (PARTITION_RETENTION_DAYS,))
+        return table_list
 
     def check_is_period(self) -> bool:
         """
@@ -620,81 +1468,49 @@ class TaskSVC(BaseSVC):
 
         Алгоритм:
          - если время посленего запуска периодической задачи пустое:
-            - запускаются поиски изменений для каждого канала
+            - ставятся в очередь поиски изменений по всей сущности для каждого канала (через буферы сообщений:
+              поиск выполняется в пуле потоков, а не в потоке подписки, который принимает сигналы
+              работоспособности)
             - возвращает False
          - иначе:
-            - проверка по времени на необходимость поиска изменений в соответствующих сущностях
-            - запуск соответствующих методов при необходимости
+            - если прошло FULL_REFRESH_TIME секунд с последнего полного поиска изменений,
+              то запускается полный поиск изменений для каждого канала
+              (в режиме нескольких экземпляров - и сверка неотвеченных задач диспетчера, см. sync_dispatch)
             - проверка по времени на необходимость запуска периодической задачи
             - если необходимо, то возвращает True, иначе False
         :return:
         """
         if not self.ldt:
             self.ldt = datetime.now()
-            self.refresh_main_task_log()
-            self.refresh_message()
-            self.refresh_task_log()
-            self.refresh_command_log()
-        else:
+            self.fdt = datetime.now()
             for key in self._key_func.keys():
-                if self.notify_list[key].is_need_add_task_by_time():
-                    refresh_func = getattr(self, self._key_func[key].name)
-                    refresh_func()
+                self.notify_list[key].push(None)
+                self.notify_list[key].flush()
+            # секции сообщений создаются заранее уже при старте, не дожидаясь периодической задачи
+            # (в режиме нескольких экземпляров - при получении роли ведущего)
+            if self.is_leader:
+                self.pool_task.add_task(self.manage_message_partition)
+        else:
+            if (datetime.now() - self.fdt).seconds >= FULL_REFRESH_TIME:
+                # Периодический полный поиск изменений на случай потери notify
+                self.fdt = datetime.now()
+                for key in self._key_func.keys():
+                    self.notify_list[key].push(None)
+                    self.notify_list[key].flush()
+                if self.cluster:
+                    self.pool_task.put_task(self.sync_dispatch)
             if (datetime.now() - self.ldt).seconds >= PERIOD_TIME * 60:
                 return True
         return False
 
-
-class NotifyCount(object):
-    _ldt = None
-    _count = None
-    _max_count = None
-
-    def __init__(self, max_count: int, wait_time: int):
-        """
-        :param max_count: количество подряд идущих notify
-        :param wait_time: время в секундах, через которое запустить проверку таблицы
+    def period_task(self) -> None:
         """
-        self._count = 0
-        self._max_count = max_count
-        self._wait_time = wait_time
-
-    def is_need_add_task(self) -> bool:
-        """
-        Если время пустое - пришла первая нотифайка - инициализируем время только для первой натифайки,
-        чтобы разницу во времени считать с первой
-        Если времени не меньше wait_time секунд или количество сообщений пришло не меньше max_count,
-        то обнуляем все и возвращаем True -> следует добавить в очередь задачу для данного канала
-        Иначе инкрементируем на единицу количество пришедших notify и возвращаем False -> ожидаем
+        Периодическая задача: обслуживание секций сущности "Сообщения" (только ведущим экземпляром)
         :return:
         """
-        self._count += 1
-        if not self._ldt:
-            self._ldt = datetime.now()
-        elif (datetime.now() - self._ldt).seconds >= self._wait_time or self._count >= self._max_count:
-            self._ldt = None
-            self._count = 0
-            return True
-        return False
-
-    def is_need_add_task_by_time(self):
-        if self._ldt and (datetime.now() - self._ldt).seconds >= self._wait_time:
-            self._ldt = None
-            self._count = 0
-            return True
-        return False
-
-    @property
-    def ldt(self):
-        return self._ldt
-
-    @property
-    def wait_time(self):
-        return self._wait_time
-
-    # @property
-    # def count(self):
-    #     return self._count
+        self.ldt = datetime.now()
+        if self.is_leader:
+            self.pool_task.add_task(self.manage_message_partition)
 
 
 if __name__ == '__main__':
@@ -153,6 +153,7 @@ class MessageModel(Base):
     msg_type = Column("name", Enum(MsgTypeChoice), default=MsgTypeChoice.connect.value, info={"verbose_name": "Тип сообщения"})
     status = Column("status", Enum(StatusSendChoice), default=StatusSendChoice.sent.value, info={"verbose_name": "Статус отправки"})
     date_created = Column("date_created", DateTime, default=datetime.now, info={"verbose_name": "Дата создания"})
+    instance_id = Column("instance_id", UUID(as_uuid=True), nullable=True, info={"verbose_name": "Экземпляр службы-получателя"})
 
     task_log = relationship("TaskLogModel", backref="message_list")
     parent_msg = relationship("MessageModel", backref=backref("child_list", remote_side=s_id))
@@ -168,6 +169,28 @@ class MessageModel(Base):
         return f"<MessageModel {self.s_id}>"
 
 
+class MessagePayloadModel(Base):
+
+    __tablename__ = "message_payload"
+    __table_args__ = {
+        "schema": "manager",
+        "comment": "Данные сообщений"
+    }
+
+    s_id = Column("s_id", UUID(as_uuid=True), primary_key=True, default=uuid4, unique=True, info={"verbose_name": "Идентификатор"})
+    message_id = Column("message_id", UUID(as_uuid=True), nullable=False, info={"verbose_name": "Сообщение"})
+    number = Column("number", Integer, nullable=False, info={"verbose_name": "Порядковый номер части"})
+    data = Column("data", JSONB, nullable=True, info={"verbose_name": "Часть результата"})
+    date_created = Column("date_created", DateTime, default=datetime.now, info={"verbose_name": "Дата создания"})
+
+    def __init__(self, **kwargs):
+        for key, item in kwargs.items():
+            setattr(self, key, item)
+
+    def __repr__(self):
+        return f"<MessagePayloadModel {self.s_id}>"
+
+
 class MethodModuleModel(Base):
 
     __tablename__ = "method_module"
@@ -180,6 +203,7 @@ class MethodModuleModel(Base):
     module_id = Column("module_id", UUID(as_uuid=True), ForeignKey("manager.module.s_id"), nullable=False, info={"verbose_name": "Служба"})
     name = Column("name", Text, nullable=False, info={"verbose_name": "Наименование"})
     system_name = Column("system_name", Text, nullable=False, info={"verbose_name": "Системное наименование"})
+    is_batch = Column("is_batch", Boolean, default=False, nullable=False, info={"verbose_name": "Признак пакетного выполнения команд"})
 
     module = relationship("ModuleModel", backref="method_module_list")
 
@@ -191,6 +215,31 @@ class MethodModuleModel(Base):
         return f"<MethodModuleModel {self.s_id}>"
 
 
+class ModuleInstanceModel(Base):
+
+    __tablename__ = "module_instance"
+    __table_args__ = {
+        "schema": "manager",
+        "comment": "Экземпляры служб"
+    }
+
+    s_id = Column("s_id", UUID(as_uuid=True), primary_key=True, default=uuid4, unique=True, info={"verbose_name": "Идентификатор"})
+    module_id = Column("module_id", UUID(as_uuid=True), ForeignKey("manager.module.s_id"), nullable=False, info={"verbose_name": "Служба"})
+    channel_name = Column("channel_name", Text, nullable=False, info={"verbose_name": "Наименование канала экземпляра"})
+    capacity = Column("capacity", Integer, default=1, nullable=False, info={"verbose_name": "Емкость (количество потоков)"})
+    host = Column("host", Text, nullable=True, info={"verbose_name": "Хост"})
+    date_created = Column("date_created", DateTime, default=datetime.now, info={"verbose_name": "Дата и время регистрации"})
+
+    module = relationship("ModuleModel", backref="instance_list")
+
+    def __init__(self, **kwargs):
+        for key, item in kwargs.items():
+            setattr(self, key, item)
+
+    def __repr__(self):
+        return f"<ModuleInstanceModel {self.s_id}>"
+
+
 class ModuleModel(Base):
 
     __tablename__ = "module"
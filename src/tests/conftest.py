@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# модули служб импортируются от каталога src (как при запуске служб)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from uuid import uuid4
+
+import pytest
+
+from utils.base_utils.cluster import ShardCluster
+
+
+def connect():
+    raise ConnectionError("no database in unit tests")
+
+
+def make_cluster(shard_count: int = 64) -> ShardCluster:
+    # поток распределения не может подключиться и ждет следующего цикла: проверяется только _target
+    return ShardCluster(connect, shard_count=shard_count, renew=60000)
+
+
+@pytest.fixture
+def cluster_list():
+    cluster_list = [make_cluster() for _ in range(3)]
+    yield cluster_list
+    for cluster in cluster_list:
+        cluster.stop()
+
+
+def test_single_member_owns_all():
+    cluster = make_cluster(16)
+    try:
+        assert cluster._target([]) == set(range(16))
+        assert cluster._target([cluster.s_id]) == set(range(16))
+    finally:
+        cluster.stop()
+
+
+def test_shards_are_partitioned(cluster_list):
+    """Каждая секция принадлежит ровно одному экземпляру при одинаковом составе экземпляров"""
+    member_list = [cluster.s_id for cluster in cluster_list]
+    target_list = [cluster._target(member_list) for cluster in cluster_list]
+    assert set().union(*target_list) == set(range(64))
+    assert sum(len(target) for target in target_list) == 64
+
+
+def test_member_change_moves_only_its_shards(cluster_list):
+    """При добавлении и выбывании экземпляра переходят только секции этого экземпляра"""
+    member_list = [cluster.s_id for cluster in cluster_list]
+    before = [cluster._target(member_list) for cluster in cluster_list]
+    new_member = str(uuid4())
+    after = [cluster._target(member_list + [new_member]) for cluster in cluster_list]
+    for shard_set, new_shard_set in zip(before, after):
+        assert new_shard_set <= shard_set
+    left = [cluster._target(member_list[:2]) for cluster in cluster_list[:2]]
+    for shard_set, new_shard_set in zip(before, left):
+        assert shard_set <= new_shard_set
+    assert left[0] | left[1] == set(range(64))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from utils.base_utils.dispatcher import InstanceDispatcher, DISPATCH_HASH
+
+
+def instance(s_id: str, capacity: int = 1, module_id: str = "module") -> dict:
+    return {"s_id": s_id, "module_id": module_id, "channel_name": "channel_" + s_id, "capacity": capacity}
+
+
+def make_dispatcher(mode=None, instance_list=None) -> InstanceDispatcher:
+    dispatcher = InstanceDispatcher(mode) if mode else InstanceDispatcher()
+    instance_list = instance_list or [instance("a"), instance("b")]
+    dispatcher.set_instance_list(instance_list)
+    for item in instance_list:
+        dispatcher.set_alive(item["s_id"], True)
+    return dispatcher
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        InstanceDispatcher("random")
+
+
+def test_least_outstanding_by_capacity():
+    """Задача отправляется экземпляру с наименьшим отношением неотвеченных задач к емкости"""
+    dispatcher = make_dispatcher(instance_list=[instance("a", 1), instance("b", 3)])
+    chosen = [dispatcher.choose("module", task_id)["s_id"] for task_id in range(4)]
+    assert chosen.count("a") == 1 and chosen.count("b") == 3
+    dispatcher.release([task_id for task_id, s_id in enumerate(chosen) if s_id == "b"])
+    assert dispatcher.stats()["outstanding"] == {"a": 1, "b": 0}
+    assert dispatcher.choose("module", 10)["s_id"] == "b"
+    assert dispatcher.stats()["dispatch_count"] == 5
+
+
+def test_only_alive_instances_of_module():
+    dispatcher = make_dispatcher(instance_list=[instance("a"), instance("b", module_id="other")])
+    assert dispatcher.has_instance("module") and not dispatcher.has_instance("missing")
+    assert dispatcher.choose("module", 1)["s_id"] == "a"
+    assert dispatcher.set_alive("a", False) == ["1"]
+    assert dispatcher.choose("module", 2) is None
+    assert dispatcher.stats()["outstanding"] == {}
+
+
+def test_hash_moves_only_tasks_of_dead_instance():
+    """В режиме hash задачи закреплены за экземпляром по ключу, при выбывании переходят только его задачи"""
+    dispatcher = make_dispatcher(DISPATCH_HASH, [instance("a"), instance("b"), instance("c")])
+    before = {key: dispatcher.choose("module", key, key=key)["s_id"] for key in map(str, range(100))}
+    assert before == {key: dispatcher.choose("module", key, key=key)["s_id"] for key in before}
+    dispatcher.set_alive("c", False)
+    after = {key: dispatcher.choose("module", key, key=key)["s_id"] for key in before}
+    assert all(after[key] == s_id for key, s_id in before.items() if s_id != "c")
+    assert set(after.values()) == {"a", "b"}
+
+
+def test_reassign_keeps_counts():
+    dispatcher = make_dispatcher()
+    dispatcher.assign(1, "a")
+    dispatcher.assign(1, "b")
+    assert dispatcher.stats()["outstanding"] == {"a": 0, "b": 1}
+
+
+def test_resync_replays_changes_during_sync():
+    """Сверка заменяет неотвеченные задачи прочитанными и применяет изменения, сделанные во время чтения"""
+    dispatcher = make_dispatcher()
+    dispatcher.assign(1, "a")
+    dispatcher.assign(2, "a")
+    assert dispatcher.begin_sync()
+    assert not dispatcher.begin_sync()
+    # во время чтения: задача 3 отправлена, на задачу 4 получен ответ
+    dispatcher.assign(3, "b")
+    dispatcher.release([4])
+    dispatcher.resync([(2, "a"), (4, "b"), (5, "b"), (6, "dead")])
+    assert dispatcher.stats()["outstanding"] == {"a": 1, "b": 2}
+    assert dispatcher.stats()["sync_count"] == 1
+    assert dispatcher.begin_sync()
+    dispatcher.cancel_sync()
+    assert dispatcher.begin_sync()
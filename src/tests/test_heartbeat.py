@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from utils.base_utils.heartbeat import HeartbeatMonitor
+
+
+@pytest.fixture
+def monitor():
+    # поток монитора не проверяет состояния во время теста: изменения собираются вызовом _collect
+    monitor = HeartbeatMonitor(lambda change_dict: None, timeout=100, check=60000,
+                               state={"old": (True, 10), "new": (False, None)})
+    yield monitor
+    monitor.stop()
+
+
+def test_initial_state(monitor):
+    """Начальное состояние берется из базы данных, устаревшие сигналы меняют состояние при первой проверке"""
+    assert monitor.is_alive("old") and not monitor.is_alive("new")
+    assert monitor._collect() == {"old": False}
+    assert monitor._collect() == {}
+
+
+def test_collect_changes(monitor):
+    """Изменения передаются только при смене состояния"""
+    monitor._collect()
+    monitor.beat("new")
+    monitor.beat("unknown")
+    assert monitor._collect() == {"new": True, "unknown": True}
+    assert monitor._collect() == {}
+    time.sleep(0.15)
+    assert monitor._collect() == {"new": False, "unknown": False}
+    assert monitor.stats() == {"alive_count": 0, "dead_count": 3, "change_count": 5}
+
+
+def test_confirm_alive(monitor):
+    """Подтвержденная служба считается работоспособной без передачи изменения"""
+    monitor._collect()
+    monitor.confirm_alive("old", 0.01)
+    assert monitor.is_alive("old")
+    assert monitor._collect() == {}
+
+
+def test_forget(monitor):
+    """Исключенная служба не контролируется, пока снова не придет сигнал"""
+    monitor.beat("new")
+    monitor._collect()
+    monitor.forget(["new", "old"])
+    assert monitor.state() == {}
+    time.sleep(0.15)
+    assert monitor._collect() == {}
+    monitor.beat("new")
+    assert monitor._collect() == {"new": True}
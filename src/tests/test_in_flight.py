@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from utils.base_utils.in_flight import InFlightRegistry
+
+
+def test_claim_collapses_queued():
+    """Повторная постановка записи, которая уже в очереди, схлопывается; ключи обработчиков независимы"""
+    registry = InFlightRegistry()
+    assert registry.claim("handler", [1, 2, 2]) == [1, 2]
+    assert registry.claim("handler", [2, 3]) == [3]
+    assert registry.claim("other", [1]) == [1]
+    assert registry.release("handler", [1, 2, 3]) == []
+    assert registry.claim("handler", [1]) == [1]
+    stats = registry.stats()
+    assert stats["in_flight"] == {"handler": 1, "other": 1}
+    assert stats["claim_count"] == 5
+    assert stats["collapse_count"] == 2
+    assert stats["requeue_count"] == 0
+
+
+def test_release_returns_changed_while_running():
+    """Запись, поставленная повторно во время обработки, возвращается release для повторной постановки"""
+    registry = InFlightRegistry()
+    registry.claim("handler", [1, 2])
+    registry.start("handler", [1, 2])
+    assert registry.claim("handler", [2]) == []
+    assert registry.release("handler", [1, 2]) == [2]
+    assert registry.stats()["in_flight"] == {}
+    assert registry.stats()["requeue_count"] == 1
+    # после освобождения запись захватывается заново и больше не считается измененной
+    assert registry.claim("handler", [2]) == [2]
+    registry.start("handler", [2])
+    assert registry.release("handler", [2]) == []
+
+
+def test_queued_not_running_is_not_dirty():
+    """Повторная постановка записи, обработка которой еще не началась, не требует повторной постановки"""
+    registry = InFlightRegistry()
+    registry.claim("handler", [1])
+    assert registry.claim("handler", [1]) == []
+    registry.start("handler", [1])
+    assert registry.release("handler", [1]) == []
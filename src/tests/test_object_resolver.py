@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from utils.base_utils.object_resolver import ObjectResolver, ObjectSet  # noqa: E402
+
+TaskLog = namedtuple("TaskLog", "s_id main_task_log_id")
+
+
+class FakeSession(object):
+    """Сессия, возвращающая заданные строки запроса поиска объектов и запоминающая параметры"""
+
+    def __init__(self) -> None:
+        self.row_list = list()
+        self.params_list = list()
+
+    def execute(self, query, params):
+        self.params_list.append(params)
+        return list(self.row_list)
+
+
+def test_cache_narrows_query_and_reuses_set():
+    """Следующая задача той же базовой задачи ищет связи только после окончательного номера операции"""
+    session = FakeSession()
+    resolver = ObjectResolver(session)
+    session.row_list = [("t1", "m", 3, 1, "o1"), ("t1", "m", 3, 1, "o2")]
+    assert resolver.resolve([TaskLog("t1", "m")]) == {"t1": ObjectSet(1, ["o1", "o2"])}
+    assert session.params_list[-1]["from_number_list"] == [None]
+
+    session.row_list = [("t2", "m", 5, None, None)]
+    assert resolver.resolve([TaskLog("t2", "m")]) == {"t2": ObjectSet(1, ["o1", "o2"])}
+    assert session.params_list[-1]["from_number_list"] == [3]
+    assert resolver.stats() == {"size": 1, "hit_count": 1, "miss_count": 1}
+
+    # новые связи после окончательного номера заменяют набор из кэша
+    session.row_list = [("t3", "m", 7, 6, "o3")]
+    assert resolver.resolve([TaskLog("t3", "m")]) == {"t3": ObjectSet(6, ["o3"])}
+    assert session.params_list[-1]["from_number_list"] == [5]
+
+
+def test_cache_ignored_for_earlier_task():
+    """Кэш, построенный по задаче с большим номером операции, не используется (перезапуск задачи)"""
+    session = FakeSession()
+    resolver = ObjectResolver(session)
+    session.row_list = [("t5", "m", 5, 1, "o1")]
+    resolver.resolve([TaskLog("t5", "m")])
+    session.row_list = [("t2", "m", 2, None, None)]
+    assert resolver.resolve([TaskLog("t2", "m")]) == {"t2": None}
+    assert resolver.stats()["hit_count"] == 0
+
+
+def test_own_links_not_cached():
+    """Связи самой задачи могут измениться при ее выполнении: набор по ним не кэшируется"""
+    session = FakeSession()
+    resolver = ObjectResolver(session)
+    session.row_list = [("t1", "m", 3, 3, "o1")]
+    assert resolver.resolve([TaskLog("t1", "m")]) == {"t1": ObjectSet(3, ["o1"])}
+    assert resolver.stats()["size"] == 0
+    session.row_list = [("t2", "m", 4, 3, "o1")]
+    resolver.resolve([TaskLog("t2", "m")])
+    assert session.params_list[-1]["from_number_list"] == [None]
+
+
+def test_lru_and_invalidate():
+    session = FakeSession()
+    resolver = ObjectResolver(session, max_size=1)
+    session.row_list = [("t1", "m1", 2, 1, "o1")]
+    resolver.resolve([TaskLog("t1", "m1")])
+    session.row_list = [("t2", "m2", 2, 1, "o2")]
+    resolver.resolve([TaskLog("t2", "m2")])
+    assert resolver.stats()["size"] == 1
+    assert resolver._get("m1") is None and resolver._get("m2") is not None
+    resolver.invalidate("m2")
+    assert resolver.stats()["size"] == 0
+    assert ObjectResolver(session, max_size=0).resolve([]) == {}
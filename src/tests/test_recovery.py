@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from utils.base_utils.recovery import RecoveryEngine
+
+
+class Collector(object):
+    """Функция отправки пачек, запоминающая пачки"""
+
+    def __init__(self, total: int) -> None:
+        self.batch_list = list()
+        self._total = total
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __call__(self, key, batch) -> None:
+        with self._lock:
+            self.batch_list.append((key, list(batch)))
+            if sum(len(item) for _, item in self.batch_list) >= self._total:
+                self.done.set()
+
+
+def test_batches():
+    """Записи отправляются пачками не больше batch_size в исходном порядке"""
+    collector = Collector(5)
+    engine = RecoveryEngine(collector, batch_size=2, rate=0)
+    try:
+        engine.start("module", [1, 2, 3, 4, 5])
+        assert collector.done.wait(2)
+        assert collector.batch_list == [("module", [1, 2]), ("module", [3, 4]), ("module", [5])]
+        assert engine.stats() == {}
+    finally:
+        engine.stop()
+
+
+def test_jobs_interleave():
+    """При ограничении скорости задания разных служб чередуются"""
+    collector = Collector(6)
+    engine = RecoveryEngine(collector, batch_size=1, rate=1000)
+    try:
+        # задания ставятся под блокировкой движка, чтобы поток не начал отправку раньше второго задания
+        with engine._condition:
+            engine.start("a", [1, 2, 3])
+            engine.start("b", [1, 2, 3])
+        assert collector.done.wait(2)
+        assert [key for key, _ in collector.batch_list] == ["a", "b", "a", "b", "a", "b"]
+    finally:
+        engine.stop()
+
+
+def test_cancel_and_replace():
+    """Отмена удаляет задание, повторный запуск заменяет его"""
+    collector = Collector(3)
+    engine = RecoveryEngine(collector, batch_size=1, rate=1)
+    try:
+        with engine._condition:
+            engine.start("module", [1, 2, 3])
+            engine.start("module", [4, 5])
+            assert engine.stats()["module"]["total"] == 2
+        engine.cancel("module")
+        assert engine.stats() == {}
+        assert all(batch[0] in (4, 5) for _, batch in collector.batch_list)
+    finally:
+        engine.stop()
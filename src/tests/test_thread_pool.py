@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import threading
+from queue import Full
+
+import pytest
+
+from utils.base_utils.thread_pool import (TaskQueue, ThreadPool, PRIORITY_HEARTBEAT, PRIORITY_COMPLETION,
+                                          PRIORITY_DISPATCH, PRIORITY_FANOUT)
+
+
+def drain(queue: TaskQueue) -> list:
+    return [queue.get(block=False) for _ in range(queue.qsize())]
+
+
+def test_priority_classes():
+    """Задачи более высокого класса приоритета выбираются первыми независимо от порядка постановки"""
+    queue = TaskQueue()
+    queue.put("fanout", PRIORITY_FANOUT)
+    queue.put("dispatch", PRIORITY_DISPATCH)
+    queue.put("completion", PRIORITY_COMPLETION)
+    queue.put("heartbeat", PRIORITY_HEARTBEAT)
+    assert drain(queue) == ["heartbeat", "completion", "dispatch", "fanout"]
+
+
+def test_round_robin_by_key():
+    """Внутри класса приоритета задачи выбираются по кругу по ключам, в пределах ключа - по порядку"""
+    queue = TaskQueue()
+    for number in range(3):
+        queue.put("a{}".format(number), key="a")
+    queue.put("b0", key="b")
+    queue.put("c0", key="c")
+    assert drain(queue) == ["a0", "b0", "c0", "a1", "a2"]
+
+
+def test_bounded_put():
+    """Ограничение глубины очереди: постановка ждет места, сигналы и постановка без ограничения проходят сразу"""
+    queue = TaskQueue(max_size=2)
+    queue.put(1)
+    queue.put(2)
+    with pytest.raises(Full):
+        queue.put(3, block=False)
+    with pytest.raises(Full):
+        queue.put(3, timeout=0.05)
+    queue.put("heartbeat", PRIORITY_HEARTBEAT)
+    queue.put("worker", bounded=False)
+    assert queue.qsize() == 4
+
+    def release():
+        for _ in range(3):
+            queue.get()
+    thread = threading.Thread(target=release)
+    thread.start()
+    queue.put(3, timeout=2)
+    thread.join()
+    assert queue.qsize() == 2
+
+
+def test_join_and_stats():
+    queue = TaskQueue()
+    queue.put("task", PRIORITY_COMPLETION)
+    assert queue.stats()[PRIORITY_COMPLETION]["depth"] == 1
+    queue.get()
+    queue.task_done()
+    queue.join()
+    stats = queue.stats()[PRIORITY_COMPLETION]
+    assert stats["depth"] == 0
+    assert stats["count"] == 1
+    assert stats["wait_max"] >= stats["wait_avg"] >= 0
+
+
+def test_worker_thread_bypasses_bound():
+    """Задача, поставленная рабочим потоком пула в заполненную очередь, ставится сразу (без взаимоблокировки)"""
+    pool = ThreadPool(1, max_size=1)
+    started, filled, put_done, follow_up_done = (threading.Event() for _ in range(4))
+
+    def follow_up():
+        follow_up_done.set()
+
+    def producer():
+        started.set()
+        filled.wait(2)
+        pool.put_task(follow_up)
+        put_done.set()
+
+    pool.add_task(producer)
+    assert started.wait(2)
+    pool.add_task(lambda: None)
+    assert pool.tasks.qsize() == 1
+    filled.set()
+    assert put_done.wait(2)
+    assert follow_up_done.wait(5)
+    pool.wait_completion()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import time
+import uuid
+import logging
+import threading
+
+from sqlalchemy import inspect
+
+logger = logging.getLogger(__name__)
+
+
+class MessageAcknowledger(object):
+    """
+    Буфер квитирования сообщений
+
+    Накапливает изменения статусов отправки пришедших сообщений и ответные сообщения
+    и записывает их пачкой в одной транзакции:
+     - один UPDATE ... WHERE s_id IN (...) на статус "Получено" (для сообщений, обработка которых
+       к моменту записи не завершилась)
+     - один многострочный INSERT ответных сообщений
+     - один UPDATE ... WHERE s_id IN (...) на статус "Обработано"
+
+    Пачка записывается по истечении max_wait миллисекунд с первого изменения в пачке,
+    при накоплении max_count изменений или при остановке буфера (запись выполняет собственный поток).
+    Если пачка не записалась, то ее изменения записываются по одному (см. _write).
+    """
+
+    def __init__(self, session, model, recd_status, ok_status, max_count: int = 500, max_wait: int = 50) -> None:
+        """
+        :param session: сессия SQLAlchemy (scoped_session)
+        :param model: модель сущности "Сообщения"
+        :param recd_status: статус отправки "Получено"
+        :param ok_status: статус отправки "Обработано"
+        :param max_count: максимальное количество изменений в пачке
+        :param max_wait: максимальное время ожидания записи пачки (в миллисекундах)
+        """
+        self._session = session
+        self._model = model
+        self._recd_status = recd_status
+        self._ok_status = ok_status
+        self._max_count = max_count
+        self._max_wait = max_wait / 1000
+        mapper = inspect(model)
+        self._column_dict = {prop.key: prop.columns[0].key for prop in mapper.column_attrs}
+        self._condition = threading.Condition()
+        self._recd_set = set()
+        self._ok_set = set()
+        self._message_list = list()
+        self._first_time = None
+        self._is_stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def received(self, s_id) -> None:
+        """
+        Сообщение получено (статус "Получено")
+        :param s_id: идентификатор сообщения
+        :return:
+        """
+        self._push(self._recd_set, s_id)
+
+    def done(self, s_id, message: dict = None) -> None:
+        """
+        Сообщение обработано (статус "Обработано") с ответным сообщением
+        :param s_id: идентификатор сообщения или None
+        :param message: данные ответного сообщения {атрибут модели: значение} или None
+        :return:
+        """
+        with self._condition:
+            if message:
+                self._message_list.append(message)
+            if s_id:
+                self._ok_set.add(str(s_id))
+            self._touch()
+
+    def add_message(self, message: dict) -> None:
+        """
+        Добавление сообщения (например, с типом "Информация") без изменения статусов
+        :param message: данные сообщения {атрибут модели: значение}
+        :return:
+        """
+        self.done(None, message)
+
+    def _push(self, id_set: set, s_id) -> None:
+        with self._condition:
+            id_set.add(str(s_id))
+            self._touch()
+
+    def _touch(self) -> None:
+        """
+        Учет изменения в пачке (вызывается под блокировкой)
+        :return:
+        """
+        if self._first_time is None:
+            self._first_time = time.monotonic()
+        if len(self._recd_set) + len(self._ok_set) + len(self._message_list) >= self._max_count:
+            self._first_time = 0
+        self._condition.notify()
+
+    def flush(self) -> None:
+        """
+        Запись накопленной пачки в текущем потоке
+        :return:
+        """
+        with self._condition:
+            recd_set, ok_set, message_list = self._recd_set, self._ok_set, self._message_list
+            self._recd_set, self._ok_set, self._message_list = set(), set(), list()
+            self._first_time = None
+        if recd_set or ok_set or message_list:
+            self._write(recd_set - ok_set, ok_set, message_list)
+
+    def stop(self) -> None:
+        """
+        Остановка буфера с записью накопленной пачки
+        :return:
+        """
+        with self._condition:
+            self._is_stop = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        """
+        Поток записи пачек по таймеру
+        :return:
+        """
+        while True:
+            with self._condition:
+                while not self._is_stop:
+                    if self._first_time is None:
+                        self._condition.wait()
+                    else:
+                        timeout = self._first_time + self._max_wait - time.monotonic()
+                        if timeout <= 0:
+                            break
+                        self._condition.wait(timeout)
+                if self._is_stop:
+                    return
+            self.flush()
+
+    def _row(self, message: dict, key_list: list) -> dict:
+        """
+        Преобразование данных сообщения в запись для INSERT
+        (атрибуты модели заменяются атрибутами сущности, записи модели - их идентификаторами)
+        """
+        row = dict()
+        for key in key_list:
+            value = message.get(key)
+            if hasattr(value, "s_id"):
+                value = value.s_id
+            row[self._column_dict[key]] = value
+        if row.get(self._column_dict["s_id"]) is None:
+            row[self._column_dict["s_id"]] = uuid.uuid4()
+        return row
+
+    def _write(self, recd_set: set, ok_set: set, message_list: list) -> None:
+        """
+        Запись пачки в одной транзакции
+        (если пачка не записалась, то изменения записываются по одному, каждое в своей транзакции:
+         ошибка одной записи не отменяет остальные изменения пачки)
+        :param recd_set: идентификаторы сообщений для статуса "Получено"
+        :param ok_set: идентификаторы сообщений для статуса "Обработано"
+        :param message_list: ответные сообщения
+        :return:
+        """
+        try:
+            self._execute(recd_set, ok_set, message_list)
+        except Exception:
+            logger.exception("Acknowledgement of %s messages failed, retrying one by one",
+                             len(recd_set) + len(ok_set))
+            for s_id in recd_set:
+                self._write_one("Status of message %s", s_id, {s_id}, set(), [])
+            for message in message_list:
+                self._write_one("Message %s", message, set(), set(), [message])
+            for s_id in ok_set:
+                self._write_one("Status of message %s", s_id, set(), {s_id}, [])
+
+    def _write_one(self, description: str, item, recd_set: set, ok_set: set, message_list: list) -> None:
+        """
+        Запись одного изменения в отдельной транзакции (ошибка записи фиксируется в журнале)
+        :param description: описание изменения для журнала
+        :param item: изменение (идентификатор или данные сообщения)
+        :param recd_set: идентификаторы сообщений для статуса "Получено"
+        :param ok_set: идентификаторы сообщений для статуса "Обработано"
+        :param message_list: ответные сообщения
+        :return:
+        """
+        try:
+            self._execute(recd_set, ok_set, message_list)
+        except Exception:
+            logger.exception(description + " was not written", item)
+
+    def _execute(self, recd_set: set, ok_set: set, message_list: list) -> None:
+        """
+        Выполнение запросов пачки и фиксация транзакции (при ошибке транзакция откатывается)
+        :param recd_set: идентификаторы сообщений для статуса "Получено"
+        :param ok_set: идентификаторы сообщений для статуса "Обработано"
+        :param message_list: ответные сообщения
+        :return:
+        """
+        model = self._model
+        session = self._session
+        try:
+            if recd_set:
+                session.query(model).filter(model.s_id.in_(list(recd_set))).update(
+                    {model.status: self._recd_status}, synchronize_session=False)
+            if message_list:
+                key_list = sorted({key for message in message_list for key in message} | {"s_id"})
+                session.execute(model.__table__.insert().values(
+                    [self._row(message, key_list) for message in message_list]))
+            if ok_set:
+                session.query(model).filter(model.s_id.in_(list(ok_set))).update(
+                    {model.status: self._ok_status}, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
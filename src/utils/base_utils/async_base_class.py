@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import logging
+import functools
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+
+from utils.base_utils.base_class import BaseSVC
+from utils.base_utils.connection_pool import ConnectionPool
+from utils.base_utils.metrics import MetricRegistry, TaskMetrics
+from utils.base_utils.thread_pool import TaskQueue, PRIORITY_DISPATCH
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTaskPool(object):
+    """
+    Пул задач на цикле событий (используется AsyncBaseSVC вместо ThreadPool)
+
+    Основные функции:
+     - выполнение корутинных функций (async def) на цикле событий
+     - выполнение обычных функций в пуле потоков (с подключением к базе данных из пула подключений),
+       чтобы синхронные обработчики не блокировали цикл событий
+     - ограничение количества одновременно выполняемых задач: корутинных - max_tasks, обычных - thread_count
+
+    Задачи сверх ограничения ждут в очередях TaskQueue (отдельно для корутинных и обычных функций) и берутся
+    из них так же, как в ThreadPool: по классу приоритета (priority_map - приоритет по наименованию функции)
+    и по кругу по ключу. Очереди не ограничены по глубине: постановка задачи не блокирует цикл событий.
+
+    Метод add_task потокобезопасен: задачи можно ставить из любого потока (например, из буфера сообщений).
+
+    Если заданы метрики задач (TaskMetrics), учитываются ожидание и длительность задач, ошибки,
+    а для обычных функций - и запросы к базе данных.
+    """
+
+    def __init__(self, loop, thread_count: int, max_tasks: int, connection_pool: ConnectionPool = None,
+                 metrics: TaskMetrics = None, priority_map: dict = None) -> None:
+        """
+        :param loop: цикл событий
+        :param thread_count: количество потоков для обычных функций
+        :param max_tasks: максимальное количество одновременно выполняемых корутинных функций
+        :param connection_pool: пул подключений для потоков (для переподключения после ошибки)
+        :param metrics: метрики задач
+        :param priority_map: приоритет задач по наименованию функции {наименование: PRIORITY_*}
+        """
+        self.loop = loop
+        # дополнительный поток - для проверки периодической задачи (см. AsyncBaseSVC._check_period)
+        self.executor = ThreadPoolExecutor(max_workers=thread_count + 1)
+        self.connection_pool = connection_pool
+        self.metrics = metrics
+        self.priority_map = priority_map or dict()
+        self.tasks = TaskQueue()
+        self._coroutine_tasks = TaskQueue()
+        self._thread_count = thread_count
+        self._max_tasks = max_tasks
+        self._running = {True: 0, False: 0}
+        self._task_set = set()
+
+    def add_task(self, func, *args, **kwargs) -> None:
+        """
+        Постановка задачи на выполнение (приоритет по priority_map, ключ - наименование функции)
+        :param func: функция или корутинная функция
+        :param args: позиционные аргументы функции
+        :param kwargs: именованные аргументы функции
+        :return:
+        """
+        self.put_task(func, args, kwargs)
+
+    def put_task(self, func, args=(), kwargs=None, priority=None, key=None, name=None) -> None:
+        """
+        Постановка задачи на выполнение с явным классом приоритета и ключом (совместимость с ThreadPool.put_task)
+        :param func: функция или корутинная функция
+        :param args: позиционные аргументы функции
+        :param kwargs: именованные аргументы функции
+        :param priority: класс приоритета (по умолчанию - по priority_map)
+        :param key: ключ очереди (по умолчанию - наименование функции)
+        :param name: наименование задачи для метрик (по умолчанию - наименование функции)
+        :return:
+        """
+        func_name = getattr(func, "__name__", None)
+        if priority is None:
+            priority = self.priority_map.get(func_name, PRIORITY_DISPATCH)
+        self.loop.call_soon_threadsafe(self._submit, (func, args, kwargs or dict(), name or func_name or str(func),
+                                                      time.monotonic()), priority, key or func_name)
+
+    def stats(self) -> dict:
+        """
+        Статистика очереди обычных функций по классам приоритета (см. TaskQueue.stats)
+        :return: словарь
+        """
+        return self.tasks.stats()
+
+    def running_count(self) -> int:
+        """
+        Количество выполняемых задач
+        :return: количество задач
+        """
+        return len(self._task_set)
+
+    def _submit(self, item, priority, key) -> None:
+        is_coroutine = asyncio.iscoroutinefunction(item[0])
+        (self._coroutine_tasks if is_coroutine else self.tasks).put(item, priority, key)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """
+        Запуск задач из очередей в пределах ограничений (вызывается на цикле событий)
+        :return:
+        """
+        for is_coroutine, queue, limit in ((True, self._coroutine_tasks, self._max_tasks),
+                                           (False, self.tasks, self._thread_count)):
+            while self._running[is_coroutine] < limit:
+                try:
+                    item = queue.get(block=False)
+                except Empty:
+                    break
+                self._running[is_coroutine] += 1
+                task = self.loop.create_task(self._run(is_coroutine, *item))
+                self._task_set.add(task)
+                task.add_done_callback(functools.partial(self._done, is_coroutine, queue))
+
+    def _done(self, is_coroutine: bool, queue: TaskQueue, task) -> None:
+        self._task_set.discard(task)
+        self._running[is_coroutine] -= 1
+        queue.task_done()
+        self._dispatch()
+
+    async def _run(self, is_coroutine, func, args, kwargs, name, put_time) -> None:
+        try:
+            if is_coroutine:
+                start = time.perf_counter()
+                if self.metrics:
+                    self.metrics.wait.observe(time.monotonic() - put_time, name)
+                try:
+                    await func(*args, **kwargs)
+                except Exception:
+                    if self.metrics:
+                        self.metrics.observe(name, time.perf_counter() - start, True)
+                    raise
+                if self.metrics:
+                    self.metrics.observe(name, time.perf_counter() - start)
+            else:
+                await self.loop.run_in_executor(self.executor, functools.partial(
+                    self._call, func, args, kwargs, name, put_time))
+        except Exception:
+            logger.exception("Task %s failed", name)
+
+    def _call(self, func, args, kwargs, name, put_time):
+        is_error = False
+        start = self.metrics.begin(name, time.monotonic() - put_time) if self.metrics else None
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            is_error = True
+            # подключение потока могло быть потеряно: переподключение до следующей задачи
+            if self.connection_pool:
+                self.connection_pool.check()
+            raise
+        finally:
+            if self.metrics:
+                self.metrics.end(name, start, is_error)
+
+    async def wait_completion(self) -> None:
+        """
+        Ожидание завершения всех поставленных задач (в том числе ожидающих в очередях)
+        :return:
+        """
+        while self._task_set or self.tasks.qsize() or self._coroutine_tasks.qsize():
+            if self._task_set:
+                await asyncio.wait(list(self._task_set))
+            else:
+                await asyncio.sleep(0)
+
+    def shutdown(self) -> None:
+        """
+        Остановка пула потоков
+        :return:
+        """
+        self.executor.shutdown(wait=True)
+
+
+class AsyncBaseSVC(BaseSVC):
+    """
+    Базовый класс службы на цикле событий (asyncio)
+
+    Основные функции:
+     - подписка на канал через asyncpg (LISTEN на выделенном подключении)
+     - выполнение задач на цикле событий (AsyncTaskPool): корутинные обработчики выполняются
+       на цикле событий (тысячи одновременных задач, ожидающих ввода-вывода), обычные - в пуле потоков
+     - выполнение периодической и/или первичной задачи по условию (проверка раз в _period_timeout секунд)
+     - пул асинхронных подключений к базе данных (apool) для корутинных обработчиков
+
+    Контракт add_task / period_task / check_is_period совпадает с BaseSVC, поэтому службы-наследники
+    переходят на цикл событий через множественное наследование, например:
+
+        class AsyncTaskSVC(TaskSVC, AsyncBaseSVC):
+            pass
+
+    add_task вызывается на цикле событий и не должен блокировать его (тяжелая работа ставится в pool_task).
+    """
+    _max_tasks = 1000
+
+    loop = None
+    apool = None
+    _pool_size = None
+    _stop_event = None
+
+    def __init__(self, thread_count: int, host: str, port: str, db_name: str, user: str, channel_name: str,
+                 pool_size: int = None) -> None:
+        """
+        Конструктор класса
+
+        Инициализирует:
+         - количество потоков для обычных (синхронных) обработчиков
+         - цикл событий
+         - реестр метрик и метрики задач
+         - пул подключений к базе данных для потоков
+         - пул задач на цикле событий
+
+        Подключение для подписки на канал и пул асинхронных подключений создаются при запуске (run).
+
+        :param thread_count: количество потоков для обычных обработчиков
+        :param host: hostname, на которой развернута база данных
+        :param port: порт подключения к базе данных
+        :param db_name: наименование базы данных
+        :param user: роль для подключения к базе данных
+        :param channel_name: наименование канала, в который поступают сообщения от базы данных
+        :param pool_size: максимальный размер пула асинхронных подключений (по умолчанию - количество потоков)
+        """
+        self._host = host
+        self._port = port
+        self._db_name = db_name
+        self._user = user
+        self._thread_count = thread_count
+        self._channel_name = channel_name
+        self._pool_size = pool_size or thread_count
+        self.loop = asyncio.new_event_loop()
+        self.metrics = MetricRegistry()
+        self.task_metrics = TaskMetrics(self.metrics)
+        self.metrics.add_collector(self._queue_metrics)
+        self.metrics.add_collector(self._pool_metrics)
+        self.db_pool = ConnectionPool(self.connect, self._thread_count + 1,
+                                      cursor_factory=self.task_metrics.cursor_factory)
+        self.pool_task = AsyncTaskPool(self.loop, self._thread_count, self._max_tasks, self.db_pool,
+                                       self.task_metrics, self._priority_func)
+
+    def _pool_metrics(self) -> list:
+        """
+        Функция сбора метрик пула задач: количество выполняемых задач
+        :return: список метрик (см. MetricRegistry.add_collector)
+        """
+        return [("svc_tasks_running", "gauge", "Выполняемые задачи", (), {(): self.pool_task.running_count()})]
+
+    @property
+    def connect_kwargs(self) -> dict:
+        return {"host": self._host, "port": self._port, "database": self._db_name, "user": self._user}
+
+    def run(self) -> None:
+        """
+        Запуск подписки на список каналов (блокирует вызывающий поток до получения SIGINT/SIGTERM)
+
+        :return:
+        """
+        asyncio.set_event_loop(self.loop)
+        self.start_metrics()
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.stop_metrics()
+            self.pool_task.shutdown()
+            self.db_pool.close()
+            self.loop.close()
+
+    async def _run(self) -> None:
+        self._stop_event = asyncio.Event()
+        for sig in self._signals_to_handle:
+            self.loop.add_signal_handler(sig, self._stop_event.set)
+        self.apool = await asyncpg.create_pool(min_size=1, max_size=self._pool_size, **self.connect_kwargs)
+        try:
+            await self._listen()
+        finally:
+            await self.pool_task.wait_completion()
+            await self.apool.close()
+            for sig in self._signals_to_handle:
+                self.loop.remove_signal_handler(sig)
+
+    async def _listen(self) -> None:
+        """
+        Подписка на список каналов
+
+        Основыне задачи метода:
+         - подписка на канал службы и дополнительные каналы (сообщения обрабатываются функцией _on_notify
+           по мере поступления)
+         - каждые _period_timeout секунд проверка на признак запуска периодической/первичной задачи
+         - ожидание сигнала на завершение
+
+        :return:
+        """
+        if not self._table_list:
+            return
+        channel_list = [self._channel_name] + list(self._extra_channel_list or [])
+        connection = await asyncpg.connect(**self.connect_kwargs)
+        for channel in channel_list:
+            await connection.add_listener(channel, self._on_notify)
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=self._period_timeout)
+                except asyncio.TimeoutError:
+                    await self._check_period()
+        finally:
+            for channel in channel_list:
+                await connection.remove_listener(channel, self._on_notify)
+            await connection.close()
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str) -> None:
+        """
+        Обработка сообщения из канала (вызывается asyncpg на цикле событий)
+        :return:
+        """
+        key, data = self.decode_notify(channel, payload)
+        if key in self._table_list:
+            try:
+                self.add_task(key, data)
+            except Exception:
+                logger.exception("Notify %s failed", key)
+
+    async def _check_period(self) -> None:
+        """
+        Проверка на запуск периодической/первичной задачи
+        (check_is_period может обращаться к базе данных, поэтому выполняется в пуле потоков)
+        :return:
+        """
+        try:
+            if await self.loop.run_in_executor(self.pool_task.executor, self.check_is_period):
+                self.period_task()
+        except Exception:
+            logger.exception("Period task failed")
@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
+import json
+import time
 import signal
+import logging
+import threading
+from collections import deque
 from datetime import datetime
 from pgnotify import await_pg_notifications, get_dbapi_connection
 from thread_pool import ThreadPool
+from connection_pool import ConnectionPool
+from metrics import MetricRegistry, TaskMetrics, MetricServer, MetricLogger
+
+logger = logging.getLogger(__name__)
 
 
 class BaseSVC(object):
@@ -12,7 +21,11 @@ class BaseSVC(object):
     Основные функции:
      - подписка на канал
      - выполнение задач в однопоточном или многопоточном режиме с одной очередью
+       (с приоритетами, справедливым разделением между каналами и ограничением глубины, см. TaskQueue)
      - выполнение периодической и/или первичной задачи по условию
+     - метрики (см. MetricRegistry): время ожидания и выполнения задач пула потоков, ошибки и запросы
+       к базе данных по обработчикам, глубина очереди; выгрузка по HTTP в формате Prometheus
+       и периодическая сводка в журнал
 
     """
     _signals_to_handle = [signal.SIGINT, signal.SIGTERM]
@@ -21,13 +34,31 @@ class BaseSVC(object):
     _db_name = None
     _user = None
     _channel_name = None
+    # Дополнительные каналы подписки (например, собственный канал экземпляра службы)
+    _extra_channel_list = None
     _thread_count = None
     _table_list = None
     _e = None
     _is_period = True
+    # Период (в секундах) проверки на запуск периодической/первичной задачи
+    _period_timeout = 10
+    # Приоритет задач по наименованию функции {наименование: PRIORITY_*} и максимальная глубина очереди
+    _priority_func = None
+    _queue_size = 0
+    # Адрес и порт выгрузки метрик по HTTP (порт 0 - выгрузка отключена) и период (в секундах)
+    # сводки метрик в журнал (0 - сводка отключена)
+    _metrics_host = "127.0.0.1"
+    _metrics_port = 0
+    _metrics_log_interval = 0
 
     connect_string = "host={0} port={1} dbname={2} user={3}"
+    _message_status_query = "UPDATE manager.message SET status = %s WHERE s_id = ANY(%s::uuid[])"
     pool_task = None
+    db_pool = None
+    metrics = None
+    task_metrics = None
+    _metric_server = None
+    _metric_logger = None
     ldt = None
 
     def __init__(self, thread_count: int, host: str, port: str, db_name: str, user: str, channel_name: str) -> None:
@@ -36,7 +67,10 @@ class BaseSVC(object):
 
         Инициализирует:
          - количество потоков
-         - подключение к базе данных
+         - выделенное подключение к базе данных для подписки на канал
+         - реестр метрик и метрики задач
+         - пул подключений к базе данных (по одному подключению на поток пула потоков и поток подписки)
+           с учетом запросов в метриках задач
          - один пул потоков
 
         :param thread_count: количество потоков в пуле потоков
@@ -53,7 +87,13 @@ class BaseSVC(object):
         self._thread_count = thread_count
         self._channel_name = channel_name
         self._e = self.connect()
-        self.pool_task = ThreadPool(self._thread_count)
+        self.metrics = MetricRegistry()
+        self.task_metrics = TaskMetrics(self.metrics)
+        self.metrics.add_collector(self._queue_metrics)
+        self.db_pool = ConnectionPool(self.connect, self._thread_count + 1,
+                                      cursor_factory=self.task_metrics.cursor_factory)
+        self.pool_task = ThreadPool(self._thread_count, self.db_pool, self._priority_func, self._queue_size,
+                                    self.task_metrics)
 
     @property
     def e(self):
@@ -76,22 +116,24 @@ class BaseSVC(object):
         Подписка на список каналов
 
         Основыне задачи метода:
-         - подписка на канал
+         - подписка на канал службы и дополнительные каналы
          - ожидание сообщений
-            - если ни одного сообщения пока не пришло, то производится проверка
-              на признак запуска периодической/первичной задачи
             - если пришло сообщение от одного из каналов, то запускается функция обработки данного сообщения
+            - не реже раза в _period_timeout секунд производится проверка на признак запуска
+              периодической/первичной задачи (в том числе при непрерывном потоке сообщений,
+              например сигналов работоспособности, когда ожидание не завершается по таймауту)
 
         :return:
         """
         if self._table_list:
             is_continue = True
+            period_check_time = None
             while is_continue:
                 try:
                     for n in await_pg_notifications(
                             self._e,
-                            [self._channel_name],
-                            timeout=10,
+                            [self._channel_name] + list(self._extra_channel_list or []),
+                            timeout=self._period_timeout,
                             yield_on_timeout=True,
                             handle_signals=self._signals_to_handle,
                     ):
@@ -99,23 +141,104 @@ class BaseSVC(object):
                             sig = signal.Signals(n)
                             is_continue = False
                             break
-                        elif n is None:
+                        elif n is not None:
+                            key, data = self.decode_notify(n.channel, n.payload)
+                            if key in self._table_list:
+                                self.add_task(key, data)
+                        if period_check_time is None or \
+                                time.monotonic() - period_check_time >= self._period_timeout:
+                            period_check_time = time.monotonic()
                             if self.is_period:
                                 self.period_task()
-                        elif n is not None:
-                            if n.payload in self._table_list:
-                                self.add_task(n.channel, n.payload)
                 except KeyboardInterrupt:
                     if self.pool_task:
                         del self.pool_task
 
+    def decode_notify(self, channel: str, payload: str) -> tuple:
+        """
+        Разбор сообщения из канала
+
+        Варианты сообщений:
+         - наименование сущности-инициатора (прежний формат notify_me) - возвращается наименование сущности
+           без данных, что означает полный поиск изменений в сущности
+         - json с ключом t (формат notify_me с данными об измененной записи) - возвращается наименование
+           сущности и список измененных записей
+         - json с ключами t и ids (формат notify_me_statement, одно сообщение на оператор) - возвращается
+           наименование сущности и список измененных записей, содержащих только идентификатор
+         - иное сообщение (например, задача для функциональной службы) - возвращается канал и сообщение как есть
+
+        :param channel: наименование канала
+        :param payload: сообщение из канала
+        :return: кортеж (ключ для обработки сообщения, данные сообщения)
+        """
+        if payload in self._table_list:
+            return payload, None
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return channel, payload
+        if isinstance(data, dict) and "t" in data:
+            if "ids" in data:
+                return data["t"], [{"id": s_id} for s_id in data["ids"]]
+            return data.pop("t"), [data]
+        return channel, payload
+
     def run(self) -> None:
         """
-        Запуск подписки на список каналов
+        Запуск подписки на список каналов (и выгрузки метрик на время подписки)
 
         :return:
         """
-        self._listen()
+        self.start_metrics()
+        try:
+            self._listen()
+        finally:
+            self.stop_metrics()
+
+    def start_metrics(self) -> None:
+        """
+        Запуск выгрузки метрик по HTTP и сводки метрик в журнал (если включены)
+        :return:
+        """
+        if self.metrics is None:
+            return
+        if self._metrics_port:
+            self._metric_server = MetricServer(self.metrics, self._metrics_host, self._metrics_port)
+            logger.info("Metrics endpoint: http://%s:%s/metrics", self._metrics_host, self._metric_server.port)
+        if self._metrics_log_interval:
+            self._metric_logger = MetricLogger(self.task_metrics, self._metrics_log_interval, self.queue_depth)
+
+    def stop_metrics(self) -> None:
+        """
+        Остановка выгрузки метрик и сводки метрик в журнал
+        :return:
+        """
+        if self._metric_server:
+            self._metric_server.stop()
+            self._metric_server = None
+        if self._metric_logger:
+            self._metric_logger.stop()
+            self._metric_logger = None
+
+    def queue_depth(self):
+        """
+        Глубина очереди задач (None, если у пула задач нет очереди)
+        """
+        tasks = getattr(self.pool_task, "tasks", None)
+        return tasks.qsize() if tasks is not None else None
+
+    def _queue_metrics(self) -> list:
+        """
+        Функция сбора метрик очереди задач: глубина очереди и количество выданных задач по классам приоритета
+        :return: список метрик (см. MetricRegistry.add_collector)
+        """
+        stats = self.pool_task.stats()
+        return [
+            ("svc_queue_depth", "gauge", "Глубина очереди задач", ("priority",),
+             {(priority,): item["depth"] for priority, item in stats.items()}),
+            ("svc_queue_dequeued_total", "counter", "Задачи, выданные из очереди", ("priority",),
+             {(priority,): item["count"] for priority, item in stats.items()}),
+        ]
 
     def connect(self):
         """
@@ -136,6 +259,16 @@ class BaseSVC(object):
         """
         pass
 
+    def set_message_status(self, id_list: list, status: str) -> None:
+        """
+        Изменение статуса отправки списка сообщений одним запросом
+
+        :param id_list: список идентификаторов сообщений из сущности "Сообщения"
+        :param status: статус отправки
+        :return:
+        """
+        self.db_pool.cursor().execute(self._message_status_query, (status, [str(s_id) for s_id in id_list]))
+
     def period_task(self) -> None:
         """
         Периодическая/первичная задача
@@ -154,49 +287,176 @@ class BaseSVC(object):
         return True if not self.ldt else False
 
 
-class NotifyCount(object):
-    _ldt = None
-    _count = None
-    _max_count = None
+class NotifyCoalescer(object):
+    """
+    Адаптивный буфер сообщений
+
+    Накапливает измененные записи из notify одного канала и передает их пачкой в функцию обработки.
+
+    Алгоритм:
+     - если канал простаивал (с последнего notify прошло не меньше max_wait), то пачка
+       передается на обработку сразу
+     - иначе для пачки назначается окно ожидания, которое растет вместе с интенсивностью поступления
+       notify: min_wait * (ожидаемое количество notify за min_wait), но не больше max_wait
+     - если количество notify в пачке достигло max_count, то пачка передается на обработку сразу
+     - передачу пачки на обработку по истечении окна выполняет отдельный поток (таймер),
+       а не цикл ожидания сообщений из канала
+
+    Дополнительно собирается статистика по задержке (от первого notify в пачке до передачи на обработку)
+    и по размеру пачек
+    """
+    _ALPHA = 0.2
+    _STAT_SIZE = 1000
 
-    def __init__(self, max_count: int, wait_time: int):
+    def __init__(self, callback, min_wait: int, max_wait: int, max_count: int) -> None:
         """
-        :param max_count: количество подряд идущих notify
-        :param wait_time: время в секундах, через которое запустить проверку таблицы
+        :param callback: функция обработки пачки, принимает список измененных записей
+                         или None (если необходим поиск по всей сущности)
+        :param min_wait: минимальное окно ожидания в миллисекундах
+        :param max_wait: максимальное окно ожидания в миллисекундах
+        :param max_count: максимальное количество notify в пачке
         """
-        self._count = 0
+        self._callback = callback
+        self._min_wait = min_wait / 1000
+        self._max_wait = max_wait / 1000
         self._max_count = max_count
-        self._wait_time = wait_time
+        self._condition = threading.Condition()
+        self._done = threading.Event()
+        self._row_dict = dict()
+        self._is_full = False
+        self._count = 0
+        self._first_time = None
+        self._last_time = None
+        self._deadline = None
+        self._interval = self._max_wait
+        self._notify_count = 0
+        self._batch_count = 0
+        self._latency_list = deque(maxlen=self._STAT_SIZE)
+        self._batch_size_list = deque(maxlen=self._STAT_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def rate(self) -> float:
+        """
+        Оценка интенсивности поступления notify (количество в секунду)
+        """
+        return 1 / self._interval if self._interval else 0.0
 
-    def is_need_add_task(self) -> bool:
+    def push(self, row_list) -> None:
+        """
+        Добавление notify в буфер
+
+        :param row_list: список измененных записей или None (если необходим поиск по всей сущности)
+        :return:
+        """
+        with self._condition:
+            now = time.monotonic()
+            is_idle = self._last_time is None or now - self._last_time >= self._max_wait
+            if self._last_time is not None:
+                self._interval = self._ALPHA * (now - self._last_time) + (1 - self._ALPHA) * self._interval
+            self._last_time = now
+            self._notify_count += 1
+            self._count += 1
+
+            if row_list is None:
+                self._is_full = True
+                self._row_dict.clear()
+            elif not self._is_full:
+                for row in row_list:
+                    self._row_dict[row["id"]] = row
+
+            if self._deadline is None:
+                self._first_time = now
+                if is_idle:
+                    self._deadline = now
+                else:
+                    window = self._min_wait * max(1.0, self.rate * self._min_wait)
+                    self._deadline = now + min(self._max_wait, window)
+            if self._count >= self._max_count:
+                self._deadline = now
+            self._condition.notify()
+
+    def flush(self) -> None:
         """
-        Если время пустое - инициализируем время только для первой notify, чтобы разницу во времени считать с первой
-        Если времени не меньше wait_time секунд или количество сообщений пришло не меньше max_count,
-        то обнуляем все и возвращаем True -> следует добавить в очередь задачу для данного канала
-        Иначе инкрементируем на единицу количество пришедших notify и возвращаем False -> ожидаем
+        Немедленная передача накопленной пачки на обработку
         :return:
         """
-        self._count += 1
-        if not self._ldt:
-            self._ldt = datetime.now()
-        elif (datetime.now() - self._ldt).seconds >= self._wait_time or self._count >= self._max_count:
-            self._ldt = None
-            self._count = 0
-            return True
-        return False
-
-    def is_need_add_task_by_time(self):
-        if self._ldt and (datetime.now() - self._ldt).seconds >= self._wait_time:
-            self._ldt = None
-            self._count = 0
-            return True
-        return False
+        with self._condition:
+            if self._deadline is not None:
+                self._deadline = time.monotonic()
+                self._condition.notify()
 
-    @property
-    def ldt(self):
-        return self._ldt
+    def _pop(self):
+        """
+        Получение накопленной пачки и обнуление буфера (вызывается под блокировкой)
+        :return: список измененных записей или None (если необходим поиск по всей сущности)
+        """
+        now = time.monotonic()
+        self._batch_count += 1
+        self._latency_list.append(now - self._first_time)
+        self._batch_size_list.append(self._count)
+        row_list = None if self._is_full else list(self._row_dict.values())
+        self._row_dict = dict()
+        self._is_full = False
+        self._count = 0
+        self._first_time = None
+        self._deadline = None
+        return row_list
 
-    @property
-    def wait_time(self):
-        return self._wait_time
+    def _run(self) -> None:
+        """
+        Таймер: ожидание окончания окна и передача пачки на обработку
+        :return:
+        """
+        while not self._done.is_set():
+            with self._condition:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                timeout = self._deadline - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                row_list = self._pop()
+            self._callback(row_list)
+
+    def stop(self) -> None:
+        """
+        Остановка таймера
+        :return:
+        """
+        self._done.set()
+        with self._condition:
+            self._condition.notify()
 
+    def stats(self) -> dict:
+        """
+        Статистика буфера
+        :return: словарь:
+                 - notify_count - количество поступивших notify
+                 - batch_count - количество переданных на обработку пачек
+                 - rate - оценка интенсивности поступления notify (количество в секунду)
+                 - batch_size_avg, batch_size_max - средний и максимальный размер пачки (в notify)
+                 - latency_p50, latency_p99, latency_max - задержка передачи на обработку в миллисекундах
+        """
+        with self._condition:
+            latency_list = sorted(self._latency_list)
+            batch_size_list = list(self._batch_size_list)
+            data = {
+                "notify_count": self._notify_count,
+                "batch_count": self._batch_count,
+                "rate": self.rate,
+            }
+        data["batch_size_avg"] = sum(batch_size_list) / len(batch_size_list) if batch_size_list else 0
+        data["batch_size_max"] = max(batch_size_list) if batch_size_list else 0
+        data["latency_p50"] = self._percentile(latency_list, 0.5) * 1000
+        data["latency_p99"] = self._percentile(latency_list, 0.99) * 1000
+        data["latency_max"] = latency_list[-1] * 1000 if latency_list else 0
+        return data
+
+    @staticmethod
+    def _percentile(value_list: list, q: float) -> float:
+        if not value_list:
+            return 0
+        return value_list[min(len(value_list) - 1, int(q * len(value_list)))]
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import socket
+import hashlib
+import logging
+import threading
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+
+class ShardCluster(object):
+    """
+    Распределение обработки между экземплярами менеджера задач
+
+    Записи аудита и сообщения делятся на shard_count секций (функция manager.shard_of). Собственный поток
+    с выделенным подключением к базе данных каждые renew миллисекунд:
+     - продлевает аренду экземпляра в сущности "Экземпляры менеджера задач" на lease миллисекунд
+     - получает список экземпляров с действующей арендой и распределяет между ними секции
+       (rendezvous hashing: при изменении состава экземпляров переходят только секции выбывшего
+        или к добавленному экземпляру)
+     - освобождает рекомендательные блокировки секций, которые перешли другим экземплярам,
+       и захватывает блокировки своих секций (секция обрабатывается, только пока блокировка захвачена:
+       новый владелец получает секцию после того, как прежний ее освободил)
+     - захватывает блокировку ведущего экземпляра, если она свободна (ведущий выполняет задачи,
+       которые должен выполнять один экземпляр)
+
+    Блокировки сессионные: при потере подключения или аварийной остановке экземпляра они освобождаются
+    СУБД, и секции переходят другим экземплярам после окончания аренды. При ошибке экземпляр сразу
+    перестает обрабатывать все секции, подключение пересоздается в следующем цикле.
+
+    При получении новых секций или роли ведущего вызывается on_change(список новых секций, признак получения
+    роли ведущего). Список секций и признак ведущего читаются без блокировки (неизменяемые значения).
+    """
+    # Пространство ключей рекомендательных блокировок (первый ключ пары) и ключ блокировки ведущего
+    _lock_class = 7301
+    _leader_key = -1
+    _lease_query = """
+        INSERT INTO manager.manager_instance (s_id, host, lease_until)
+        VALUES (%s, %s, now() + %s * interval '1 millisecond')
+            ON CONFLICT (s_id) DO UPDATE SET lease_until = EXCLUDED.lease_until
+    """
+    _member_query = "SELECT s_id FROM manager.manager_instance WHERE lease_until > now() ORDER BY s_id"
+    _expire_query = "DELETE FROM manager.manager_instance WHERE lease_until < now() - %s * interval '1 millisecond'"
+    _leave_query = "DELETE FROM manager.manager_instance WHERE s_id = %s"
+    _lock_query = "SELECT pg_try_advisory_lock(%s, %s)"
+    _unlock_query = "SELECT pg_advisory_unlock(%s, %s)"
+
+    def __init__(self, connect_func, shard_count: int = 64, lease: int = 5000, renew: int = 1000,
+                 on_change=None) -> None:
+        """
+        :param connect_func: функция без аргументов, возвращающая подключение DB-API
+        :param shard_count: количество секций
+        :param lease: срок аренды экземпляра (в миллисекундах)
+        :param renew: период продления аренды и перераспределения секций (в миллисекундах)
+        :param on_change: функция, принимающая список новых секций и признак получения роли ведущего
+        """
+        self._connect_func = connect_func
+        self._shard_count = shard_count
+        self._lease = lease
+        self._renew = renew / 1000
+        self._on_change = on_change
+        self.s_id = str(uuid4())
+        self._host = socket.gethostname()
+        self._connection = None
+        self._shard_list = frozenset()
+        self._is_leader = False
+        self._member_list = []
+        self._rebalance_count = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def shard_count(self) -> int:
+        return self._shard_count
+
+    @property
+    def shard_list(self) -> list:
+        """
+        Секции, которые обрабатывает экземпляр
+        """
+        return list(self._shard_list)
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    @staticmethod
+    def _weight(shard: int, member_id: str) -> int:
+        """
+        Вес пары (секция, экземпляр) для rendezvous hashing
+        """
+        return int.from_bytes(hashlib.md5("{}:{}".format(shard, member_id).encode()).digest()[:8], "big")
+
+    def _target(self, member_list: list) -> set:
+        """
+        Секции экземпляра при заданном составе экземпляров
+        :param member_list: список идентификаторов экземпляров с действующей арендой
+        :return: множество секций
+        """
+        if self.s_id not in member_list:
+            member_list = member_list + [self.s_id]
+        return {shard for shard in range(self._shard_count)
+                if max(member_list, key=lambda member_id: self._weight(shard, member_id)) == self.s_id}
+
+    def _execute(self, cursor, query: str, params: tuple):
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+    def _step(self) -> None:
+        """
+        Один цикл: продление аренды, перераспределение секций, выборы ведущего
+        :return:
+        """
+        if self._connection is None:
+            self._connection = self._connect_func()
+            self._connection.autocommit = True
+        with self._connection.cursor() as cursor:
+            cursor.execute(self._lease_query, (self.s_id, self._host, self._lease))
+            cursor.execute(self._member_query)
+            member_list = [str(row[0]) for row in cursor.fetchall()]
+            target = self._target(member_list)
+
+            shard_list = set(self._shard_list)
+            for shard in shard_list - target:
+                self._execute(cursor, self._unlock_query, (self._lock_class, shard))
+            shard_list &= target
+            new_list = [shard for shard in sorted(target - shard_list)
+                        if self._execute(cursor, self._lock_query, (self._lock_class, shard))]
+            shard_list.update(new_list)
+            self._shard_list = frozenset(shard_list)
+
+            is_new_leader = False
+            if not self._is_leader:
+                is_new_leader = self._is_leader = self._execute(cursor, self._lock_query,
+                                                                (self._lock_class, self._leader_key))
+            if self._is_leader:
+                cursor.execute(self._expire_query, (self._lease,))
+
+        if member_list != self._member_list:
+            logger.info("Manager cluster members: %s, own shards: %s", len(member_list), len(shard_list))
+            self._member_list = member_list
+        if new_list or is_new_leader:
+            self._rebalance_count += 1
+            if self._on_change:
+                self._on_change(new_list, is_new_leader)
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._step()
+            except Exception:
+                logger.exception("Manager cluster step failed")
+                self._reset()
+            self._stop_event.wait(self._renew)
+        self._leave()
+
+    def _reset(self) -> None:
+        """
+        Отказ от всех секций и роли ведущего, закрытие подключения (блокировки освобождает СУБД)
+        :return:
+        """
+        self._shard_list = frozenset()
+        self._is_leader = False
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _leave(self) -> None:
+        """
+        Удаление аренды экземпляра при остановке (секции сразу переходят другим экземплярам)
+        :return:
+        """
+        try:
+            if self._connection is not None:
+                with self._connection.cursor() as cursor:
+                    cursor.execute(self._leave_query, (self.s_id,))
+        except Exception:
+            logger.exception("Manager cluster leave failed")
+        self._reset()
+
+    def stop(self) -> None:
+        """
+        Остановка: удаление аренды и освобождение блокировок
+        :return:
+        """
+        self._stop_event.set()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """
+        Состояние экземпляра
+        :return: словарь {member_count - экземпляров с действующей арендой, shard_count - своих секций,
+                          is_leader - признак ведущего, rebalance_count - получений новых секций или роли ведущего}
+        """
+        return {"member_count": len(self._member_list), "shard_count": len(self._shard_list),
+                "is_leader": self._is_leader, "rebalance_count": self._rebalance_count}
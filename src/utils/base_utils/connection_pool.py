@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+
+class ConnectionPool(object):
+    """
+    Пул подключений к базе данных
+
+    Основные функции:
+     - выдача каждому потоку (например, потоку пула потоков) собственного подключения
+     - ограничение количества одновременно выданных подключений (max_size)
+     - проверка работоспособности подключения перед выдачей, если оно не использовалось дольше ping_time секунд
+     - переподключение при потере подключения
+    """
+
+    def __init__(self, connect_func, max_size: int, ping_time: int = 30, cursor_factory=None) -> None:
+        """
+        :param connect_func: функция без аргументов, создающая подключение DB-API
+        :param max_size: максимальное количество одновременно выданных подключений
+        :param ping_time: время в секундах, после которого подключение проверяется перед выдачей
+        :param cursor_factory: класс курсоров, которые выдает cursor (psycopg2, например, с учетом запросов
+                               в метриках задач - TaskMetrics.cursor_factory); None - курсор по умолчанию
+        """
+        self._connect_func = connect_func
+        self._cursor_factory = cursor_factory
+        self._max_size = max_size
+        self._ping_time = ping_time
+        self._semaphore = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._idle_list = list()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def connection(self):
+        """
+        Получение подключения текущего потока
+        (при первом обращении подключение выдается из пула; если все подключения выданы - ожидание)
+
+        :return: подключение DB-API
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self._semaphore.acquire()
+            with self._lock:
+                connection = self._idle_list.pop() if self._idle_list else None
+            if connection is None or not self._is_alive(connection):
+                connection = self._connect()
+            self._local.connection = connection
+        elif time.monotonic() - self._local.ldt >= self._ping_time and not self._is_alive(connection):
+            connection = self._reconnect()
+        self._local.ldt = time.monotonic()
+        return connection
+
+    def cursor(self):
+        """
+        Получение нового курсора для подключения текущего потока
+        :return: курсор DB-API
+        """
+        if self._cursor_factory is not None:
+            return self.connection().cursor(cursor_factory=self._cursor_factory)
+        return self.connection().cursor()
+
+    def check(self) -> None:
+        """
+        Проверка подключения текущего потока и переподключение при его потере
+        (вызывается, например, после ошибки выполнения задачи)
+        :return:
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and not self._is_alive(connection):
+            self._reconnect()
+
+    def release(self) -> None:
+        """
+        Возврат подключения текущего потока в пул
+        :return:
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            with self._lock:
+                self._idle_list.append(connection)
+            self._semaphore.release()
+
+    def close(self) -> None:
+        """
+        Закрытие подключений, возвращенных в пул
+        :return:
+        """
+        with self._lock:
+            idle_list, self._idle_list = self._idle_list, list()
+        for connection in idle_list:
+            self._close(connection)
+
+    def _connect(self):
+        connection = self._connect_func()
+        connection.autocommit = True
+        return connection
+
+    def _reconnect(self):
+        self._close(self._local.connection)
+        self._local.connection = self._connect()
+        return self._local.connection
+
+    @staticmethod
+    def _is_alive(connection) -> bool:
+        """
+        Проверка работоспособности подключения
+        :param connection: подключение DB-API
+        :return: True или False
+        """
+        if getattr(connection, "closed", False):
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def _close(connection) -> None:
+        try:
+            connection.close()
+        except Exception:
+            pass
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+
+DISPATCH_LEAST_OUTSTANDING = "least_outstanding"
+DISPATCH_HASH = "hash"
+DISPATCH_MODE_LIST = (DISPATCH_LEAST_OUTSTANDING, DISPATCH_HASH)
+
+
+class InstanceDispatcher(object):
+    """
+    Выбор экземпляра функциональной службы для отправки задачи
+
+    Служба может быть запущена несколькими экземплярами (сущность "Экземпляры служб"), у каждого экземпляра
+    своя емкость (количество потоков) и свой канал. Задача отправляется одному работоспособному экземпляру:
+     - least_outstanding - экземпляру с наименьшей загрузкой (количество неотвеченных задач / емкость)
+     - hash - экземпляру, выбранному по ключу задачи (rendezvous hashing: при изменении состава экземпляров
+       переназначаются только задачи выбывшего или добавленного экземпляра)
+
+    Диспетчер хранит в памяти неотвеченные задачи каждого экземпляра; задача освобождается при получении ответа
+    или при выбывании экземпляра. Если ответ может обработать другой процесс (несколько экземпляров менеджера задач),
+    неотвеченные задачи периодически сверяются с базой данных (см. begin_sync, resync).
+    Диспетчер потокобезопасен.
+    """
+
+    def __init__(self, mode: str = DISPATCH_LEAST_OUTSTANDING) -> None:
+        """
+        :param mode: режим выбора экземпляра (DISPATCH_LEAST_OUTSTANDING или DISPATCH_HASH)
+        """
+        if mode not in DISPATCH_MODE_LIST:
+            raise ValueError("Неизвестный режим выбора экземпляра службы: {}".format(mode))
+        self._mode = mode
+        self._lock = threading.Lock()
+        self._instance_dict = dict()
+        self._alive_set = set()
+        self._task_dict = dict()
+        self._outstanding = dict()
+        self._dispatch_count = 0
+        self._sync_dict = None
+        self._sync_count = 0
+
+    def set_instance_list(self, instance_list: list) -> None:
+        """
+        Обновление списка экземпляров служб
+        :param instance_list: список записей {s_id, module_id, channel_name, capacity}
+        :return:
+        """
+        with self._lock:
+            self._instance_dict = {str(instance["s_id"]): instance for instance in instance_list}
+
+    def set_alive(self, instance_id, is_alive: bool) -> list:
+        """
+        Изменение признака работоспособности экземпляра
+        :param instance_id: идентификатор экземпляра
+        :param is_alive: признак работоспособности
+        :return: список неотвеченных задач экземпляра, который стал неработоспособным (задачи освобождаются)
+        """
+        instance_id = str(instance_id)
+        with self._lock:
+            if is_alive:
+                self._alive_set.add(instance_id)
+                return []
+            self._alive_set.discard(instance_id)
+            task_list = [task_id for task_id, task_instance_id in self._task_dict.items()
+                         if task_instance_id == instance_id]
+            for task_id in task_list:
+                del self._task_dict[task_id]
+            self._outstanding.pop(instance_id, None)
+            return task_list
+
+    def has_instance(self, module_id) -> bool:
+        """
+        Признак наличия у службы зарегистрированных экземпляров
+        :param module_id: идентификатор службы
+        :return: True или False
+        """
+        module_id = str(module_id)
+        with self._lock:
+            return any(str(instance["module_id"]) == module_id for instance in self._instance_dict.values())
+
+    def choose(self, module_id, task_id, key=None):
+        """
+        Выбор работоспособного экземпляра службы для задачи и учет задачи как неотвеченной
+        :param module_id: идентификатор службы
+        :param task_id: идентификатор задачи (сообщения)
+        :param key: ключ задачи для режима hash (по умолчанию - идентификатор задачи)
+        :return: запись экземпляра или None, если работоспособных экземпляров нет
+        """
+        module_id = str(module_id)
+        with self._lock:
+            instance_list = [instance for instance_id, instance in self._instance_dict.items()
+                             if instance_id in self._alive_set and str(instance["module_id"]) == module_id]
+            if not instance_list:
+                return None
+            if self._mode == DISPATCH_HASH:
+                key = str(key or task_id)
+                instance = max(instance_list, key=lambda item: self._weight(key, str(item["s_id"])))
+            else:
+                instance = min(instance_list, key=lambda item: (
+                    self._outstanding.get(str(item["s_id"]), 0) / max(item["capacity"] or 1, 1), str(item["s_id"])))
+            instance_id = str(instance["s_id"])
+            self._assign(str(task_id), instance_id)
+            self._dispatch_count += 1
+            return instance
+
+    def assign(self, task_id, instance_id) -> None:
+        """
+        Учет неотвеченной задачи экземпляра (например, при старте менеджера задач)
+        :param task_id: идентификатор задачи (сообщения)
+        :param instance_id: идентификатор экземпляра
+        :return:
+        """
+        with self._lock:
+            self._assign(str(task_id), str(instance_id))
+
+    def _assign(self, task_id: str, instance_id: str) -> None:
+        if self._sync_dict is not None:
+            self._sync_dict[task_id] = instance_id
+        previous_id = self._task_dict.get(task_id)
+        if previous_id is not None:
+            self._outstanding[previous_id] -= 1
+        self._task_dict[task_id] = instance_id
+        self._outstanding[instance_id] = self._outstanding.get(instance_id, 0) + 1
+
+    def release(self, task_id_list: list) -> None:
+        """
+        Освобождение задач, на которые получен ответ
+        :param task_id_list: список идентификаторов задач (сообщений)
+        :return:
+        """
+        with self._lock:
+            for task_id in task_id_list:
+                if self._sync_dict is not None:
+                    self._sync_dict[str(task_id)] = None
+                instance_id = self._task_dict.pop(str(task_id), None)
+                if instance_id is not None:
+                    self._outstanding[instance_id] -= 1
+
+    def begin_sync(self) -> bool:
+        """
+        Начало сверки неотвеченных задач с базой данных: до вызова resync назначения и освобождения задач
+        запоминаются, чтобы не потерять изменения, сделанные во время чтения из базы данных
+        :return: True или False, если сверка уже выполняется
+        """
+        with self._lock:
+            if self._sync_dict is not None:
+                return False
+            self._sync_dict = dict()
+            return True
+
+    def cancel_sync(self) -> None:
+        """
+        Отмена сверки неотвеченных задач (например, при ошибке чтения из базы данных)
+        :return:
+        """
+        with self._lock:
+            self._sync_dict = None
+
+    def resync(self, task_list: list) -> None:
+        """
+        Замена неотвеченных задач прочитанными из базы данных (после begin_sync)
+
+        Учитываются только задачи работоспособных экземпляров; назначения и освобождения задач, сделанные
+        после begin_sync, применяются поверх прочитанных задач.
+
+        :param task_list: список пар (идентификатор задачи, идентификатор экземпляра)
+        :return:
+        """
+        with self._lock:
+            task_dict = {str(task_id): str(instance_id) for task_id, instance_id in task_list
+                         if str(instance_id) in self._alive_set}
+            for task_id, instance_id in (self._sync_dict or {}).items():
+                if instance_id is None:
+                    task_dict.pop(task_id, None)
+                else:
+                    task_dict[task_id] = instance_id
+            self._sync_dict = None
+            self._task_dict = task_dict
+            self._outstanding = dict()
+            for instance_id in task_dict.values():
+                self._outstanding[instance_id] = self._outstanding.get(instance_id, 0) + 1
+            self._sync_count += 1
+
+    @staticmethod
+    def _weight(key: str, instance_id: str) -> int:
+        """
+        Вес пары (ключ, экземпляр) для rendezvous hashing
+        """
+        return int.from_bytes(hashlib.md5((key + instance_id).encode()).digest()[:8], "big")
+
+    def stats(self) -> dict:
+        """
+        Статистика диспетчера
+        :return: словарь {outstanding - неотвеченных задач по экземплярам, alive_count - работоспособных
+                          экземпляров, dispatch_count - отправлено задач, sync_count - сверок с базой данных}
+        """
+        with self._lock:
+            return {"outstanding": dict(self._outstanding), "alive_count": len(self._alive_set),
+                    "dispatch_count": self._dispatch_count, "sync_count": self._sync_count}
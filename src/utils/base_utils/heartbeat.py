@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatSender(object):
+    """
+    Отправка сигналов работоспособности службы
+
+    Собственный поток с выделенным подключением к базе данных (не зависит от загрузки пула подключений и очереди
+    задач) каждые interval миллисекунд вызывает функцию manager.module_heartbeat: сохранение времени сигнала
+    в нежурналируемой сущности "Сигналы работоспособности служб" и notify менеджеру задач.
+    При ошибке подключение пересоздается при следующем сигнале.
+    """
+    _heartbeat_query = "SELECT manager.module_heartbeat(%s, %s)"
+
+    def __init__(self, connect_func, module_id, interval: int = 200, instance_id=None) -> None:
+        """
+        :param connect_func: функция без аргументов, возвращающая подключение DB-API
+        :param module_id: идентификатор службы
+        :param interval: период отправки сигналов (в миллисекундах)
+        :param instance_id: идентификатор экземпляра службы (None - служба без экземпляров)
+        """
+        self._connect_func = connect_func
+        self._module_id = str(module_id)
+        self._instance_id = str(instance_id) if instance_id else None
+        self._interval = interval / 1000
+        self._connection = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _beat(self) -> None:
+        """
+        Отправка одного сигнала
+        :return:
+        """
+        if self._connection is None:
+            self._connection = self._connect_func()
+            self._connection.autocommit = True
+        with self._connection.cursor() as cursor:
+            cursor.execute(self._heartbeat_query, (self._module_id, self._instance_id))
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._beat()
+            except Exception:
+                logger.exception("Heartbeat of module %s failed", self._module_id)
+                self._close()
+            self._stop_event.wait(self._interval)
+        self._close()
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def stop(self) -> None:
+        """
+        Остановка отправки сигналов
+        :return:
+        """
+        self._stop_event.set()
+        self._thread.join()
+
+
+class HeartbeatMonitor(object):
+    """
+    Контроль работоспособности служб по сигналам
+
+    Хранит в памяти время последнего сигнала каждой службы (экземпляра службы). Собственный поток каждые check
+    миллисекунд определяет службы, для которых изменилось состояние (сигнал не приходил дольше timeout миллисекунд
+    или сигнал пришел от неработоспособной службы), и передает все изменения одним вызовом on_change.
+
+    Монитор потокобезопасен.
+    """
+
+    def __init__(self, on_change, timeout: int = 1000, check: int = 100, state: dict = None) -> None:
+        """
+        :param on_change: функция, принимающая словарь {идентификатор службы: признак работоспособности}
+                          с изменившимися состояниями
+        :param timeout: время (в миллисекундах) без сигналов, после которого служба считается неработоспособной
+        :param check: период (в миллисекундах) проверки состояний
+        :param state: начальное состояние {идентификатор службы: (признак работоспособности,
+                      время с последнего сигнала в секундах или None)}
+        """
+        self._on_change = on_change
+        self._timeout = timeout / 1000
+        self._check = check / 1000
+        self._lock = threading.Lock()
+        self._last_seen = dict()
+        self._alive = dict()
+        self._change_count = 0
+        now = time.monotonic()
+        for module_id, (is_alive, age) in (state or {}).items():
+            self._alive[str(module_id)] = bool(is_alive)
+            if age is not None:
+                self._last_seen[str(module_id)] = now - age
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def beat(self, module_id) -> None:
+        """
+        Учет сигнала службы
+        :param module_id: идентификатор службы
+        :return:
+        """
+        with self._lock:
+            self._last_seen[str(module_id)] = time.monotonic()
+
+    def confirm_alive(self, module_id, age: float = 0) -> None:
+        """
+        Подтверждение работоспособности службы, которую монитор счел неработоспособной
+        (например, по времени сигнала в базе данных: сигналы могли задержаться в потоке подписки);
+        изменение состояния не передается в on_change
+        :param module_id: идентификатор службы
+        :param age: время с последнего сигнала в секундах
+        :return:
+        """
+        with self._lock:
+            self._last_seen[str(module_id)] = time.monotonic() - age
+            self._alive[str(module_id)] = True
+
+    def forget(self, module_id_list: list) -> None:
+        """
+        Исключение служб из контроля (например, удаленных экземпляров служб);
+        изменение состояния не передается в on_change
+        :param module_id_list: список идентификаторов служб
+        :return:
+        """
+        with self._lock:
+            for module_id in module_id_list:
+                self._last_seen.pop(str(module_id), None)
+                self._alive.pop(str(module_id), None)
+
+    def is_alive(self, module_id) -> bool:
+        """
+        Признак работоспособности службы
+        :param module_id: идентификатор службы
+        :return: True или False
+        """
+        with self._lock:
+            return self._alive.get(str(module_id), False)
+
+    def state(self) -> dict:
+        """
+        Текущее состояние всех служб (для сверки с сущностью "Службы")
+        :return: словарь {идентификатор службы: признак работоспособности}
+        """
+        with self._lock:
+            return dict(self._alive)
+
+    def _collect(self) -> dict:
+        """
+        Определение изменившихся состояний
+        :return: словарь {идентификатор службы: признак работоспособности}
+        """
+        now = time.monotonic()
+        change_dict = dict()
+        with self._lock:
+            for module_id in set(self._alive) | set(self._last_seen):
+                last_seen = self._last_seen.get(module_id)
+                is_alive = last_seen is not None and now - last_seen <= self._timeout
+                if is_alive != self._alive.get(module_id):
+                    self._alive[module_id] = is_alive
+                    change_dict[module_id] = is_alive
+            self._change_count += len(change_dict)
+        return change_dict
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._check):
+            change_dict = self._collect()
+            if change_dict:
+                try:
+                    self._on_change(change_dict)
+                except Exception:
+                    logger.exception("Heartbeat state change handling failed")
+
+    def stop(self) -> None:
+        """
+        Остановка контроля
+        :return:
+        """
+        self._stop_event.set()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """
+        Статистика монитора
+        :return: словарь {alive_count - работоспособных служб, dead_count - неработоспособных служб,
+                          change_count - изменений состояния}
+        """
+        with self._lock:
+            alive_count = sum(1 for is_alive in self._alive.values() if is_alive)
+            return {"alive_count": alive_count, "dead_count": len(self._alive) - alive_count,
+                    "change_count": self._change_count}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class InFlightRegistry(object):
+    """
+    Реестр записей в обработке
+
+    Хранит идентификаторы записей, переданных в очередь задач, по ключу обработчика.
+    Запись, которая уже передана обработчику и еще не обработана, повторно не передается
+    (повторная постановка схлопывается), после обработки запись освобождается.
+
+    Если запись уже обрабатывается (см. start), то повторная постановка тоже схлопывается, но запись
+    отмечается как измененная во время обработки: release возвращает такие записи, чтобы их поставить
+    в очередь повторно (изменение, которое обработчик мог не увидеть, не теряется).
+
+    Реестр потокобезопасен.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._data = dict()
+        self._running = dict()
+        self._dirty = dict()
+        self._claim_count = 0
+        self._collapse_count = 0
+        self._requeue_count = 0
+
+    def claim(self, key, id_list: list) -> list:
+        """
+        Захват записей для обработки
+        :param key: ключ обработчика
+        :param id_list: список идентификаторов записей
+        :return: список захваченных идентификаторов (без записей, которые уже в обработке, и без повторов)
+        """
+        claim_list = list()
+        with self._lock:
+            id_set = self._data.setdefault(key, set())
+            running_set = self._running.get(key, ())
+            for s_id in id_list:
+                if s_id in id_set:
+                    self._collapse_count += 1
+                    if s_id in running_set:
+                        self._dirty.setdefault(key, set()).add(s_id)
+                else:
+                    id_set.add(s_id)
+                    claim_list.append(s_id)
+            self._claim_count += len(claim_list)
+        return claim_list
+
+    def start(self, key, id_list: list) -> None:
+        """
+        Начало обработки захваченных записей
+        :param key: ключ обработчика
+        :param id_list: список идентификаторов записей
+        :return:
+        """
+        with self._lock:
+            self._running.setdefault(key, set()).update(id_list)
+
+    def release(self, key, id_list: list) -> list:
+        """
+        Освобождение записей после обработки
+        :param key: ключ обработчика
+        :param id_list: список идентификаторов записей
+        :return: список записей, которые были повторно поставлены во время обработки (их нужно поставить
+                 в очередь еще раз)
+        """
+        with self._lock:
+            for data in (self._data, self._running):
+                id_set = data.get(key)
+                if id_set is not None:
+                    id_set.difference_update(id_list)
+                    if not id_set:
+                        del data[key]
+            dirty_set = self._dirty.get(key)
+            if not dirty_set:
+                return []
+            dirty_list = [s_id for s_id in id_list if s_id in dirty_set]
+            dirty_set.difference_update(dirty_list)
+            if not dirty_set:
+                del self._dirty[key]
+            self._requeue_count += len(dirty_list)
+            return dirty_list
+
+    def stats(self) -> dict:
+        """
+        Статистика реестра
+        :return: словарь {in_flight - записей в обработке по ключам, claim_count - захвачено записей,
+                          collapse_count - схлопнуто повторных постановок, requeue_count - поставлено повторно
+                          после обработки}
+        """
+        with self._lock:
+            return {
+                "in_flight": {key: len(id_set) for key, id_set in self._data.items()},
+                "claim_count": self._claim_count,
+                "collapse_count": self._collapse_count,
+                "requeue_count": self._requeue_count,
+            }
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# Границы интервалов гистограмм длительности (в секундах)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    item_list = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(label_names, label_values)]
+    if extra:
+        item_list.append(extra)
+    return "{" + ",".join(item_list) + "}" if item_list else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    """
+    Метрика с метками: значения хранятся по кортежу значений меток
+    """
+    kind = None
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._data = dict()
+
+    def _key(self, label_values: tuple) -> tuple:
+        if len(label_values) != len(self.label_names):
+            raise ValueError("Метрика {} ожидает метки {}".format(self.name, self.label_names))
+        return tuple(label_values)
+
+    def render(self) -> list:
+        line_list = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            item_list = list(self._data.items())
+        for label_values, value in sorted(item_list, key=lambda item: tuple(map(str, item[0]))):
+            line_list.extend(self._render_item(label_values, value))
+        return line_list
+
+    def _render_item(self, label_values: tuple, value) -> list:
+        return ["{}{} {}".format(self.name, _format_labels(self.label_names, label_values), _format_value(value))]
+
+
+class Counter(_Metric):
+    """
+    Счетчик (только увеличивается)
+    """
+    kind = "counter"
+
+    def inc(self, *label_values, value=1) -> None:
+        key = self._key(label_values)
+        with self._lock:
+            self._data[key] = self._data.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._data)
+
+
+class Gauge(_Metric):
+    """
+    Текущее значение
+    """
+    kind = "gauge"
+
+    def set(self, value, *label_values) -> None:
+        key = self._key(label_values)
+        with self._lock:
+            self._data[key] = value
+
+    def inc(self, *label_values, value=1) -> None:
+        key = self._key(label_values)
+        with self._lock:
+            self._data[key] = self._data.get(key, 0) + value
+
+    def dec(self, *label_values, value=1) -> None:
+        self.inc(*label_values, value=-value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._data)
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма: количество наблюдений по интервалам, сумма и количество наблюдений
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, *label_values) -> None:
+        key = self._key(label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                item = self._data[key] = [[0] * len(self.buckets), 0.0, 0]
+            item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+
+    def snapshot(self) -> dict:
+        """
+        :return: словарь {значения меток: (количество по интервалам (не накопленное), сумма, количество)}
+        """
+        with self._lock:
+            return {key: (list(item[0]), item[1], item[2]) for key, item in self._data.items()}
+
+    def _render_item(self, label_values: tuple, value) -> list:
+        bucket_list, total, count = value
+        line_list = list()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_list):
+            cumulative += bucket_count
+            labels = _format_labels(self.label_names, label_values, 'le="{}"'.format(_format_value(bound)))
+            line_list.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+        labels = _format_labels(self.label_names, label_values)
+        line_list.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+        line_list.append("{}_count{} {}".format(self.name, labels, count))
+        return line_list
+
+    def quantile(self, bucket_list: list, q: float) -> float:
+        """
+        Оценка квантиля сверху (граница интервала, в который попадает квантиль)
+        :param bucket_list: количество наблюдений по интервалам (не накопленное)
+        :param q: квантиль (0..1)
+        :return: граница интервала
+        """
+        total = sum(bucket_list)
+        if not total:
+            return 0.0
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_list):
+            cumulative += bucket_count
+            if cumulative >= q * total:
+                return bound
+        return self.buckets[-1]
+
+
+class MetricRegistry(object):
+    """
+    Реестр метрик службы
+
+    Основные функции:
+     - создание (или получение уже созданных) счетчиков, текущих значений и гистограмм
+     - функции сбора (collector): вызываются при выгрузке и возвращают текущие значения, которые
+       служба уже считает сама (глубина очереди, статистика буферов сообщений)
+     - выгрузка в текстовом формате Prometheus
+
+    Обновление метрик потокобезопасно; блокировка - на метрику, поэтому потоки, обновляющие разные
+    метрики, не ждут друг друга.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metric_dict = dict()
+        self._collector_list = list()
+
+    def _get(self, cls, name: str, description: str, label_names: tuple, **kwargs):
+        with self._lock:
+            metric = self._metric_dict.get(name)
+            if metric is None:
+                metric = self._metric_dict[name] = cls(name, description, label_names, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Метрика {} уже зарегистрирована с типом {}".format(name, metric.kind))
+            return metric
+
+    def counter(self, name: str, description: str, label_names: tuple = ()) -> Counter:
+        return self._get(Counter, name, description, label_names)
+
+    def gauge(self, name: str, description: str, label_names: tuple = ()) -> Gauge:
+        return self._get(Gauge, name, description, label_names)
+
+    def histogram(self, name: str, description: str, label_names: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, label_names, buckets=buckets)
+
+    def get(self, name: str):
+        return self._metric_dict.get(name)
+
+    def add_collector(self, func) -> None:
+        """
+        Добавление функции сбора
+        :param func: функция без аргументов, возвращающая список кортежей
+                     (наименование, тип (gauge или counter), описание, список меток, {значения меток: значение})
+        :return:
+        """
+        self._collector_list.append(func)
+
+    def render(self) -> str:
+        """
+        Выгрузка метрик в текстовом формате Prometheus
+        :return: текст
+        """
+        with self._lock:
+            metric_list = list(self._metric_dict.values())
+        line_list = list()
+        for metric in sorted(metric_list, key=lambda item: item.name):
+            line_list.extend(metric.render())
+        for func in self._collector_list:
+            try:
+                item_list = func()
+            except Exception:
+                logger.exception("Metric collector %s failed", getattr(func, "__name__", func))
+                continue
+            for name, kind, description, label_names, data in item_list:
+                line_list.append("# HELP {} {}".format(name, description))
+                line_list.append("# TYPE {} {}".format(name, kind))
+                for label_values, value in data.items():
+                    if value is not None:
+                        line_list.append("{}{} {}".format(name, _format_labels(label_names, label_values),
+                                                          _format_value(value)))
+        return "\n".join(line_list) + "\n"
+
+
+class TaskMetrics(object):
+    """
+    Метрики выполнения задач пула (метка handler - наименование обработчика)
+
+     - svc_task_total, svc_task_errors_total - количество выполненных задач и задач с ошибкой
+     - svc_task_duration_seconds - длительность выполнения (гистограмма)
+     - svc_task_wait_seconds - время ожидания в очереди (гистограмма)
+     - svc_sql_queries_total, svc_sql_seconds_total - количество и время запросов к базе данных,
+       выполненных в задаче (через курсоры cursor_factory, подключения SQLAlchemy с instrument_engine
+       и подключения Django с django_execute_wrapper)
+     - svc_workers_busy - количество потоков, выполняющих задачу
+
+    Счетчики запросов задачи хранятся в данных потока: [количество, время] или None, если поток
+    не выполняет задачу (запросы вне задач не учитываются).
+    """
+
+    def __init__(self, registry: MetricRegistry) -> None:
+        self.registry = registry
+        self._local = threading.local()
+        self.cursor_factory = type("MetricCursor", (MetricCursor,), {"metrics": self})
+        self.task_count = registry.counter("svc_task_total", "Выполненные задачи", ("handler",))
+        self.error_count = registry.counter("svc_task_errors_total", "Задачи, завершившиеся ошибкой", ("handler",))
+        self.duration = registry.histogram("svc_task_duration_seconds", "Длительность выполнения задачи",
+                                           ("handler",))
+        self.wait = registry.histogram("svc_task_wait_seconds", "Время ожидания задачи в очереди", ("handler",))
+        self.sql_count = registry.counter("svc_sql_queries_total", "Запросы к базе данных в задачах", ("handler",))
+        self.sql_time = registry.counter("svc_sql_seconds_total", "Время запросов к базе данных в задачах",
+                                         ("handler",))
+        self.busy = registry.gauge("svc_workers_busy", "Потоки, выполняющие задачу")
+
+    def begin(self, name: str, wait: float = None) -> float:
+        """
+        Начало выполнения задачи в текущем потоке
+        :param name: наименование обработчика
+        :param wait: время ожидания в очереди в секундах (None - не учитывается)
+        :return: время начала
+        """
+        if wait is not None:
+            self.wait.observe(wait, name)
+        self.busy.inc()
+        self._local.sql = [0, 0.0]
+        return time.perf_counter()
+
+    def end(self, name: str, start: float, is_error: bool = False) -> None:
+        """
+        Окончание выполнения задачи в текущем потоке
+        :param name: наименование обработчика
+        :param start: время начала (см. begin)
+        :param is_error: признак ошибки
+        :return:
+        """
+        self.observe(name, time.perf_counter() - start, is_error)
+        sql = getattr(self._local, "sql", None)
+        self._local.sql = None
+        if sql and sql[0]:
+            self.sql_count.inc(name, value=sql[0])
+            self.sql_time.inc(name, value=sql[1])
+        self.busy.dec()
+
+    def observe(self, name: str, duration: float, is_error: bool = False) -> None:
+        """
+        Учет выполненной задачи без учета запросов (например, корутины на цикле событий)
+        :param name: наименование обработчика
+        :param duration: длительность выполнения в секундах
+        :param is_error: признак ошибки
+        :return:
+        """
+        self.duration.observe(duration, name)
+        self.task_count.inc(name)
+        if is_error:
+            self.error_count.inc(name)
+
+    def track_sql(self, duration: float) -> None:
+        """
+        Учет запроса к базе данных в задаче, которую выполняет текущий поток
+        :param duration: время выполнения запроса в секундах
+        :return:
+        """
+        sql = getattr(self._local, "sql", None)
+        if sql is not None:
+            sql[0] += 1
+            sql[1] += duration
+
+    def django_execute_wrapper(self, execute, sql, params, many, context):
+        """
+        Обертка выполнения запросов Django (connection.execute_wrappers) с учетом запросов в задаче
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.track_sql(time.perf_counter() - start)
+
+    def instrument_engine(self, engine) -> None:
+        """
+        Учет запросов SQLAlchemy в задачах
+        :param engine: Engine SQLAlchemy
+        :return:
+        """
+        from sqlalchemy import event
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("metric_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _after(conn, cursor, statement, parameters, context, executemany):
+            self.track_sql(time.perf_counter() - conn.info["metric_start"].pop())
+
+
+class MetricCursor(psycopg2.extensions.cursor):
+    """
+    Курсор psycopg2 с учетом запросов в задаче текущего потока
+    (используется подкласс с заданными метриками - TaskMetrics.cursor_factory)
+    """
+    metrics = None
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.metrics.track_sql(time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.metrics.track_sql(time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.metrics.track_sql(time.perf_counter() - start)
+
+
+class MetricServer(object):
+    """
+    HTTP-сервер выгрузки метрик в формате Prometheus (GET /metrics) в собственном потоке
+    """
+
+    def __init__(self, registry: MetricRegistry, host: str, port: int) -> None:
+        """
+        :param registry: реестр метрик
+        :param host: адрес (рекомендуется локальный - 127.0.0.1)
+        :param port: порт
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class MetricLogger(object):
+    """
+    Периодическая сводка метрик задач в журнал (в собственном потоке)
+
+    Каждые interval секунд для каждого обработчика, выполнявшего задачи за период, выводится: количество
+    задач и ошибок, средняя длительность и оценка 99-го процентиля длительности, среднее ожидание в очереди,
+    запросов к базе данных на задачу.
+    """
+
+    def __init__(self, task_metrics: TaskMetrics, interval: int, queue_depth=None) -> None:
+        """
+        :param task_metrics: метрики задач
+        :param interval: период сводки в секундах
+        :param queue_depth: функция без аргументов, возвращающая глубину очереди задач (или None)
+        """
+        self._metrics = task_metrics
+        self._interval = interval
+        self._queue_depth = queue_depth
+        self._previous = self._snapshot()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _snapshot(self) -> dict:
+        return {"duration": self._metrics.duration.snapshot(), "wait": self._metrics.wait.snapshot(),
+                "error": self._metrics.error_count.snapshot(), "sql": self._metrics.sql_count.snapshot()}
+
+    def summary(self) -> list:
+        """
+        Сводка за период с предыдущего вызова
+        :return: список строк (по строке на обработчик)
+        """
+        current, previous = self._snapshot(), self._previous
+        self._previous = current
+        line_list = list()
+        for key, (bucket_list, total, count) in sorted(current["duration"].items()):
+            old_bucket_list, old_total, old_count = previous["duration"].get(key, ([0] * len(bucket_list), 0.0, 0))
+            count -= old_count
+            if not count:
+                continue
+            bucket_list = [new - old for new, old in zip(bucket_list, old_bucket_list)]
+            _, wait_total, wait_count = current["wait"].get(key, (None, 0.0, 0))
+            _, old_wait_total, old_wait_count = previous["wait"].get(key, (None, 0.0, 0))
+            wait_count -= old_wait_count
+            line_list.append(
+                "{}: {} tasks, {} errors, avg {:.1f} ms, p99 <= {:.1f} ms, wait avg {:.1f} ms, {:.1f} sql/task".format(
+                    key[0], count, current["error"].get(key, 0) - previous["error"].get(key, 0),
+                    (total - old_total) / count * 1000, self._metrics.duration.quantile(bucket_list, 0.99) * 1000,
+                    (wait_total - old_wait_total) / wait_count * 1000 if wait_count else 0.0,
+                    (current["sql"].get(key, 0) - previous["sql"].get(key, 0)) / count))
+        return line_list
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            try:
+                line_list = self.summary()
+                if line_list:
+                    depth = self._queue_depth() if self._queue_depth else None
+                    logger.info("Metrics for %s s (queue depth %s):\n  %s", self._interval, depth,
+                                "\n  ".join(line_list))
+            except Exception:
+                logger.exception("Metric summary failed")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict, namedtuple
+from sqlalchemy import text
+
+# Набор объектов задачи: порядковый номер операции задачи-источника, идентификаторы объектов
+ObjectSet = namedtuple("ObjectSet", "number object_id_list")
+# Запись кэша базовой задачи: последний номер операции, связи которой окончательны, и ближайший к нему набор
+_CacheEntry = namedtuple("_CacheEntry", "final_number object_set")
+
+
+class ObjectResolver(object):
+    """
+    Поиск объектов задач
+
+    Набор объектов задачи - объекты, связанные (сущность "Связь аудита выполнения задач с объектами")
+    с ближайшей задачей той же базовой задачи, порядковый номер операции которой не больше номера операции
+    данной задачи.
+
+    Основные функции:
+     - поиск наборов для списка задач одним запросом (оконная функция по задачам базовой задачи)
+     - кэш по базовой задаче с вытеснением давно не использованных записей (LRU): задачи с меньшими номерами
+       операций уже выполнены, и их связи окончательны, поэтому для следующей задачи той же базовой задачи
+       запрос просматривает только задачи с номерами операций после последнего окончательного,
+       а если связей там нет - используется набор из кэша
+
+    Кэш потокобезопасен.
+    """
+    _resolve_query = """
+        WITH target AS (
+            SELECT t.task_log_id, t.from_number, tl.main_task_log_id, a.number
+              FROM unnest(CAST(:task_log_id_list AS uuid[]), CAST(:from_number_list AS integer[]))
+                   AS t (task_log_id, from_number)
+              JOIN manager.task_log AS tl ON tl.s_id = t.task_log_id
+              JOIN manager.action AS a ON a.s_id = tl.action_id
+        ), linked AS (
+            SELECT t.task_log_id, a.number, o.object_id,
+                   dense_rank() OVER (PARTITION BY t.task_log_id ORDER BY a.number DESC, l.s_id) AS rank
+              FROM target AS t
+              JOIN manager.task_log AS l ON l.main_task_log_id = t.main_task_log_id
+              JOIN manager.action AS a ON a.s_id = l.action_id
+              JOIN manager.object_to_task_log AS o ON o.task_log_id = l.s_id
+             WHERE a.number <= t.number
+               AND (t.from_number IS NULL OR t.from_number > t.number OR a.number >= t.from_number)
+        )
+        SELECT t.task_log_id, t.main_task_log_id, t.number, l.number, l.object_id
+          FROM target AS t
+          LEFT JOIN linked AS l ON l.task_log_id = t.task_log_id AND l.rank = 1
+    """
+
+    def __init__(self, session, max_size: int = 1000) -> None:
+        """
+        :param session: сессия SQLAlchemy (scoped_session)
+        :param max_size: максимальное количество базовых задач в кэше (0 - без кэша)
+        """
+        self._session = session
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._hit_count = 0
+        self._miss_count = 0
+
+    def _get(self, main_task_log_id):
+        with self._lock:
+            entry = self._data.get(main_task_log_id)
+            if entry is not None:
+                self._data.move_to_end(main_task_log_id)
+            return entry
+
+    def _put(self, main_task_log_id, entry: _CacheEntry) -> None:
+        if not self._max_size:
+            return
+        with self._lock:
+            current = self._data.get(main_task_log_id)
+            if current is None or current.final_number < entry.final_number:
+                self._data[main_task_log_id] = entry
+            self._data.move_to_end(main_task_log_id)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def resolve(self, task_log_list: list) -> dict:
+        """
+        Поиск наборов объектов для списка задач одним запросом
+        :param task_log_list: список записей из сущности "Аудит выполнения задач"
+        :return: словарь {идентификатор задачи: набор объектов (ObjectSet) или None}
+        """
+        entry_dict = {str(task_log.s_id): self._get(str(task_log.main_task_log_id)) for task_log in task_log_list}
+        if not entry_dict:
+            return dict()
+        result = self._session.execute(text(self._resolve_query), {
+            "task_log_id_list": list(entry_dict.keys()),
+            "from_number_list": [entry.final_number + 1 if entry else None for entry in entry_dict.values()],
+        })
+        row_dict = dict()
+        for task_log_id, main_task_log_id, number, link_number, object_id in result:
+            item = row_dict.setdefault(str(task_log_id), [str(main_task_log_id), number, link_number, []])
+            if object_id is not None:
+                item[3].append(object_id)
+
+        object_set_dict = dict()
+        for task_log_id, (main_task_log_id, number, link_number, object_id_list) in row_dict.items():
+            entry = entry_dict[task_log_id]
+            if entry and entry.final_number >= number:
+                # кэш построен по задаче с большим номером операции (например, при перезапуске задачи)
+                entry = None
+            if object_id_list:
+                object_set = ObjectSet(link_number, object_id_list)
+            else:
+                object_set = entry.object_set if entry else None
+            if entry and not object_id_list:
+                self._hit_count += 1
+            else:
+                self._miss_count += 1
+            object_set_dict[task_log_id] = object_set
+            # задачи с меньшими номерами операций выполнены: их связи окончательны
+            # (связи самой задачи могут появиться при ее выполнении - набор по ним не кэшируется)
+            if object_set is None or object_set.number < number:
+                self._put(main_task_log_id, _CacheEntry(number - 1, object_set))
+        return object_set_dict
+
+    def invalidate(self, main_task_log_id=None) -> None:
+        """
+        Сброс кэша базовой задачи (или всего кэша, если main_task_log_id не указан)
+        :param main_task_log_id: идентификатор записи из сущности "Аудит выполнения базовых задач"
+        :return:
+        """
+        with self._lock:
+            if main_task_log_id:
+                self._data.pop(str(main_task_log_id), None)
+            else:
+                self._data.clear()
+
+    def stats(self) -> dict:
+        """
+        Статистика кэша
+        :return: словарь {size - базовых задач в кэше, hit_count - наборов из кэша,
+                          miss_count - наборов из базы данных}
+        """
+        return {"size": len(self._data), "hit_count": self._hit_count, "miss_count": self._miss_count}
+
+
+class ChunkedObjectList(object):
+    """
+    Ленивый список записей модели по списку идентификаторов
+
+    Записи загружаются при итерации частями по chunk_size идентификаторов (один запрос на часть),
+    в памяти одновременно находится только одна часть. Длина списка - количество идентификаторов
+    (записи, которых нет в модели, при итерации пропускаются).
+    """
+
+    def __init__(self, session, model, object_id_list: list, chunk_size: int = 1000) -> None:
+        """
+        :param session: сессия SQLAlchemy
+        :param model: модель SQLAlchemy
+        :param object_id_list: список идентификаторов записей
+        :param chunk_size: количество идентификаторов в части
+        """
+        self._session = session
+        self._model = model
+        self._object_id_list = list(object_id_list)
+        self._chunk_size = chunk_size
+        self._primary_key = getattr(model, model.__table__.primary_key[0].name)
+
+    @property
+    def object_id_list(self) -> list:
+        return list(self._object_id_list)
+
+    def __len__(self) -> int:
+        return len(self._object_id_list)
+
+    def __bool__(self) -> bool:
+        return bool(self._object_id_list)
+
+    def chunks(self):
+        """
+        Итерация по частям
+        :return: генератор списков записей
+        """
+        for start in range(0, len(self._object_id_list), self._chunk_size):
+            chunk = self._object_id_list[start:start + self._chunk_size]
+            row_list = self._session.query(self._model).filter(self._primary_key.in_(chunk)).all()
+            if row_list:
+                yield row_list
+
+    def __iter__(self):
+        for row_list in self.chunks():
+            for row in row_list:
+                yield row
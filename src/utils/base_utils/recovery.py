@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class RecoveryEngine(object):
+    """
+    Повторная отправка работы после восстановления службы
+
+    Для каждой службы (ключа) хранится задание восстановления - список записей для повторной отправки.
+    Собственный поток передает записи пачками по batch_size записей функции dispatch_func
+    с ограничением скорости rate записей в секунду для каждой службы (восстановившаяся служба
+    не получает весь накопленный объем сразу); задания разных служб чередуются.
+
+    Повторный запуск задания для службы заменяет текущее задание, отмена - удаляет его
+    (например, если служба снова стала неработоспособной).
+
+    Движок потокобезопасен.
+    """
+
+    def __init__(self, dispatch_func, batch_size: int = 100, rate: int = 500) -> None:
+        """
+        :param dispatch_func: функция отправки пачки, принимающая ключ и список записей
+        :param batch_size: максимальный размер пачки
+        :param rate: максимальная скорость отправки (записей в секунду для одного ключа, 0 - без ограничения)
+        """
+        self._dispatch_func = dispatch_func
+        self._batch_size = batch_size
+        self._rate = rate
+        self._condition = threading.Condition()
+        self._job_dict = dict()
+        self._is_stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def start(self, key, item_list: list) -> None:
+        """
+        Запуск задания восстановления
+        :param key: ключ (идентификатор службы)
+        :param item_list: список записей для повторной отправки
+        :return:
+        """
+        with self._condition:
+            self._job_dict[key] = {"queue": deque(item_list), "total": len(item_list), "dispatched": 0,
+                                   "start": time.monotonic(), "next": time.monotonic()}
+            self._condition.notify()
+        logger.info("Recovery of %s started: %s items", key, len(item_list))
+
+    def cancel(self, key) -> None:
+        """
+        Отмена задания восстановления
+        :param key: ключ (идентификатор службы)
+        :return:
+        """
+        with self._condition:
+            job = self._job_dict.pop(key, None)
+        if job:
+            logger.info("Recovery of %s cancelled: %s of %s items dispatched", key, job["dispatched"], job["total"])
+
+    def _next_batch(self):
+        """
+        Ожидание и получение следующей пачки (задание с наименьшим временем следующей отправки)
+        :return: кортеж (ключ, пачка, задание) или None при остановке
+        """
+        with self._condition:
+            while not self._is_stop:
+                if not self._job_dict:
+                    self._condition.wait()
+                    continue
+                key, job = min(self._job_dict.items(), key=lambda item: item[1]["next"])
+                timeout = job["next"] - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                queue = job["queue"]
+                batch = [queue.popleft() for _ in range(min(self._batch_size, len(queue)))]
+                job["dispatched"] += len(batch)
+                if self._rate:
+                    job["next"] = time.monotonic() + len(batch) / self._rate
+                if not queue:
+                    del self._job_dict[key]
+                return key, batch, job
+            return None
+
+    def _run(self) -> None:
+        while True:
+            item = self._next_batch()
+            if item is None:
+                return
+            key, batch, job = item
+            try:
+                if batch:
+                    self._dispatch_func(key, batch)
+            except Exception:
+                logger.exception("Recovery batch of %s failed", key)
+            if not job["queue"]:
+                logger.info("Recovery of %s finished: %s items in %.1f s", key, job["dispatched"],
+                            time.monotonic() - job["start"])
+
+    def stop(self) -> None:
+        """
+        Остановка движка (незавершенные задания отбрасываются)
+        :return:
+        """
+        with self._condition:
+            self._is_stop = True
+            self._condition.notify()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """
+        Ход выполнения заданий восстановления
+        :return: словарь {ключ: {total - записей в задании, dispatched - отправлено записей,
+                                 elapsed - время выполнения в секундах}}
+        """
+        now = time.monotonic()
+        with self._condition:
+            return {key: {"total": job["total"], "dispatched": job["dispatched"], "elapsed": now - job["start"]}
+                    for key, job in self._job_dict.items()}
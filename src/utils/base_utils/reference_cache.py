@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class ReferenceCache(object):
+    """
+    Кэш справочных сущностей
+
+    Основные функции:
+     - загрузка справочной сущности целиком при первом обращении к ней
+     - поиск записи по идентификатору (s_id) или по системному наименованию (system_name)
+     - сброс сущности по notify об ее изменении (следующее обращение загрузит сущность заново)
+
+    Записи хранятся как словари {атрибут: значение}, идентификаторы приводятся к строке.
+    Кэш потокобезопасен: загрузка и сброс выполняются под блокировкой.
+    """
+    _query_dict = {
+        "manager.task_completion_status": "SELECT s_id, name, system_name FROM manager.task_completion_status",
+        "manager.module": "SELECT s_id, name, system_name, channel_name, status FROM manager.module",
+        "manager.module_instance": "SELECT s_id, module_id, channel_name, capacity FROM manager.module_instance",
+        "manager.method_module": "SELECT s_id, module_id, name, system_name FROM manager.method_module",
+        "manager.action": "SELECT s_id, task_id, method_id, name, number FROM manager.action",
+        "manager.command": "SELECT s_id, action_id, method_id, parent_id, name, is_parallel, number "
+                           "FROM manager.command",
+    }
+
+    def __init__(self, cursor_func) -> None:
+        """
+        :param cursor_func: функция без аргументов, возвращающая курсор DB-API для загрузки сущностей
+        """
+        self._cursor_func = cursor_func
+        self._lock = threading.RLock()
+        self._data = dict()
+
+    @property
+    def table_list(self) -> list:
+        return list(self._query_dict.keys())
+
+    def _load(self, table: str) -> dict:
+        """
+        Получение данных сущности (с загрузкой при необходимости)
+        :param table: наименование сущности со схемой
+        :return: словарь {"s_id": {идентификатор: запись}, "system_name": {системное наименование: запись}}
+        """
+        data = self._data.get(table)
+        if data is not None:
+            return data
+        with self._lock:
+            data = self._data.get(table)
+            if data is None:
+                cursor = self._cursor_func()
+                cursor.execute(self._query_dict[table])
+                column_list = [column[0] for column in cursor.description]
+                data = {"s_id": dict(), "system_name": dict()}
+                for values in cursor.fetchall():
+                    row = dict(zip(column_list, values))
+                    for key in ("s_id", "module_id", "method_id", "action_id", "task_id", "parent_id"):
+                        if row.get(key) is not None:
+                            row[key] = str(row[key])
+                    data["s_id"][row["s_id"]] = row
+                    if "system_name" in row:
+                        data["system_name"][row["system_name"]] = row
+                self._data[table] = data
+            return data
+
+    def invalidate(self, table: str = None) -> None:
+        """
+        Сброс сущности (или всех сущностей, если table не указана)
+        :param table: наименование сущности со схемой
+        :return:
+        """
+        with self._lock:
+            if table:
+                self._data.pop(table, None)
+            else:
+                self._data.clear()
+
+    def get(self, table: str, s_id):
+        """
+        Получение записи по идентификатору
+        :param table: наименование сущности со схемой
+        :param s_id: идентификатор
+        :return: запись или None
+        """
+        return self._load(table)["s_id"].get(str(s_id))
+
+    def get_by_name(self, table: str, system_name: str):
+        """
+        Получение записи по системному наименованию
+        :param table: наименование сущности со схемой
+        :param system_name: системное наименование
+        :return: запись или None
+        """
+        return self._load(table)["system_name"].get(system_name)
+
+    def all(self, table: str) -> list:
+        """
+        Получение всех записей сущности
+        :param table: наименование сущности со схемой
+        :return: список записей
+        """
+        return list(self._load(table)["s_id"].values())
+
+    def status_id(self, system_name: str) -> str:
+        """
+        Получение идентификатора статуса выполнения задачи
+        :param system_name: системное наименование статуса
+        :return: идентификатор
+        """
+        return self.get_by_name("manager.task_completion_status", system_name)["s_id"]
+
+    def status_id_list(self, *system_name_list) -> list:
+        """
+        Получение списка идентификаторов статусов выполнения задачи
+        :param system_name_list: системные наименования статусов
+        :return: список идентификаторов
+        """
+        return [self.status_id(system_name) for system_name in system_name_list]
+
+    def module(self, s_id):
+        """
+        Получение службы по идентификатору
+        :param s_id: идентификатор службы
+        :return: запись или None
+        """
+        return self.get("manager.module", s_id)
+
+    def active_action_id_list(self) -> list:
+        """
+        Получение списка операций, методы которых выполняются работоспособными службами
+        :return: список идентификаторов операций
+        """
+        module_dict = self._load("manager.module")["s_id"]
+        method_dict = self._load("manager.method_module")["s_id"]
+        action_id_list = list()
+        for action in self.all("manager.action"):
+            method = method_dict.get(action["method_id"])
+            if method and module_dict.get(method["module_id"], {}).get("status"):
+                action_id_list.append(action["s_id"])
+        return action_id_list
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import time
+from uuid import uuid4
+from datetime import datetime
+from collections import namedtuple
+
+# Ход выполнения задачи: доля выполнения (0..1 или None) и текст для пользовательского интерфейса
+Progress = namedtuple("Progress", "value message")
+Progress.__new__.__defaults__ = (None, None)
+
+
+class ResultStream(object):
+    """
+    Потоковый результат задачи функциональной службы
+
+    Метод службы - генератор: каждое значение, выданное через yield, - часть результата,
+    значение Progress - ход выполнения; значение, возвращенное генератором (return), - кортеж
+    (result, is_error, data), как у обычного метода.
+
+    Основные функции:
+     - части результата накапливаются и записываются в сущность "Данные сообщений" пачками по chunk_size
+       частей (одна запись на пачку) - в памяти находится не больше одной пачки
+     - ход выполнения передается сообщениями с типом "Информация" не чаще одного раза в interval
+       миллисекунд и при записи каждой пачки (последний ход выполнения, количество частей результата)
+     - данные ответного сообщения дополняются ссылкой на данные результата: идентификатор ответного сообщения
+       задается заранее (message_id), количество пачек и частей результата
+
+    Пачки и сообщения о ходе выполнения фиксируются в транзакции сессии метода.
+    """
+
+    def __init__(self, session, model, payload_model, progress_data: dict = None, chunk_size: int = 1000,
+                 interval: int = 1000) -> None:
+        """
+        :param session: сессия SQLAlchemy
+        :param model: модель сущности "Сообщения"
+        :param payload_model: модель сущности "Данные сообщений"
+        :param progress_data: атрибуты сообщений о ходе выполнения (отправитель, получатель, тип, статус,
+                              ссылки на задачу) без данных; None - сообщения о ходе выполнения не создаются
+        :param chunk_size: количество частей результата в пачке
+        :param interval: минимальный период (в миллисекундах) сообщений о ходе выполнения
+        """
+        self._session = session
+        self._model = model
+        self._payload_model = payload_model
+        self._progress_data = progress_data
+        self._chunk_size = chunk_size
+        self._interval = interval / 1000
+        self.message_id = uuid4()
+        self._buffer = list()
+        self._progress = Progress()
+        self._is_progress_changed = False
+        self._last_time = time.monotonic()
+        self.chunk_count = 0
+        self.item_count = 0
+        self.progress_count = 0
+
+    def consume(self, generator) -> tuple:
+        """
+        Выполнение метода-генератора
+        :param generator: генератор метода службы
+        :return: кортеж (result, is_error, data) с данными результата в data
+        """
+        while True:
+            try:
+                item = next(generator)
+            except StopIteration as stop:
+                value = stop.value
+                break
+            if isinstance(item, Progress):
+                self._progress = item
+                self._is_progress_changed = True
+            else:
+                self._buffer.append(item)
+                self.item_count += 1
+            if len(self._buffer) >= self._chunk_size:
+                self._flush()
+            elif self._is_progress_changed and time.monotonic() - self._last_time >= self._interval:
+                self._flush()
+        if self._buffer:
+            self._write_chunk()
+            self._session.commit()
+
+        result, is_error, data = value if value is not None else (None, False, None)
+        if self.chunk_count:
+            data = dict(data or {})
+            data["payload"] = {"message_id": str(self.message_id), "chunk_count": self.chunk_count,
+                               "item_count": self.item_count}
+        return result, is_error, data
+
+    def _write_chunk(self) -> None:
+        """
+        Запись пачки частей результата
+        :return:
+        """
+        self._session.add(self._payload_model(message_id=self.message_id, number=self.chunk_count,
+                                              data=self._buffer))
+        self._buffer = list()
+        self.chunk_count += 1
+
+    def _flush(self) -> None:
+        """
+        Запись накопленной пачки и сообщения о ходе выполнения
+        :return:
+        """
+        if self._buffer:
+            self._write_chunk()
+        if self._progress_data is not None:
+            data = {"message": self._progress.message or "Выполняется", "item_count": self.item_count}
+            if self._progress.value is not None:
+                data["progress"] = self._progress.value
+            self._session.add(self._model(date_created=datetime.now(), data=data, **self._progress_data))
+            self.progress_count += 1
+        self._session.commit()
+        self._is_progress_changed = False
+        self._last_time = time.monotonic()
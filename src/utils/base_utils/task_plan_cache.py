@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import namedtuple
+
+# Команда плана: идентификатор, метод, признак параллельного выполнения, порядковый номер, дочерние команды
+CommandPlan = namedtuple("CommandPlan", "s_id method_id is_parallel number child_list")
+# Операция плана: идентификатор, метод, дерево команд (команды верхнего уровня по порядку)
+ActionPlan = namedtuple("ActionPlan", "s_id method_id command_list")
+
+
+class TaskPlanCache(object):
+    """
+    Кэш скомпилированных планов базовых задач
+
+    План базовой задачи - упорядоченный список операций всех задач из последовательности задач
+    (по номеру в последовательности, затем по номеру операции) с деревом команд каждой операции
+    (команды одного уровня упорядочены по номеру, признак is_parallel сохраняется).
+
+    Основные функции:
+     - компиляция планов для списка базовых задач одним запросом при первом обращении к ним
+     - сброс всех планов по notify об изменении структуры задач (базовые задачи, последовательности задач,
+       операции, команды)
+
+    Кэш потокобезопасен: компиляция и сброс выполняются под блокировкой.
+    """
+    _table_list = ["manager.base_task", "manager.task_sequence", "manager.action", "manager.command"]
+    _plan_query = """
+        SELECT ts.base_task_id, a.s_id, a.method_id
+          FROM manager.task_sequence AS ts
+          JOIN manager.action AS a ON a.task_id = ts.task_id
+         WHERE ts.base_task_id = ANY(%s::uuid[])
+         ORDER BY ts.base_task_id, ts.number, a.number
+    """
+    _command_query = """
+        SELECT c.s_id, c.action_id, c.parent_id, c.method_id, c.is_parallel, c.number
+          FROM manager.command AS c
+         WHERE c.action_id = ANY(%s::uuid[])
+         ORDER BY c.number
+    """
+
+    def __init__(self, cursor_func) -> None:
+        """
+        :param cursor_func: функция без аргументов, возвращающая курсор DB-API для компиляции планов
+        """
+        self._cursor_func = cursor_func
+        self._lock = threading.RLock()
+        self._data = dict()
+        self._compile_count = 0
+
+    @property
+    def table_list(self) -> list:
+        return list(self._table_list)
+
+    def plan(self, base_task_id) -> list:
+        """
+        Получение плана базовой задачи
+        :param base_task_id: идентификатор базовой задачи
+        :return: список операций (ActionPlan) по порядку выполнения
+        """
+        return self.plan_dict([base_task_id])[str(base_task_id)]
+
+    def plan_dict(self, base_task_id_list: list) -> dict:
+        """
+        Получение планов списка базовых задач (с компиляцией отсутствующих в кэше)
+        :param base_task_id_list: список идентификаторов базовых задач
+        :return: словарь {идентификатор базовой задачи: список операций (ActionPlan)}
+        """
+        data = self._data
+        key_list = {str(base_task_id) for base_task_id in base_task_id_list}
+        if not key_list.issubset(data):
+            with self._lock:
+                missing_list = [key for key in key_list if key not in self._data]
+                if missing_list:
+                    data = dict(self._data)
+                    data.update(self._compile(missing_list))
+                    self._data = data
+                data = self._data
+        return {key: data[key] for key in key_list}
+
+    def _compile(self, base_task_id_list: list) -> dict:
+        """
+        Компиляция планов базовых задач (два запроса на весь список)
+        :param base_task_id_list: список идентификаторов базовых задач
+        :return: словарь {идентификатор базовой задачи: список операций (ActionPlan)}
+        """
+        cursor = self._cursor_func()
+        cursor.execute(self._plan_query, (base_task_id_list,))
+        action_row_list = [(str(base_task_id), str(action_id), str(method_id))
+                           for base_task_id, action_id, method_id in cursor.fetchall()]
+
+        command_dict = dict()
+        action_id_list = list({action_id for _, action_id, _ in action_row_list})
+        if action_id_list:
+            cursor.execute(self._command_query, (action_id_list,))
+            for s_id, action_id, parent_id, method_id, is_parallel, number in cursor.fetchall():
+                key = (str(action_id), str(parent_id) if parent_id else None)
+                command_dict.setdefault(key, list()).append((str(s_id), str(method_id), is_parallel, number))
+
+        plan_dict = {base_task_id: list() for base_task_id in base_task_id_list}
+        for base_task_id, action_id, method_id in action_row_list:
+            plan_dict[base_task_id].append(
+                ActionPlan(action_id, method_id, self._command_tree(command_dict, action_id, None)))
+        self._compile_count += len(base_task_id_list)
+        return plan_dict
+
+    def _command_tree(self, command_dict: dict, action_id: str, parent_id) -> list:
+        """
+        Построение дерева команд операции
+        :param command_dict: словарь {(операция, родительская команда): список команд по порядку}
+        :param action_id: идентификатор операции
+        :param parent_id: идентификатор родительской команды (None - команды верхнего уровня)
+        :return: список команд (CommandPlan)
+        """
+        return [CommandPlan(s_id, method_id, is_parallel, number, self._command_tree(command_dict, action_id, s_id))
+                for s_id, method_id, is_parallel, number in command_dict.get((action_id, parent_id), [])]
+
+    def invalidate(self, table: str = None) -> None:
+        """
+        Сброс всех планов при изменении структуры задач
+        :param table: наименование измененной сущности со схемой (None - сброс без условия)
+        :return:
+        """
+        if table is None or table in self._table_list:
+            with self._lock:
+                self._data = dict()
+
+    def stats(self) -> dict:
+        """
+        Статистика кэша
+        :return: словарь {plan_count - планов в кэше, compile_count - скомпилировано планов}
+        """
+        return {"plan_count": len(self._data), "compile_count": self._compile_count}
@@ -1,28 +1,154 @@
 # -*- coding: utf-8 -*-
+import time
+import logging
+from threading import Thread, Event, Condition, current_thread
+from collections import OrderedDict, deque
+from queue import Empty, Full
 
-from threading import Thread, Event
-from queue import Queue, Empty
+logger = logging.getLogger(__name__)
+
+# Priority classes (lower value is served first)
+PRIORITY_HEARTBEAT = 0
+PRIORITY_COMPLETION = 1
+PRIORITY_DISPATCH = 2
+PRIORITY_FANOUT = 3
+PRIORITY_LIST = (PRIORITY_HEARTBEAT, PRIORITY_COMPLETION, PRIORITY_DISPATCH, PRIORITY_FANOUT)
+
+
+class TaskQueue(object):
+    """Priority- and fairness-aware task queue
+
+    - tasks of a higher priority class are always taken first
+    - inside a class tasks are taken round-robin by key (channel or handler),
+      so one key with a huge backlog cannot starve the others
+    - depth is bounded by max_size (0 - unbounded): put blocks until there
+      is room (backpressure on the producer); heartbeat tasks and unbounded
+      puts (tasks put by the pool's own workers) bypass the bound
+    - wait time (from put to get) is collected per priority class
+
+    Implements the part of queue.Queue used by Worker and ThreadPool:
+    put, get, task_done, join, qsize.
+    """
+    _SAMPLE_SIZE = 1000
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self._cond = Condition()
+        self._queue_list = {priority: OrderedDict() for priority in PRIORITY_LIST}
+        self._size = 0
+        self._unfinished = 0
+        self._wait_list = {priority: deque(maxlen=self._SAMPLE_SIZE) for priority in PRIORITY_LIST}
+        self._count_list = {priority: 0 for priority in PRIORITY_LIST}
+
+    def qsize(self):
+        with self._cond:
+            return self._size
+
+    def put(self, item, priority=PRIORITY_DISPATCH, key=None, block=True, timeout=None, bounded=True):
+        """Put a task into the queue
+
+        :param item: task
+        :param priority: priority class (PRIORITY_*)
+        :param key: fair-share key (tasks with the same key are served in FIFO order)
+        :param block: wait for room if the queue is full
+        :param timeout: maximum wait in seconds (queue.Full is raised on expiry)
+        :param bounded: apply the max_size bound (False - put at once even if the queue is full)
+        """
+        with self._cond:
+            if self.max_size > 0 and bounded and priority != PRIORITY_HEARTBEAT:
+                if not self._cond.wait_for(lambda: self._size < self.max_size, timeout if block else 0):
+                    raise Full
+            self._queue_list[priority].setdefault(key, deque()).append((time.monotonic(), item))
+            self._size += 1
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        """Take the next task: the highest non-empty priority class, round-robin by key"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size > 0, timeout if block else 0):
+                raise Empty
+            for priority in PRIORITY_LIST:
+                key_list = self._queue_list[priority]
+                if key_list:
+                    key, task_list = next(iter(key_list.items()))
+                    put_time, item = task_list.popleft()
+                    # the key goes to the end of the round
+                    del key_list[key]
+                    if task_list:
+                        key_list[key] = task_list
+                    break
+            self._size -= 1
+            self._wait_list[priority].append(time.monotonic() - put_time)
+            self._count_list[priority] += 1
+            self._cond.notify_all()
+            return item
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._unfinished <= 0)
+
+    def stats(self):
+        """Queue statistics per priority class
+
+        :return: dict {priority: {depth, count, wait_avg, wait_p99, wait_max}} (wait in ms)
+        """
+        with self._cond:
+            result = dict()
+            for priority in PRIORITY_LIST:
+                wait_list = sorted(self._wait_list[priority])
+                result[priority] = {
+                    "depth": sum(len(task_list) for task_list in self._queue_list[priority].values()),
+                    "count": self._count_list[priority],
+                    "wait_avg": sum(wait_list) / len(wait_list) * 1000 if wait_list else 0.0,
+                    "wait_p99": wait_list[min(len(wait_list) - 1, int(len(wait_list) * 0.99))] * 1000
+                    if wait_list else 0.0,
+                    "wait_max": wait_list[-1] * 1000 if wait_list else 0.0,
+                }
+            return result
 
 
 class Worker(Thread):
     _TIMEOUT = 2
 
-    def __init__(self, tasks, th_num):
+    def __init__(self, tasks, th_num, connection_pool=None, metrics=None):
         Thread.__init__(self)
         self.tasks = tasks
         self.daemon, self.th_num = True, th_num
+        self.connection_pool = connection_pool
+        self.metrics = metrics
         self.done = Event()
         self.start()
 
     def run(self):
         while not self.done.is_set():
             try:
-                func, args, kwargs = self.tasks.get(block=True,
-                                                    timeout=self._TIMEOUT)
+                func, args, kwargs, name, put_time = self.tasks.get(block=True,
+                                                                    timeout=self._TIMEOUT)
+            except Empty as e:
+                continue
+            is_error = False
+            start = self.metrics.begin(name, time.monotonic() - put_time) if self.metrics else None
+            try:
                 func(*args, **kwargs)
+            except Exception:
+                is_error = True
+                logger.exception("Worker %s: task %s failed", self.th_num, name)
+                # the connection may have been lost: reconnect before the next task
+                if self.connection_pool:
+                    self.connection_pool.check()
+            finally:
+                if self.metrics:
+                    self.metrics.end(name, start, is_error)
                 self.tasks.task_done()
-            except Empty as e:
-                pass
+        if self.connection_pool:
+            self.connection_pool.release()
         return
 
     def signal_exit(self):
@@ -31,22 +157,57 @@ class Worker(Thread):
 
 
 class ThreadPool:
-    """Pool of threads consuming tasks from a queue"""
-    def __init__(self, num_threads):
-        self.tasks = Queue()
+    """Pool of threads consuming tasks from a queue
+
+    If connection_pool is set, every worker leases its own database
+    connection from it and returns the connection on exit.
+
+    Tasks are scheduled by TaskQueue: priority_map maps a function name to
+    its priority class (PRIORITY_DISPATCH by default), max_size bounds the
+    queue depth (add_task blocks while the queue is full).
+
+    Only producers outside the pool (the listen thread, notify coalescer
+    timers) are blocked by the bound: a task put by a worker of this pool
+    (e.g. a handler fanning out follow-up handlers) is queued at once,
+    otherwise workers blocked on a full queue would leave nobody to drain it.
+
+    If metrics (TaskMetrics) is set, every task is timed under its handler
+    name: queue wait, duration, errors and the SQL it ran.
+    """
+    def __init__(self, num_threads, connection_pool=None, priority_map=None, max_size=0, metrics=None):
+        self.tasks = TaskQueue(max_size)
         self.workers = list()
         self.done = False
+        self.connection_pool = connection_pool
+        self.priority_map = priority_map or dict()
+        self.metrics = metrics
         self._init_workers(num_threads)
         # for task in tasks:
         #     self.tasks.put(task)
 
     def _init_workers(self, num_threads):
         for i in range(num_threads):
-            self.workers.append(Worker(self.tasks, i))
+            self.workers.append(Worker(self.tasks, i, self.connection_pool, self.metrics))
 
     def add_task(self, func, *args, **kwargs):
-        """Add a task to the queue"""
-        self.tasks.put((func, args, kwargs))
+        """Add a task to the queue (priority by priority_map, fair-share key - function name)"""
+        self.put_task(func, args, kwargs)
+
+    def put_task(self, func, args=(), kwargs=None, priority=None, key=None, name=None):
+        """Add a task to the queue with an explicit priority class and fair-share key
+
+        :param name: handler name for metrics (the function name by default), e.g. the
+                     wrapped handler when func is a generic runner
+        """
+        func_name = getattr(func, "__name__", None)
+        if priority is None:
+            priority = self.priority_map.get(func_name, PRIORITY_DISPATCH)
+        self.tasks.put((func, args, kwargs or dict(), name or func_name or str(func), time.monotonic()),
+                       priority, key or func_name, bounded=current_thread() not in self.workers)
+
+    def stats(self):
+        """Queue statistics per priority class (see TaskQueue.stats)"""
+        return self.tasks.stats()
 
     def _close_all_threads(self):
         """ Signal all threads to exit and lose the references to them """
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import gzip
+from contextlib import contextmanager
+
+
+@contextmanager
+def transaction(cursor):
+    """
+    Выполнение блока запросов в одной транзакции
+    (подключение службы работает в режиме autocommit, поэтому транзакция открывается явно)
+
+    :param cursor: курсор DB-API
+    :return:
+    """
+    cursor.execute("BEGIN")
+    try:
+        yield cursor
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    else:
+        cursor.execute("COMMIT")
+
+
+def _copy_value(value) -> str:
+    """
+    Преобразование значения в формат text команды COPY
+    :param value: значение
+    :return: строка
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(cursor, table: str, column_list: list, row_list: list) -> int:
+    """
+    Загрузка записей в сущность через COPY ... FROM STDIN
+    (если курсор не поддерживает COPY, то записи загружаются многострочными INSERT)
+
+    :param cursor: курсор DB-API
+    :param table: наименование сущности со схемой
+    :param column_list: список атрибутов
+    :param row_list: список кортежей значений в порядке column_list
+    :return: количество загруженных записей
+    """
+    if not row_list:
+        return 0
+    if not hasattr(cursor, "copy_expert"):
+        return insert_rows(cursor, table, column_list, row_list)
+    data = io.StringIO()
+    for row in row_list:
+        data.write("\t".join(_copy_value(value) for value in row))
+        data.write("\n")
+    data.seek(0)
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(column_list)), data)
+    return len(row_list)
+
+
+def insert_rows(cursor, table: str, column_list: list, row_list: list, page_size: int = 1000) -> int:
+    """
+    Загрузка записей в сущность многострочными INSERT (по page_size записей в одном запросе)
+
+    :param cursor: курсор DB-API
+    :param table: наименование сущности со схемой
+    :param column_list: список атрибутов
+    :param row_list: список кортежей значений в порядке column_list
+    :param page_size: количество записей в одном запросе
+    :return: количество загруженных записей
+    """
+    row_query = "({})".format(", ".join(["%s"] * len(column_list)))
+    for i in range(0, len(row_list), page_size):
+        page = row_list[i:i + page_size]
+        query = "INSERT INTO {} ({}) VALUES {}".format(
+            table, ", ".join(column_list), ", ".join([row_query] * len(page)))
+        cursor.execute(query, [value for row in page for value in row])
+    return len(row_list)
+
+
+def copy_to_file(cursor, table: str, path: str) -> None:
+    """
+    Выгрузка сущности в сжатый файл через COPY ... TO STDOUT (формат csv с заголовком, gzip)
+    (файл сначала пишется во временный и затем переименовывается, поэтому прерванная выгрузка
+     не оставляет неполный файл под итоговым именем)
+
+    :param cursor: курсор DB-API
+    :param table: наименование сущности со схемой
+    :param path: путь к файлу
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+        cursor.copy_expert("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)".format(table), file)
+    os.replace(tmp_path, path)
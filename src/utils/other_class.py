@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 import json
+import socket
+from uuid import uuid4
 from datetime import datetime
 
 from utils.exceptions import FindModuleError, TaskError
 from utils.wrapper import message_wrapper, task_wrapper
 from utils.base_utils.base_class import BaseSVC
-from utils.status_type import MsgTypeChoice
+from utils.base_utils.acknowledger import MessageAcknowledger
+from utils.base_utils.heartbeat import HeartbeatSender
+from utils.base_utils.object_resolver import ObjectResolver
+from utils.base_utils.thread_pool import PRIORITY_HEARTBEAT, PRIORITY_COMPLETION
+from utils.status_type import MsgTypeChoice, StatusSendChoice
 
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm import exc
-from orm.models import ModuleModel
+from orm.models import ModuleModel, ModuleInstanceModel, MessageModel
 
 
 class BaseFunctionalSVC(BaseSVC):
@@ -17,7 +24,9 @@ class BaseFunctionalSVC(BaseSVC):
     Базовый класс функциональной службы
 
     Основные задачи:
-     - подписка на канал, который прописан в базе данных в сущности "Службы и модули" для соответствующего модуля
+     - подписка на канал, который прописан в базе данных в сущности "Службы и модули" для соответствующего модуля,
+       и на собственный канал экземпляра службы (служба может быть запущена несколькими экземплярами,
+       менеджер задач распределяет задачи между ними с учетом загрузки)
      - запуск первичной задачи: уведомление менеджера задач о начале работы
      - при получении сообщения:
         - обработка сообщения (предполагается, что сообщение - это json, преобразованный в строку)
@@ -28,16 +37,42 @@ class BaseFunctionalSVC(BaseSVC):
 
     _module = None
     _manager = None
+    _priority_func = {"_connect": PRIORITY_HEARTBEAT, "_error_method": PRIORITY_COMPLETION}
+    _heartbeat_delete_query = "DELETE FROM manager.module_heartbeat WHERE instance_id = :instance_id"
+    # Размер пачки и время ожидания записи пачки (в миллисекундах) буфера квитирования
+    _ack_max_count = 500
+    _ack_max_wait = 50
+    # Период (в миллисекундах) отправки сигналов работоспособности
+    _heartbeat_interval = 200
+    # Размер кэша наборов объектов (количество базовых задач) и количество объектов, начиная с которого
+    # объекты передаются в метод ленивым списком, загружаемым частями (см. task_model_wrapper)
+    _object_cache_size = 1000
+    _object_chunk_size = 1000
+    # Размер пачки частей результата и минимальный период (в миллисекундах) сообщений о ходе выполнения
+    # методов-генераторов (см. ResultStream)
+    _stream_chunk_size = 1000
+    _stream_interval = 1000
+
+    acknowledger = None
+    heartbeat = None
+    instance = None
+    object_resolver = None
 
     def __init__(self, system_name: str, thread_count: int, host: str, port: str, db_name: str, user: str,
-                 channel_name: str, manager_name: str) -> None:
+                 channel_name: str, manager_name: str, batch_ack: bool = False) -> None:
         """
         Конструктор класса
 
         Инициализирует:
          - все параметры из базового класса
+         - сессию, своя для каждого потока (подключения выдаются из пула размером на количество потоков
+           и поток подписки, перед выдачей подключение проверяется и при потере переподключается;
+           запросы сессии учитываются в метриках задач)
          - данные функциональной службе
          - данные о менеджере задач
+         - поиск объектов задач с кэшем по базовой задаче (см. ObjectResolver)
+         - буфер квитирования, если включен пакетный режим квитирования: статусы отправки пришедших сообщений
+           и ответные сообщения записываются пачками (см. MessageAcknowledger)
 
         :param system_name: системное наименование функциональной службы
         :param thread_count: количество потоков для пула потоков
@@ -47,11 +82,20 @@ class BaseFunctionalSVC(BaseSVC):
         :param user: роль для подключения к базе данных
         :param channel_name: наименование канала, в который поступают сообщения от базы данных
         :param manager_name: системное наименование менеджера задач
+        :param batch_ack: признак пакетного режима квитирования
         """
-        BaseSVC.__init__(self, thread_count, host, port, db_name, user, channel_name)
-        self.session = Session(bind=self.e)
+        super().__init__(thread_count, host, port, db_name, user, channel_name)
+        self.engine = create_engine("postgresql+psycopg2://", creator=self.connect, pool_size=thread_count + 1,
+                                    max_overflow=0, pool_pre_ping=True)
+        self.task_metrics.instrument_engine(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
         self.module = system_name
         self.manager = manager_name
+        self.object_resolver = ObjectResolver(self.session, self._object_cache_size)
+        if batch_ack:
+            self.acknowledger = MessageAcknowledger(self.session, MessageModel, StatusSendChoice.recd.value,
+                                                    StatusSendChoice.ok.value, self._ack_max_count,
+                                                    self._ack_max_wait)
 
     @property
     def module(self):
@@ -85,14 +129,64 @@ class BaseFunctionalSVC(BaseSVC):
         Запуск подписки на список каналов
 
         Основные задачи метода:
-         - инициализация списка каналов для функциональной службы
+         - регистрация экземпляра службы (см. register_instance)
+         - инициализация списка каналов для функциональной службы: канал службы и канал экземпляра
+         - запуск отправки сигналов работоспособности экземпляра (см. HeartbeatSender)
          - запуск данного метода базового класса службы (так как _listen базового класса - закрытый)
+         - при остановке: удаление экземпляра и его сигнала работоспособности; статус службы изменяется
+           на неработоспособный, если других экземпляров службы нет
+
+        :return:
+        """
+        self.instance = self.register_instance()
+        self._extra_channel_list = [self.instance.channel_name]
+        self.table_list = [self.module["channel_name"], self.instance.channel_name]
+        self.heartbeat = HeartbeatSender(self.connect, self.module.s_id, self._heartbeat_interval, self.instance.s_id)
+        super().run()
+        self.heartbeat.stop()
+        if self.acknowledger:
+            self.acknowledger.stop()
+        self.session.execute(text(self._heartbeat_delete_query), {"instance_id": str(self.instance.s_id)})
+        self.session.delete(self.instance)
+        self.session.flush()
+        if not self.session.query(ModuleInstanceModel).filter(
+                ModuleInstanceModel.module_id == self.module.s_id).count():
+            self.module.status = False
+        self.session.commit()
+
+    def register_instance(self) -> ModuleInstanceModel:
+        """
+        Регистрация экземпляра службы в сущности "Экземпляры служб"
+
+        Канал экземпляра - канал службы с суффиксом из идентификатора экземпляра,
+        емкость - количество потоков пула потоков.
+
+        :return: запись экземпляра службы
+        """
+        s_id = uuid4()
+        instance = ModuleInstanceModel(s_id=s_id, module_id=self.module.s_id,
+                                       channel_name="{}_{}".format(self.module["channel_name"], s_id.hex[:8]),
+                                       capacity=self._thread_count, host=socket.gethostname())
+        self.session.add(instance)
+        self.session.commit()
+        return instance
+
+    def set_message_status(self, id_list: list, status: str) -> None:
+        """
+        Изменение статуса отправки списка сообщений
+        (в пакетном режиме квитирования - через буфер квитирования, иначе одним запросом)
 
+        :param id_list: список идентификаторов сообщений из сущности "Сообщения"
+        :param status: статус отправки
         :return:
         """
-        self.table_list = [self.module["channel_name"]]
-        BaseSVC.run(self)
-        self.module.status = False
+        if self.acknowledger:
+            mark = self.acknowledger.received if status == StatusSendChoice.recd.value else self.acknowledger.done
+            for s_id in id_list:
+                mark(s_id)
+            return
+        self.session.query(MessageModel).filter(MessageModel.s_id.in_(id_list)).update(
+            {MessageModel.status: status}, synchronize_session=False)
         self.session.commit()
 
     def add_task(self, channel: str, data: str) -> None:
@@ -110,6 +204,8 @@ class BaseFunctionalSVC(BaseSVC):
                 - получение метода из сообщения (обязательный аргумент)
                 - поиск соответствующего метода в классе
                 - добавление в очередь на выполнение данного метода со всеми пришедшими данными
+                  (для группы задач пакетного выполнения (task_id_list) - одна задача на группу, если метод
+                   поддерживает пакетное выполнение (см. batch_task_wrapper), иначе задача на каждое сообщение)
                 - если метода в сообщении нет или не существует соответствующего метода класса,
                   то вызывается метод на отправку сообщения об ошибке
 
@@ -119,6 +215,8 @@ class BaseFunctionalSVC(BaseSVC):
         """
         data = json.loads(data)
         task_id = data.pop("task_id")
+        task_id_list = data.pop("task_id_list", None)
+        data.pop("batch", None)
 
         msg_type = data.get("msg_type")
         if msg_type == MsgTypeChoice.connect.value:
@@ -137,10 +235,15 @@ class BaseFunctionalSVC(BaseSVC):
                     message = "{} не имеет метод {}".format(self.module["name"], data["method"])
                     raise TaskError(message)
 
-                self.pool_task.add_task(func, task_id=task_id, **data)
+                if task_id_list and getattr(func, "is_batch", False):
+                    self.pool_task.add_task(func, task_id_list=task_id_list, **data)
+                else:
+                    for s_id in task_id_list or [task_id]:
+                        self.pool_task.add_task(func, task_id=s_id, **data)
             except TaskError as ex:
-                self.pool_task.add_task(self._error_method, task_id=task_id, data={"message": str(ex)},
-                                        send_id=self.module, get_id=self.manager)
+                for s_id in task_id_list or [task_id]:
+                    self.pool_task.add_task(self._error_method, task_id=s_id, data={"message": str(ex)},
+                                            send_id=self.module, get_id=self.manager)
 
     def period_task(self) -> None:
         """
@@ -2,8 +2,8 @@
 
 import time
 import copy
+import inspect
 from sqlalchemy.orm import exc
-from sqlalchemy import desc
 from datetime import datetime
 from functools import wraps
 
@@ -11,11 +11,11 @@ from status_type import StatusSendChoice
 from status_type import MsgTypeChoice
 
 from orm.models import MessageModel
-from orm.models import ObjectToTaskLogModel
+from orm.models import MessagePayloadModel
 from orm.models import ObjectToCommandLogModel
-from orm.models import TaskLogModel
-from orm.models import ActionModel
 from orm.models import CommandLogModel
+from utils.base_utils.object_resolver import ObjectResolver, ChunkedObjectList
+from utils.base_utils.result_stream import ResultStream
 
 
 def task_wrapper(func):
@@ -31,7 +31,16 @@ def task_wrapper(func):
     - создание записи в ИР "Сообщения" с результатом выполнения функции, с ссылкой на пришедшее сообщение и задачу
       (если оно указано)
 
-    :param func: декорируемая функция, результат которой кортеж:
+    Если у службы задан буфер квитирования (атрибут acknowledger, см. MessageAcknowledger), то изменения статусов
+    и ответное сообщение передаются в буфер и записываются пачкой вместе с другими задачами,
+    а в потоке задачи выполняется одна фиксация транзакции (результат работы декорируемой функции).
+
+    Если декорируемая функция - генератор, то результат передается потоком (см. ResultStream): части результата
+    записываются пачками в сущность "Данные сообщений" с идентификатором ответного сообщения, ход выполнения
+    (Progress) - сообщениями с типом "Информация" (размер пачки и период сообщений - атрибуты службы
+    _stream_chunk_size и _stream_interval).
+
+    :param func: декорируемая функция (или генератор), результат которой кортеж:
                      - result - результат выполнения функции
                      - is_error - признак ошибки
                      - data - данные для сохранения в сущности "Сообщения"
@@ -55,6 +64,7 @@ def task_wrapper(func):
         msg_type = kwargs.pop("msg_type")
         send_id = kwargs.pop("send_id", None)
         get_id = kwargs.pop("get_id", None)
+        acknowledger = getattr(self, "acknowledger", None)
         is_error = False
         if task_id:
             try:
@@ -65,10 +75,13 @@ def task_wrapper(func):
 
         if not is_error:
             if task_id:
-                task_id.status = StatusSendChoice.recd.value
-                self.session.commit()
+                if acknowledger:
+                    acknowledger.received(task_id.s_id)
+                else:
+                    task_id.status = StatusSendChoice.recd.value
+                    self.session.commit()
 
-            result, is_error, data = func(*args, task_id=task_id, **kwargs)
+            ret = func(*args, task_id=task_id, **kwargs)
 
             post_data = {
                 "send_id": send_id if not task_id else task_id.get_id,
@@ -77,6 +90,25 @@ def task_wrapper(func):
                 "status": StatusSendChoice.sent.value,
             }
 
+            if inspect.isgenerator(ret):
+                progress_data = None
+                if task_id:
+                    progress_data = {
+                        "send_id": post_data["send_id"], "get_id": post_data["get_id"],
+                        "status": StatusSendChoice.sent.value, "msg_type": MsgTypeChoice.info.value,
+                        "parent_msg_id": task_id.s_id, "task_log_id": task_id.task_log_id,
+                        "command_log_id": task_id.command_log_id,
+                    }
+                stream = ResultStream(self.session, MessageModel, MessagePayloadModel, progress_data,
+                                      getattr(self, "_stream_chunk_size", 1000),
+                                      getattr(self, "_stream_interval", 1000))
+                result, is_error, data = stream.consume(ret)
+                if stream.chunk_count:
+                    post_data["s_id"] = stream.message_id
+                post_data["date_created"] = datetime.now()
+            else:
+                result, is_error, data = ret
+
             if msg_type == MsgTypeChoice.connect.value:
                 post_data["msg_type"] = MsgTypeChoice.connect.value
             elif data and "msg_type" in data:
@@ -92,6 +124,11 @@ def task_wrapper(func):
             if data:
                 post_data["data"] = data
 
+            if acknowledger:
+                self.session.commit()
+                acknowledger.done(task_id.s_id if task_id else None, post_data)
+                return
+
             self.session.add(MessageModel(**post_data))
             self.session.commit()
 
@@ -102,6 +139,87 @@ def task_wrapper(func):
     return wrapper
 
 
+def batch_task_wrapper(func):
+    """
+    Декоратор обработки группы сообщений пакетного выполнения из сущности "Сообщения"
+
+    Менеджер задач объединяет задачи одной группы (команды одной родительской записи с одной командой
+    для метода с признаком пакетного выполнения) в один notify со списком задач (task_id_list).
+
+    Основные задачи декоратора:
+     - получение всех сообщений группы одним запросом
+     - "квитирование" сообщений группы: перед выполнением функции - "Получено", после - "Обработано"
+       (одним запросом на группу, см. set_message_status службы)
+     - запуск декорируемой функции со списком сообщений (именованный аргумент task_id_list)
+     - создание ответных записей в сущности "Сообщения" по результатам для каждого сообщения
+       одной вставкой (в пакетном режиме квитирования - через буфер квитирования)
+
+    Декорированный метод помечается признаком is_batch: служба передает ему группу целиком
+    (метод без признака получает задачи группы по одной).
+
+    :param func: декорируемая функция, результат которой словарь {идентификатор сообщения: кортеж}:
+                     - result - результат выполнения функции
+                     - is_error - признак ошибки
+                     - data - данные для сохранения в сущности "Сообщения"
+                       (с ключом message для отображения в пользовательском интерфейсе)
+    :return:
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        """
+        :param args:
+        :param kwargs:
+                     - task_id_list - список идентификаторов сообщений из сущности "Сообщения"
+                     - msg_type - тип сообщения
+        :return:
+        """
+        self = args[0]
+        task_id_list = kwargs.pop("task_id_list")
+        kwargs.pop("msg_type", None)
+        acknowledger = getattr(self, "acknowledger", None)
+        message_list = self.session.query(MessageModel).filter(MessageModel.s_id.in_(task_id_list)).all()
+        if not message_list:
+            return
+        id_list = [message.s_id for message in message_list]
+        self.set_message_status(id_list, StatusSendChoice.recd.value)
+
+        result_dict = func(*args, task_id_list=message_list, **kwargs) or dict()
+
+        post_data_list = list()
+        for message in message_list:
+            result, is_error, data = result_dict.get(
+                str(message.s_id), (None, True, {"message": "Нет результата выполнения задачи"}))
+            post_data = {
+                "send_id": message.get_id,
+                "get_id": message.send_id,
+                "date_created": datetime.now(),
+                "status": StatusSendChoice.sent.value,
+                "parent_msg_id": message.s_id,
+                "task_log_id": message.task_log_id,
+                "command_log_id": message.command_log_id,
+            }
+            if data and "msg_type" in data:
+                post_data["msg_type"] = data["msg_type"]
+            else:
+                post_data["msg_type"] = MsgTypeChoice.error.value if is_error else MsgTypeChoice.success.value
+            if data:
+                post_data["data"] = data
+            post_data_list.append((message.s_id, post_data))
+
+        if acknowledger:
+            self.session.commit()
+            for s_id, post_data in post_data_list:
+                acknowledger.done(s_id, post_data)
+            return
+
+        self.session.bulk_insert_mappings(MessageModel, [post_data for _, post_data in post_data_list])
+        self.set_message_status(id_list, StatusSendChoice.ok.value)
+
+    wrapper.is_batch = True
+    return wrapper
+
+
 def task_model_wrapper(model):
     """
     Декоратор для указания модели SQLAlchemy
@@ -118,10 +236,10 @@ def task_model_wrapper(model):
          выполняемой задач с созданным объектом)
 
         Основные задачи декоратора:
-         - получение задачи из сущности "Аудит выполнения задач" верхнего уровня
-         - получение записи из сущности "Связь аудита выполнения задач с объектами"
-         - получение идентификаторов объектов
-         - получение записи из модели с указанным идентификатором
+         - получение идентификаторов объектов ближайшей задачи с объектами (задача из сущности "Аудит выполнения
+           задач" той же базовой задачи с номером операции не больше текущего, см. ObjectResolver)
+         - получение записей из модели с указанными идентификаторами (если идентификаторов больше, чем
+           _object_chunk_size службы, - ленивый список, загружаемый частями, см. ChunkedObjectList)
          - запуск декорируемой функции с пришедшими параметрами и полученной записи объекта
            (функция должна сама обрабатывать raise, либо должна быть обернута в декоратор @logger)
 
@@ -154,36 +272,27 @@ def task_model_wrapper(model):
             task_id = kwargs.pop("task_id", None)
             object_list = None
             if task_id:
-                object_to_task_log_list = None
-                task_log_list = self.session.query(TaskLogModel).join(ActionModel).filter(
-                    ActionModel.number <= task_id.task_log.action.number,
-                    TaskLogModel.main_task_log_id == task_id.task_log.main_task_log_id
-                ).order_by(desc(ActionModel.number)).all()
-                # task_log_list = TaskLogModel.objects.filter(
-                #     action_id__number__lte=task_id.task_log_id.action_id.number,
-                #     main_task_log_id=task_id.task_log_id.main_task_log_id
-                # ).order_by("-action_id__number")
-                for task_log in task_log_list:
-                    object_to_task_log_list = self.session.query(ObjectToTaskLogModel).filter(
-                        ObjectToTaskLogModel.task_log_id == task_log.s_id).all()
-                    # object_to_task_log_list = ObjectToTaskLogModel.objects.filter(task_log_id=task_log_id)
-                    if object_to_task_log_list:
-                        break
-
-                if not object_to_task_log_list:
+                resolver = getattr(self, "object_resolver", None) or ObjectResolver(self.session, 0)
+                object_set = resolver.resolve([task_id.task_log])[str(task_id.task_log.s_id)]
+                if object_set is None:
                     message = "Не существует связанных объектов с задачей {}".format(task_id.task_log_id)
                     return None, True, {"message": message}
-                object_id_list = set([object_to_task_log.object_id for object_to_task_log in object_to_task_log_list])
+                object_id_list = list(dict.fromkeys(object_set.object_id_list))
                 if not model.__table__.primary_key:
                     message = f"Не существует первичного ключа в сущности {model.__table_args__['schema']}.{model.__tablename__}"
                     return None, True, {"message": message}
-                primary_key = getattr(model, model.__table__.primary_key[0].name)
-                object_list = self.session.query(model).filter(primary_key.in_(object_id_list)).all()
-                # object_list = model.objects.filter(pk__in=object_id_list)
-                if not object_list:
-                    message = "В сущности {}.{} не существует записи с идентификаторами {}".format(
-                        model.__table_args__["schema"], model.__tablename__, ", ".join(object_id_list))
-                    return None, True, {"message": message}
+                chunk_size = getattr(self, "_object_chunk_size", None)
+                if chunk_size and len(object_id_list) > chunk_size:
+                    # большой набор объектов передается ленивым списком, загружаемым частями
+                    object_list = ChunkedObjectList(self.session, model, object_id_list, chunk_size)
+                else:
+                    primary_key = getattr(model, model.__table__.primary_key[0].name)
+                    object_list = self.session.query(model).filter(primary_key.in_(object_id_list)).all()
+                    if not object_list:
+                        message = "В сущности {}.{} не существует записи с идентификаторами {}".format(
+                            model.__table_args__["schema"], model.__tablename__,
+                            ", ".join(str(s_id) for s_id in object_id_list))
+                        return None, True, {"message": message}
 
             return func(*args, task_id=task_id, object_list=object_list, **kwargs)
 
@@ -264,7 +373,7 @@ def command_model_wrapper(model):
                         return None, True, {"message": message}
                     primary_key = getattr(model, model.__table__.primary_key[0].name)
                     try:
-                        object_id = self.session.query(model).filter(primary_key == object_id).one()
+                        object_id = self.session.query(model).filter(primary_key == s_id).one()
                         # object_id = model.objects.get(pk=s_id)
                     # except model.DoesNotExist:
                     except exc.NoResultFound:
@@ -279,6 +388,92 @@ def command_model_wrapper(model):
     return model_wrapper
 
 
+def command_batch_model_wrapper(model):
+    """
+    Декоратор для указания модели SQLAlchemy (пакетное выполнение команд)
+
+    :param model: модель SQLAlchemy
+    :return:
+    """
+
+    def model_wrapper(func):
+        """
+        Декоратор получения записей указанной модели для группы команд
+        (используется вместе с @batch_task_wrapper)
+
+        Основные задачи декоратора:
+         - получение объектов всех команд группы из сущности "Связь Аудита выполнения команд с объектами"
+           одним запросом
+         - получение записей из модели с указанными идентификаторами одним запросом (IN)
+         - для команд без объекта (или с несколькими объектами, или без записи в модели) - результат с ошибкой
+         - запуск декорируемой функции со списком сообщений и списком записей
+         - сопоставление результатов по объектам с сообщениями
+
+        :param func: декорируемая функция, результат которой словарь {идентификатор объекта: кортеж}:
+                     - result - результат выполнения функции
+                     - is_error - признак ошибки
+                     - data - данные для сохранения в сущности "Сообщения"
+                       (с ключом message для отображения в пользовательском интерфейсе)
+        :return:
+        """
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """
+            :param args:
+            :param kwargs:
+                         - task_id_list - список записей из сущности "Сообщения"
+            :return: словарь {идентификатор сообщения: кортеж (result, is_error, data)}
+            """
+            self = args[0]
+            message_list = kwargs.pop("task_id_list")
+            result_dict = dict()
+            if not model.__table__.primary_key:
+                message = f"Не существует первичного ключа в сущности " \
+                          f"{model.__table_args__['schema']}.{model.__tablename__}"
+                return {str(task_id.s_id): (None, True, {"message": message}) for task_id in message_list}
+
+            object_dict = dict()
+            for command_log_id, object_id in self.session.query(
+                    ObjectToCommandLogModel.command_log_id, ObjectToCommandLogModel.object_id).filter(
+                    ObjectToCommandLogModel.command_log_id.in_([task_id.command_log_id for task_id in message_list])):
+                object_dict.setdefault(str(command_log_id), list()).append(object_id)
+            primary_key = getattr(model, model.__table__.primary_key[0].name)
+            object_id_list = {object_id_list[0] for object_id_list in object_dict.values() if len(object_id_list) == 1}
+            object_list = self.session.query(model).filter(primary_key.in_(object_id_list)).all() \
+                if object_id_list else []
+            found_set = {str(getattr(instance, primary_key.key)) for instance in object_list}
+
+            object_message_dict = dict()
+            for task_id in message_list:
+                object_id_list = object_dict.get(str(task_id.command_log_id), [])
+                if not object_id_list:
+                    message = "Не существует необходимого связанного объекта с командой {}".format(
+                        task_id.command_log_id)
+                elif len(object_id_list) > 1:
+                    message = "Существует больше одного связанного объекта с командой {}".format(
+                        task_id.command_log_id)
+                elif str(object_id_list[0]) not in found_set:
+                    message = "В сущности {}.{} не существует записи с идентификатором {}".format(
+                        model.__table_args__["schema"], model.__tablename__, object_id_list[0])
+                else:
+                    object_message_dict.setdefault(str(object_id_list[0]), list()).append(task_id)
+                    continue
+                result_dict[str(task_id.s_id)] = (None, True, {"message": message})
+
+            if object_list:
+                task_id_list = [task_id for task_id_list in object_message_dict.values() for task_id in task_id_list]
+                object_result = func(*args, task_id_list=task_id_list, object_list=object_list, **kwargs) or dict()
+                for object_id, result in object_result.items():
+                    for task_id in object_message_dict.get(str(object_id), []):
+                        result_dict[str(task_id.s_id)] = result
+            return result_dict
+
+        return wrapper
+
+    return model_wrapper
+
+
 def info_logger(func):
     """
     Декоратор для создания записи в сущности "Сообщения" с типом сообщения "Информация"
@@ -291,6 +486,7 @@ def info_logger(func):
      - если признак ошибки отрицательный и поле data не пустое, то в поле data производится поиск поля тип сообщения,
         - если поля не существует, то создается запись в сущности "Сообщения" с типом "Информация"
         - иначе создается запись в сущности "Сообщения" с указанным типом (например "Внимание")
+     - если у службы задан буфер квитирования (атрибут acknowledger), то запись передается в буфер
 
     :param func: декорируемая функция, результат которой кортеж:
                 - result - результат выполнения функции
@@ -326,6 +522,10 @@ def info_logger(func):
                 "command_log_id": task_id.command_log_id,
                 "data": data
             }
+            acknowledger = getattr(self, "acknowledger", None)
+            if acknowledger:
+                acknowledger.add_message(post_data)
+                return result, is_error, data
             self.session.add(MessageModel(**post_data))
             self.session.commit()
             # MessageModel.objects.create(**post_data)
@@ -336,20 +536,29 @@ def info_logger(func):
 
 
 def message_wrapper(func):
+    """
+    Декоратор "квитирования" списка пришедших сообщений
+
+    Основные задачи декоратора:
+     - перед выполнением функции - изменение статуса отправки всех сообщений на "Получено"
+     - запуск декорируемой функции с пришедшими параметрами
+     - после выполнения функции - изменение статуса отправки всех сообщений на "Обработано"
+
+    Статус изменяется одним запросом на весь список сообщений (см. set_message_status службы).
+
+    :param func: декорируемая функция, первый аргумент которой - список записей (или идентификаторов)
+                 из сущности "Сообщения"
+    :return:
+    """
     @wraps(func)
     def wrapper(*args, **kwargs):
         self = args[0]
         message_list = args[1]
-        if message_list:
-            for message in message_list:
-                message.status = StatusSendChoice.recd.value
-                # message.save()
-            self.session.commit()
+        id_list = [getattr(message, "s_id", message) for message in message_list or []]
+        if id_list:
+            self.set_message_status(id_list, StatusSendChoice.recd.value)
 
         func(*args, **kwargs)
-        if message_list:
-            for message in message_list:
-                message.status = StatusSendChoice.ok.value
-                # message.save()
-            self.session.commit()
+        if id_list:
+            self.set_message_status(id_list, StatusSendChoice.ok.value)
     return wrapper